@@ -2,37 +2,64 @@
 Музыкальный Telegram бот для поиска и скачивания музыки
 @DownloaderSSMusicBot
 """
+import time
+
+# Отсчёт холодного старта - до тяжёлых импортов
+from startup import StartupTimer
+startup = StartupTimer()
+
 import asyncio
+import hashlib
 import os
 import logging
 import json
+import tempfile
+from functools import partial
 from io import BytesIO
 from typing import Optional
 from datetime import datetime
 
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command, CommandStart
-from aiogram.types import Message, BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.types import (
+    Message, BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery,
+    InlineQuery, InlineQueryResultArticle, InlineQueryResultCachedAudio, InputTextMessageContent,
+    InputMediaAudio, FSInputFile
+)
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 # from dotenv import load_dotenv
 from aiohttp import web
 
-from yandex_music_downloader import YandexMusicDownloader
+from sources import LazyDownloader, SourceRegistry
+import yandex_catalog
+from track_catalog import TrackCatalog
+from suggest import SuggestionTrie
+from prefetch import AudioCache, Prefetcher
+from popularity import PopularityTracker
+from rate_limit import BotApiScheduler, PRIORITY_HIGH, PRIORITY_LOW
+from log_setup import setup_logging
+from throttling import ThrottlingMiddleware
+from broadcast import Broadcaster
+from caches import TTLCache, FileIdStore
+from jobs import DownloadJobs, DownloadFailed, JobCancelled, JobTimeout
+from job_queue import JobQueue, JobWorkers
+from http_pool import close_session
+from similar import CoDownloads
+from covers import CoverArt
+from quality import UPLOAD_LIMIT, TrackTooLarge
+from tagging import Tagger
+from user_store import export_users
+import snapshot
+
+startup.mark('импорт')
 
 # Загружаем переменные окружения
 # load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),  # Вывод в консоль
-        logging.FileHandler('bot.log', encoding='utf-8')  # Сохранение в файл
-    ]
-)
+# Настройка логирования: запись в консоль и в ротируемый JSON-файл идёт в фоновом потоке
+log_listener = setup_logging(os.path.join(os.path.dirname(__file__), 'bot.log'))
 logger = logging.getLogger(__name__)
 
 # Токен бота (замените на ваш)
@@ -43,12 +70,260 @@ bot = Bot(token=BOT_TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 
+# Планировщик исходящих запросов к Bot API
+api = BotApiScheduler()
+
+# Лимиты на пользователя: лишние обновления отбрасываются до фильтров и обработчиков
+throttling = ThrottlingMiddleware()
+dp.message.outer_middleware(throttling)
+dp.callback_query.outer_middleware(throttling)
+dp.inline_query.outer_middleware(throttling)
+
 # ID админа для доступа к статистике
 ADMIN_ID = 7850455999
 
 # Путь к файлу статистики
 STATS_FILE = os.path.join(os.path.dirname(__file__), 'users_stats.json')
 
+# Путь к файлу прогресса рассылки
+BROADCAST_FILE = os.path.join(os.path.dirname(__file__), 'broadcast_state.json')
+
+# Путь к базе каталога треков
+CATALOG_FILE = os.path.join(os.path.dirname(__file__), 'catalog.db')
+
+# Путь к файлу популярности запросов и треков
+POPULARITY_FILE = os.path.join(os.path.dirname(__file__), 'popularity.json')
+
+# Путь к файлу с file_id отправленных треков
+FILE_IDS_FILE = os.path.join(os.path.dirname(__file__), 'file_ids.json')
+
+# Путь к базе очереди заданий на скачивание
+JOBS_FILE = os.path.join(os.path.dirname(__file__), 'jobs.db')
+
+# Путь к базе истории скачиваний (для похожих треков)
+DOWNLOADS_FILE = os.path.join(os.path.dirname(__file__), 'downloads.db')
+
+# Каталог кэша обложек и обложка по умолчанию
+COVERS_DIR = os.path.join(os.path.dirname(__file__), 'covers')
+DEFAULT_COVER_FILE = os.path.join(os.path.dirname(__file__), 'thumbnail.jpg')
+
+# Путь к снимку индексов и кэшей (пишется при остановке и периодически)
+SNAPSHOT_FILE = os.path.join(os.path.dirname(__file__), 'snapshot.bin')
+
+# Сколько треков запрашиваем у источника (одна выборка на чат и inline-режим)
+SEARCH_LIMIT = 50
+
+# Сколько результатов показываем в чате
+CHAT_RESULTS_LIMIT = 20
+
+# Прогрев при старте: сколько популярных запросов и треков и сколько секунд на это отводим
+WARMUP_QUERIES = 50
+WARMUP_TRACKS = 20
+WARMUP_TIMEOUT = 15
+
+# Треков на странице результатов
+TRACKS_PER_PAGE = 5
+
+# Сколько подсказок показываем при пустом или слабом результате поиска
+SUGGESTIONS_LIMIT = 4
+
+# Сколько треков страницы скачиваем одновременно при массовом скачивании
+BULK_DOWNLOAD_CONCURRENCY = 3
+
+# Дедлайны скачивания (сек): одного трека и всей страницы
+DOWNLOAD_DEADLINE = 120
+BULK_DOWNLOAD_DEADLINE = 300
+
+# Воркеров очереди скачиваний и сколько хранить завершённые задания (сек)
+DOWNLOAD_WORKERS = 4
+JOBS_RETENTION = 24 * 3600
+
+# Похожие треки: сколько показываем и как часто (сек) пересчитываем соседей
+SIMILAR_LIMIT = 10
+SIMILAR_REBUILD_INTERVAL = 3600
+
+# Inline-режим: результатов на страницу и время кэширования ответа на стороне Telegram
+INLINE_PAGE_SIZE = 20
+INLINE_CACHE_TIME = 300
+
+# Источники музыки в порядке приоритета (модули загрузчиков импортируются при первом обращении);
+# качество выбирается так, чтобы файл уложился в лимит отправки Telegram
+sources = SourceRegistry(max_bytes=UPLOAD_LIMIT)
+sources.register('yandex', 'Яндекс.Музыка', '🎶', LazyDownloader('yandex_music_downloader', 'YandexMusicDownloader'),
+                 known_tracks=yandex_catalog.known_tracks)
+sources.register('vk', 'VK Музыка', '🎵', LazyDownloader('vk_music_downloader', 'VKMusicDownloader'))
+
+# Постоянный каталог треков: id трека -> метаданные
+catalog = TrackCatalog(CATALOG_FILE)
+
+# Кэш результатов поиска: нормализованный запрос -> список треков
+search_cache = TTLCache(maxsize=2048, ttl=1800)
+
+# Подсказки запросов по исполнителям и названиям
+suggestions = SuggestionTrie(k=8)
+
+# Отрисованные страницы результатов: (id выборки, страница) -> (текст, клавиатура)
+result_pages = TTLCache(maxsize=4096, ttl=3600)
+
+# Кэш поиска и подсказки попадают в снимок для быстрого старта
+snapshot.register('search_cache', search_cache.dump)
+snapshot.register('suggestions', suggestions.to_state)
+
+# Упреждающая подкачка первых треков выдачи, пока пользователь выбирает
+audio_cache = AudioCache(max_bytes=64 * 1024 * 1024)
+prefetcher = Prefetcher(sources.download, audio_cache)
+
+# Рассылка всем пользователям (продолжается после перезапуска)
+broadcaster = Broadcaster(bot, api, BROADCAST_FILE, STATS_FILE)
+
+# Популярность запросов и треков (фиксированная память, сохраняется между перезапусками)
+popularity = PopularityTracker(POPULARITY_FILE)
+
+# file_id аудио, уже загруженных в Telegram (по id трека): повторная отправка без скачивания
+file_ids = FileIdStore(FILE_IDS_FILE)
+
+# Выполняемые скачивания пользователей: отмена и дедлайны
+jobs = DownloadJobs(deadline=DOWNLOAD_DEADLINE)
+
+# Постоянная очередь заданий на скачивание (переживает перезапуск)
+job_queue = JobQueue(JOBS_FILE)
+
+# Похожие треки по совместным скачиваниям (соседи пересчитываются в фоне)
+similar_tracks = CoDownloads(DOWNLOADS_FILE, k=SIMILAR_LIMIT)
+
+# Обложки альбомов: готовые миниатюры в памяти и на диске
+covers = CoverArt(COVERS_DIR, DEFAULT_COVER_FILE)
+
+# ID3-теги отправляемых файлов (пул процессов, готовые файлы кэшируются по id трека)
+tagger = Tagger()
+
+
+async def search_tracks(query: str) -> list:
+    """Поиск треков с кэшированием по нормализованному запросу"""
+    key = ' '.join(query.lower().split())
+    
+    async def load():
+        tracks = await sources.search(query, limit=SEARCH_LIMIT)
+        # Результаты попадают в каталог - скачивание читает треки оттуда по id
+        # (в подсказки - только после скачивания: выдача может состоять из
+        # треков-заглушек с текстом запроса)
+        await catalog.add(tracks)
+        return tracks
+    
+    return await search_cache.get_or_load(key, load)
+
+
+async def fetch_audio(track: dict) -> Optional[bytes]:
+    """Аудио трека: из подкачки, если она успела, иначе - скачивание из источника"""
+    audio_data = await prefetcher.take(track['id'])
+    if audio_data is None:
+        async with prefetcher.foreground():
+            audio_data = await sources.download(track)
+    return audio_data
+
+
+async def prepare_audio(track: dict) -> Optional[bytes]:
+    """Аудио трека с ID3-тегами: уже тегированное из кэша или скачивание и запись тегов"""
+    audio_data = tagger.cached(track['id'])
+    if audio_data is None:
+        audio_data = await fetch_audio(track)
+        if audio_data:
+            audio_data = await tagger.tag(track, audio_data, await covers.get(track))
+    return audio_data
+
+
+def add_suggestions(track: dict, weight: float = 1.0):
+    """Добавляет исполнителя и название трека в подсказки (треки локальных баз и скачанные)"""
+    suggestions.add(track['artist'], weight)
+    suggestions.add(f"{track['artist']} {track['title']}", weight)
+
+
+async def restore_snapshot() -> bool:
+    """
+    Восстанавливает кэш поиска и подсказки из снимка; подсказки без снимка строятся заново
+    
+    Returns:
+        True, если подсказки восстановлены из снимка
+    """
+    # Чтение и распаковка файла - вне event loop
+    restored = await asyncio.to_thread(snapshot.load, SNAPSHOT_FILE)
+    
+    cached = snapshot.take('search_cache')
+    if cached:
+        search_cache.restore(cached)
+    
+    state = snapshot.take('suggestions')
+    if state:
+        suggestions.load_state(state)
+    else:
+        build_suggestions()
+    
+    logger.info("Снимок: %s частей, %s запросов в кэше, %s подсказок", restored, len(search_cache), len(suggestions))
+    return state is not None
+
+
+def build_suggestions():
+    """Заполняет подсказки треками локальных баз источников"""
+    for track in sources.known_tracks():
+        add_suggestions(track)
+    logger.info("Подсказки: %s строк", len(suggestions))
+
+
+async def warm_up(boost_suggestions: bool = True):
+    """
+    Прогрев кэша поиска, каталога, индекса и аудио по популярности до приёма обновлений
+    
+    Args:
+        boost_suggestions: поднять популярные запросы в подсказках (не нужно,
+            если подсказки восстановлены из снимка - там они уже учтены)
+    """
+    started = time.monotonic()
+    
+    top_queries = popularity.top_queries(WARMUP_QUERIES)
+    for query, count in top_queries:
+        # Популярные запросы поднимаются в подсказках
+        if boost_suggestions:
+            suggestions.add(query, count)
+        try:
+            await search_tracks(query)
+        except Exception as e:
+            logger.error("Ошибка прогрева запроса '%s': %s", query, e)
+    
+    # Аудио популярных треков, которых ещё нет в Telegram, подкачиваем в фоне
+    # (по одному и только когда подкачка не нужна пользователям)
+    track_ids = [track_id for track_id, _ in popularity.top_tracks(WARMUP_TRACKS)
+                 if not file_ids.get(track_id)]
+    prefetcher.warm(await catalog.fetch_many(track_ids))
+    
+    logger.info("Прогрев: %s запросов, %s треков за %.2f сек",
+                len(top_queries), len(track_ids), time.monotonic() - started)
+
+
+def suggestions_keyboard(items: list) -> list:
+    """Ряды кнопок с подсказками (callback_data - индекс в состоянии)"""
+    return [
+        [InlineKeyboardButton(text=f"🔎 {item}", callback_data=f"suggest_{idx}")]
+        for idx, item in enumerate(items)
+    ]
+
+
+def track_caption(track: dict) -> str:
+    """Подпись к аудио"""
+    return (
+        f"🎵 <b>{track['title']}</b>\n"
+        f"👤 <i>{track['artist']}</i>\n"
+        f"⏱ {track['duration']}\n\n"
+        f"📥 Downloaded by @DownloaderSSMusicBot"
+    )
+
+
+async def load_thumbnail(track: dict) -> Optional[BufferedInputFile]:
+    """Обложка альбома трека (или обложка по умолчанию) для аудио"""
+    thumbnail = await covers.get(track)
+    if thumbnail:
+        return BufferedInputFile(thumbnail, filename='thumbnail.jpg')
+    return None
+
 
 def load_stats():
     """Загружает статистику из файла"""
@@ -58,17 +333,21 @@ def load_stats():
                 return json.load(f)
         return {"users": []}
     except Exception as e:
-        logger.error(f"Ошибка загрузки статистики: {e}")
+        logger.error("Ошибка загрузки статистики: %s", e)
         return {"users": []}
 
 
 def save_stats(stats):
     """Сохраняет статистику в файл"""
     try:
-        with open(STATS_FILE, 'w', encoding='utf-8') as f:
+        # Через временный файл: рассылка и выгрузка читают файл потоково
+        # и не должны увидеть его обрезанным на середине записи
+        tmp_path = STATS_FILE + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
             json.dump(stats, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, STATS_FILE)
     except Exception as e:
-        logger.error(f"Ошибка сохранения статистики: {e}")
+        logger.error("Ошибка сохранения статистики: %s", e)
 
 
 def add_user(user_id: int, username: str = None, first_name: str = None):
@@ -118,7 +397,7 @@ async def cmd_start(message: Message):
     
     # Логируем нового пользователя
     if is_new:
-        logger.info(f"Новый пользователь: {user.id} (@{user.username}) - {user.first_name}")
+        logger.info("Новый пользователь: %s (@%s) - %s", user.id, user.username, user.first_name)
     
     await message.answer(
         "🎵 <b>Привет! Я @DownloaderSSMusicBot</b>\n\n"
@@ -133,11 +412,11 @@ async def cmd_start(message: Message):
 @dp.message(Command('stats'))
 async def cmd_stats(message: Message):
     """Обработчик команды /stats - только для админа"""
-    logger.info(f"Запрос статистики от пользователя {message.from_user.id}")
+    logger.info("Запрос статистики от пользователя %s", message.from_user.id)
     
     # Проверяем, является ли пользователь админом
     if message.from_user.id != ADMIN_ID:
-        logger.warning(f"Отказано в доступе к /stats для пользователя {message.from_user.id}")
+        logger.warning("Отказано в доступе к /stats для пользователя %s", message.from_user.id)
         await message.answer("❌ У вас нет доступа к этой команде")
         return
     
@@ -160,7 +439,20 @@ async def cmd_stats(message: Message):
     recent_users = sorted(users, key=lambda x: x.get('joined', ''), reverse=True)[:10]
     
     text = f"📊 <b>Статистика бота</b>\n\n"
-    text += f"👥 <b>Всего пользователей:</b> {total_users}\n\n"
+    text += f"👥 <b>Всего пользователей:</b> {total_users}\n"
+    text += (f"⚡ <b>Подкачка:</b> попаданий {prefetcher.hit_rate():.0%}, "
+             f"впустую {prefetcher.stats['wasted']}, отменено {prefetcher.stats['cancelled']}\n")
+    page_lookups = result_pages.hits + result_pages.misses
+    text += (f"🗂 <b>Страницы результатов:</b> в кэше {len(result_pages)}, "
+             f"попаданий {result_pages.hits / page_lookups if page_lookups else 0:.0%}\n")
+    text += (f"📥 <b>Скачивания:</b> сейчас {sum(map(len, jobs.active.values()))}, "
+             f"готово {jobs.stats['done']}, отменено {jobs.stats['cancelled']}, "
+             f"по дедлайну {jobs.stats['timed_out']}\n")
+    queue_counts = await asyncio.to_thread(job_queue.counts)
+    text += (f"🗂 <b>Очередь:</b> ждут {queue_counts.get('queued', 0)}, "
+             f"повторов {download_workers.stats['retried']}, "
+             f"не выполнено {download_workers.stats['failed']}\n")
+    text += f"🔁 <b>Похожие треки:</b> у {len(similar_tracks)} треков есть соседи\n\n"
     text += f"📋 <b>Последние {min(10, total_users)} пользователей:</b>\n\n"
     
     for idx, user in enumerate(recent_users, 1):
@@ -185,6 +477,87 @@ async def cmd_stats(message: Message):
     await message.answer(text, parse_mode="HTML")
 
 
+@dp.message(Command('broadcast'))
+async def cmd_broadcast(message: Message):
+    """Рассылка сообщения всем пользователям - только для админа (ответом на сообщение)"""
+    if message.from_user.id != ADMIN_ID:
+        logger.warning("Отказано в доступе к /broadcast для пользователя %s", message.from_user.id)
+        await message.answer("❌ У вас нет доступа к этой команде")
+        return
+    
+    if not message.reply_to_message:
+        await message.answer(
+            "📢 <b>Рассылка</b>\n\n"
+            "Ответь командой /broadcast на сообщение, которое нужно разослать",
+            parse_mode="HTML"
+        )
+        return
+    
+    if not broadcaster.start(message.chat.id, message.chat.id, message.reply_to_message.message_id):
+        await message.answer("⏳ Рассылка уже идёт")
+        return
+    
+    logger.info("Админ %s запустил рассылку", message.from_user.id)
+    await message.answer("📢 Рассылка запущена, отчёт придёт по завершении")
+
+
+@dp.message(Command('export'))
+async def cmd_export(message: Message):
+    """
+    Выгрузка пользователей файлом - только для админа
+    
+    /export [csv|jsonl] [joined:ГГГГ-ММ-ДД] [active:ГГГГ-ММ-ДД]
+    """
+    if message.from_user.id != ADMIN_ID:
+        logger.warning("Отказано в доступе к /export для пользователя %s", message.from_user.id)
+        await message.answer("❌ У вас нет доступа к этой команде")
+        return
+    
+    fmt, filters = 'csv', {}
+    for arg in message.text.split()[1:]:
+        key, sep, value = arg.partition(':')
+        if not sep and key.lower() in ('csv', 'jsonl'):
+            fmt = key.lower()
+            continue
+        try:
+            filters[{'joined': 'joined_since', 'active': 'active_since'}[key.lower()]] = \
+                datetime.fromisoformat(value).isoformat()
+        except (KeyError, ValueError):
+            await message.answer(
+                "📤 <b>Выгрузка пользователей</b>\n\n"
+                "/export [csv|jsonl] [joined:ГГГГ-ММ-ДД] [active:ГГГГ-ММ-ДД]",
+                parse_mode="HTML"
+            )
+            return
+    
+    status = await message.answer("⏳ Готовлю выгрузку...")
+    fd, path = tempfile.mkstemp(suffix=f'.{fmt}.gz')
+    os.close(fd)
+    try:
+        # Чтение статистики и сжатие - в отдельном потоке, остальные обработчики не ждут
+        started = time.monotonic()
+        count = await asyncio.to_thread(export_users, STATS_FILE, path, fmt, **filters)
+        size = os.path.getsize(path)
+        logger.info("Выгрузка пользователей: %s записей, %.1f КБ за %.2f сек",
+                    count, size / 1024, time.monotonic() - started)
+        
+        if size > UPLOAD_LIMIT:
+            await status.edit_text(f"❌ Выгрузка ({size / 1024 / 1024:.0f} МБ) больше лимита Telegram, уточни фильтры")
+            return
+        
+        filename = f"users_{datetime.now().strftime('%Y%m%d_%H%M')}.{fmt}.gz"
+        await api.send(message.chat.id, partial(
+            bot.send_document, message.chat.id, FSInputFile(path, filename=filename),
+            caption=f"📤 Пользователей: {count}"
+        ))
+        await status.delete()
+    except Exception as e:
+        logger.error("Ошибка выгрузки пользователей: %s", e, exc_info=True)
+        await status.edit_text("❌ Не удалось выгрузить пользователей")
+    finally:
+        os.remove(path)
+
+
 @dp.message(Command('search'))
 async def cmd_search(message: Message, state: FSMContext):
     """Обработчик команды /search"""
@@ -200,55 +573,56 @@ async def cmd_search(message: Message, state: FSMContext):
 async def cmd_cancel(message: Message, state: FSMContext):
     """Обработчик команды /cancel"""
     current_state = await state.get_state()
-    if current_state is None:
+    cancelled = await cancel_downloads(message.from_user.id)
+    if current_state is None and not cancelled:
         await message.answer("❌ Нечего отменять")
         return
     
     await state.clear()
-    await message.answer("✅ Операция отменена")
+    prefetcher.cancel(message.from_user.id)
+    # Прогресс-сообщение скачивания обновляется при отмене задания
+    if not cancelled:
+        await message.answer("✅ Операция отменена")
 
 
 @dp.message(Command('status'))
 async def cmd_status(message: Message):
-    """Проверка статуса источников музыки"""
-    status_msg = await message.answer("🔍 Проверяю доступность источников...")
+    """Статус источников музыки (по состоянию circuit breaker'ов, без живых запросов)"""
+    state_names = {
+        'closed': '✅ Доступен',
+        'half_open': '🟡 Проверяется',
+        'open': '❌ Недоступен',
+    }
     
-    try:
-        downloader = MusicDownloader()
-        results = await downloader.test_sources()
-        
-        text = "📊 <b>Статус источников музыки:</b>\n\n"
-        
-        sources_info = {
-            'youtube': {'name': 'YouTube', 'emoji': '📺'},
-            'mp3wr': {'name': 'MP3WR', 'emoji': '🎵'},
-            'sefon': {'name': 'Sefon', 'emoji': '🎶'}
-        }
-        
-        for source, available in results.items():
-            info = sources_info.get(source, {'name': source, 'emoji': '❓'})
-            status = "✅ Доступен" if available else "❌ Недоступен"
-            text += f"{info['emoji']} <b>{info['name']}:</b> {status}\n"
-        
-        # Добавляем информацию о прокси
-        proxy = os.getenv('PROXY')
-        if proxy:
-            text += f"\n🔒 <b>Прокси:</b> Настроен"
-        else:
-            text += f"\n🔒 <b>Прокси:</b> Не настроен"
-            if not results.get('youtube', False):
-                text += f"\n💡 <i>Для работы с YouTube в России нужен прокси</i>"
-        
-        await status_msg.edit_text(text, parse_mode="HTML")
+    text = "📊 <b>Статус источников музыки:</b>\n\n"
+    
+    for info in sources.status():
+        text += f"{info['emoji']} <b>{info['title']}:</b> {state_names.get(info['state'], info['state'])}\n"
         
-    except Exception as e:
-        logger.error(f"Ошибка проверки статуса: {e}")
-        await status_msg.edit_text("❌ Ошибка при проверке статуса источников")
+        details = [f"ошибок {info['error_rate']:.0%}"]
+        if info['latency'] is not None:
+            details.append(f"отклик {info['latency'] * 1000:.0f} мс")
+        if info['last_check']:
+            details.append(f"проверка {datetime.fromtimestamp(info['last_check']).strftime('%H:%M:%S')}")
+        text += f"   <i>{', '.join(details)}</i>\n"
+    
+    if startup.ready is not None:
+        text += f"\n🚀 <b>Запуск:</b> {startup.ready:.1f} сек"
+        if startup.first_reply is not None:
+            text += f", первый ответ через {startup.first_reply:.1f} сек"
+        text += "\n"
+    
+    await message.answer(text, parse_mode="HTML")
+
 
+def result_set_id(track_ids: list, hints: list) -> str:
+    """Id выборки: одинаковые результаты поиска дают одинаковый id и общие отрисованные страницы"""
+    raw = '\n'.join(track_ids) + '\0' + '\n'.join(hints)
+    return hashlib.blake2b(raw.encode('utf-8'), digest_size=8).hexdigest()
 
-async def show_tracks_page(message: Message, tracks: list, page: int, state: FSMContext):
-    """Показывает страницу с треками"""
-    TRACKS_PER_PAGE = 5
+
+def render_tracks_page(tracks: list, page: int, result_set: str, hints: Optional[list] = None) -> tuple:
+    """Текст и клавиатура страницы результатов (hints - подсказки для слабого результата)"""
     total_pages = (len(tracks) + TRACKS_PER_PAGE - 1) // TRACKS_PER_PAGE
     
     # Вычисляем индексы треков для текущей страницы
@@ -276,16 +650,16 @@ async def show_tracks_page(message: Message, tracks: list, page: int, state: FSM
         
         keyboard.append([InlineKeyboardButton(
             text=button_text,
-            callback_data=f"download_{global_idx}"
+            callback_data=f"download_{result_set}_{global_idx}"
         )])
     
-    # Кнопки навигации
+    # Кнопки навигации (с id выборки: кнопки старых результатов не листают новые)
     nav_buttons = []
     
     if page > 0:
         nav_buttons.append(InlineKeyboardButton(
             text="⬅️ Назад",
-            callback_data=f"page_{page - 1}"
+            callback_data=f"page_{result_set}_{page - 1}"
         ))
     
     nav_buttons.append(InlineKeyboardButton(
@@ -296,12 +670,23 @@ async def show_tracks_page(message: Message, tracks: list, page: int, state: FSM
     if page < total_pages - 1:
         nav_buttons.append(InlineKeyboardButton(
             text="Вперёд ➡️",
-            callback_data=f"page_{page + 1}"
+            callback_data=f"page_{result_set}_{page + 1}"
         ))
     
     if nav_buttons:
         keyboard.append(nav_buttons)
     
+    # Подсказки, если результат слабый
+    if hints:
+        keyboard.extend(suggestions_keyboard(hints))
+    
+    # Скачать всю страницу одним действием
+    if len(page_tracks) > 1:
+        keyboard.append([InlineKeyboardButton(
+            text="⬇️ Скачать всю страницу",
+            callback_data=f"bulk_{result_set}_{page}"
+        )])
+    
     # Кнопка отмены
     keyboard.append([InlineKeyboardButton(
         text="❌ Отмена",
@@ -318,11 +703,36 @@ async def show_tracks_page(message: Message, tracks: list, page: int, state: FSM
         f"⏬ Выбери трек для скачивания:"
     )
     
-    await message.edit_text(
+    return text, markup
+
+
+async def get_tracks_page(result_set: str, page: int, track_ids: list, hints: Optional[list] = None,
+                          tracks: Optional[list] = None) -> Optional[tuple]:
+    """
+    Отрисованная страница из кэша; при промахе треки читаются из каталога
+    (или берутся из tracks) и страница отрисовывается один раз
+    """
+    key = (result_set, page)
+    rendered = result_pages.get(key)
+    if rendered is None:
+        if tracks is None:
+            tracks = await catalog.fetch_many(track_ids)
+        if not tracks or page * TRACKS_PER_PAGE >= len(tracks):
+            return None
+        rendered = render_tracks_page(tracks, page, result_set, hints)
+        result_pages.set(key, rendered)
+    return rendered
+
+
+async def show_tracks_page(message: Message, rendered: tuple):
+    """Показывает отрисованную страницу с треками"""
+    text, markup = rendered
+    await api.send(message.chat.id, partial(
+        message.edit_text,
         text,
         reply_markup=markup,
         parse_mode="HTML"
-    )
+    ))
 
 
 @dp.message(MusicStates.waiting_for_query)
@@ -336,50 +746,115 @@ async def search_music(message: Message, state: FSMContext):
         return
     
     # Отправляем сообщение о начале поиска
-    search_msg = await message.answer("🔍 Ищу музыку в Яндекс.Музыке...")
+    search_msg = await api.send(message.chat.id, partial(
+        message.answer, "🔍 Ищу музыку в Яндекс.Музыке..."
+    ))
+    
+    await run_search(search_msg, query, message.from_user.id, state)
+
+
+async def run_search(search_msg: Message, query: str, user_id: int, state: FSMContext):
+    """Выполняет поиск и показывает результаты в сообщении search_msg"""
+    chat_id = search_msg.chat.id
     
     try:
-        logger.info(f"Поиск музыки: '{query}' от пользователя {message.from_user.id}")
+        logger.info("Поиск музыки: '%s' от пользователя %s", query, user_id, extra={'sample': 'search'})
+        popularity.record_query(query)
+        
+        # Поиск треков в Яндекс.Музыке (повторные запросы отдаются из кэша)
+        tracks = (await search_tracks(query))[:CHAT_RESULTS_LIMIT]
         
-        # Поиск треков в Яндекс.Музыке (увеличим лимит до 20)
-        downloader = YandexMusicDownloader()
-        tracks = await downloader.search(query, limit=20)
+        logger.info("Найдено %s треков для запроса: '%s'", len(tracks), query, extra={'sample': 'search'})
         
-        logger.info(f"Найдено {len(tracks)} треков для запроса: '{query}'")
+        # Подсказки вместо ручных повторных поисков, если результатов мало
+        hints = []
+        if len(tracks) < TRACKS_PER_PAGE:
+            hints = suggestions.suggest(query, limit=SUGGESTIONS_LIMIT)
         
         if not tracks:
-            logger.warning(f"Треки не найдены для запроса: '{query}'")
-            await search_msg.edit_text(
-                "❌ Ничего не найдено\n\n"
-                "Попробуй изменить запрос или используй /search для нового поиска"
-            )
+            logger.warning("Треки не найдены для запроса: '%s'", query)
             await state.clear()
+            
+            if hints:
+                await state.update_data(suggestions=hints)
+                await api.send(chat_id, partial(
+                    search_msg.edit_text,
+                    "❌ Ничего не найдено\n\n"
+                    "💡 Попробуй:",
+                    reply_markup=InlineKeyboardMarkup(inline_keyboard=suggestions_keyboard(hints))
+                ))
+            else:
+                await api.send(chat_id, partial(
+                    search_msg.edit_text,
+                    "❌ Ничего не найдено\n\n"
+                    "Попробуй изменить запрос или используй /search для нового поиска"
+                ))
             return
         
-        # Сохраняем треки и показываем первую страницу
-        await state.update_data(tracks=tracks, page=0)
+        # Сохраняем выборку и показываем первую страницу
+        track_ids = [track['id'] for track in tracks]
+        result_set = result_set_id(track_ids, hints)
+        # Какая страница показана в каком сообщении (message_id -> номер страницы)
+        await state.update_data(track_ids=track_ids, result_set=result_set,
+                                pages={search_msg.message_id: 0}, suggestions=hints)
         await state.set_state(MusicStates.choosing_track)
         
-        # Показываем первую страницу
-        await show_tracks_page(search_msg, tracks, 0, state)
+        # Показываем первую страницу (одинаковые поиски берут её из кэша отрисовки)
+        await show_tracks_page(search_msg, await get_tracks_page(result_set, 0, track_ids, hints, tracks))
+        
+        # Пока пользователь выбирает, подкачиваем самые вероятные треки
+        # (новый поиск отменяет подкачку по предыдущему)
+        prefetcher.schedule(user_id, [track for track in tracks if not file_ids.get(track['id'])])
         
     except Exception as e:
-        logger.error(f"Ошибка при поиске: {e}")
-        await search_msg.edit_text(
+        logger.error("Ошибка при поиске: %s", e)
+        await api.send(chat_id, partial(
+            search_msg.edit_text,
             "❌ Произошла ошибка при поиске\n\n"
             "Попробуй еще раз позже"
-        )
+        ))
         await state.clear()
 
 
+@dp.callback_query(F.data.startswith("suggest_"))
+async def callback_suggest(callback: CallbackQuery, state: FSMContext):
+    """Поиск по выбранной подсказке"""
+    data = await state.get_data()
+    hints = data.get('suggestions') or []
+    idx = int(callback.data.split("_")[1])
+    
+    if idx >= len(hints):
+        await callback.answer("❌ Подсказка устарела", show_alert=True)
+        return
+    
+    await callback.answer()
+    query = hints[idx]
+    
+    await api.send(callback.message.chat.id, partial(
+        callback.message.edit_text, f"🔍 Ищу: {query}..."
+    ), PRIORITY_LOW)
+    await run_search(callback.message, query, callback.from_user.id, state)
+
+
 @dp.callback_query(F.data == "cancel")
 async def callback_cancel(callback: CallbackQuery, state: FSMContext):
-    """Обработчик отмены выбора"""
-    await callback.message.edit_text("✅ Поиск отменен")
+    """Обработчик отмены выбора трека (скачивания не трогает)"""
     await state.clear()
+    prefetcher.cancel(callback.from_user.id)
+    await callback.message.edit_text("✅ Поиск отменен")
     await callback.answer()
 
 
+@dp.callback_query(F.data == "dlcancel")
+async def callback_cancel_download(callback: CallbackQuery):
+    """Отмена скачивания, к сообщению прогресса которого относится кнопка"""
+    # Прогресс-сообщение обновляется при отмене задания
+    if await cancel_download(callback.from_user.id, callback.message.chat.id, callback.message.message_id):
+        await callback.answer("⏹ Отменяю скачивание")
+    else:
+        await callback.answer("Скачивание уже завершено")
+
+
 @dp.callback_query(F.data.startswith("page_"))
 async def callback_page(callback: CallbackQuery, state: FSMContext):
     """Обработчик навигации по страницам"""
@@ -387,154 +862,563 @@ async def callback_page(callback: CallbackQuery, state: FSMContext):
         await callback.answer("ℹ️ Используй кнопки для навигации", show_alert=False)
         return
     
-    # Получаем номер страницы
-    page = int(callback.data.split("_")[1])
-    
-    # Получаем треки из состояния
+    # Получаем id выборки и номер страницы (у кнопок старого формата их нет)
+    parts = callback.data.split("_")
     data = await state.get_data()
-    tracks = data.get('tracks', [])
+    if len(parts) != 3 or data.get('result_set') != parts[1]:
+        await callback.answer("❌ Результаты устарели, выполни новый поиск", show_alert=True)
+        return
+    result_set, page = parts[1], int(parts[2])
     
-    if not tracks:
+    # Страница уже показана в этом сообщении (повторное нажатие) - не редактируем его
+    pages = data.get('pages', {})
+    message_id = callback.message.message_id
+    if pages.get(message_id) == page:
+        await callback.answer()
+        return
+    
+    rendered = await get_tracks_page(result_set, page, data.get('track_ids', []), data.get('suggestions'))
+    if rendered is None:
         await callback.answer("❌ Треки не найдены", show_alert=True)
         return
     
-    # Обновляем страницу в состоянии
-    await state.update_data(page=page)
+    # Обновляем страницу этого сообщения в состоянии
+    await state.update_data(pages={**pages, message_id: page})
     
     # Показываем новую страницу
-    await show_tracks_page(callback.message, tracks, page, state)
+    await show_tracks_page(callback.message, rendered)
     await callback.answer()
 
 
-@dp.callback_query(F.data.startswith("download_"))
-async def callback_download(callback: CallbackQuery, state: FSMContext):
-    """Обработчик скачивания выбранного трека"""
-    await callback.answer("⏳ Скачиваю...")
+def progress_text(track: dict, bar: str, stage: str) -> str:
+    """Текст сообщения с прогрессом скачивания"""
+    return (
+        f"{bar}\n"
+        f"{stage}\n\n"
+        f"🎵 {track['title']}\n"
+        f"⏱ {track['duration']}"
+    )
+
+
+def cancel_keyboard() -> InlineKeyboardMarkup:
+    """Кнопка отмены под сообщением с прогрессом (отменяет только это скачивание)"""
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="❌ Отмена", callback_data="dlcancel")
+    ]])
+
+
+def similar_keyboard(track: dict) -> Optional[InlineKeyboardMarkup]:
+    """Кнопка "Похожие" под аудио, если для трека уже посчитаны соседи"""
+    if not similar_tracks.similar(track['id'], 1):
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="🔁 Похожие треки", callback_data=f"similar_{track['id']}")
+    ]])
+
+
+async def edit_progress(chat_id: int, message_id: int, text: str, priority: int = PRIORITY_HIGH, **kwargs):
+    """Редактирует сообщение с прогрессом по id (задание может выполняться уже после перезапуска)"""
+    await api.send(chat_id, partial(
+        bot.edit_message_text, text, chat_id=chat_id, message_id=message_id, **kwargs
+    ), priority)
+
+
+async def deliver_track(chat_id: int, message_id: int, track: dict):
+    """
+    Скачивает трек и отправляет его в чат (выполняется как задача из jobs)
     
-    try:
-        # Получаем индекс трека
-        track_idx = int(callback.data.split("_")[1])
-        
-        # Получаем список треков из состояния
-        data = await state.get_data()
-        tracks = data.get('tracks', [])
-        
-        if track_idx >= len(tracks):
-            await callback.message.edit_text("❌ Трек не найден")
-            await state.clear()
-            return
-        
-        track = tracks[track_idx]
-        
-        logger.info(f"Начало скачивания трека: '{track['title']}' ({track['url']}) для пользователя {callback.from_user.id}")
-        
-        # Прогресс бар при скачивании
-        progress_msg = await callback.message.edit_text(
-            f"⬜⬜⬜⬜⬜⬜⬜⬜⬜⬜ 0%\n"
-            f"📥 <b>Подготовка...</b>\n\n"
-            f"🎵 {track['title']}\n"
-            f"⏱ {track['duration']}",
-            parse_mode="HTML"
-        )
-        
+    Raises:
+        DownloadFailed: источник не вернул аудио
+    """
+    # Прогресс бар при скачивании (косметика - под нагрузкой может быть пропущен)
+    await edit_progress(
+        chat_id, message_id,
+        progress_text(track, "⬜⬜⬜⬜⬜⬜⬜⬜⬜⬜ 0%", "📥 <b>Подготовка...</b>"),
+        PRIORITY_LOW, parse_mode="HTML", reply_markup=cancel_keyboard()
+    )
+    
+    # Трек уже загружался в Telegram - отправляем по file_id без скачивания
+    audio = file_ids.get(track['id'])
+    thumbnail = None
+    
+    if audio is None:
         # Обновляем прогресс - 25%
         await asyncio.sleep(0.3)
-        await progress_msg.edit_text(
-            f"🟦🟦⬜⬜⬜⬜⬜⬜⬜⬜ 25%\n"
-            f"📥 <b>Скачивание...</b>\n\n"
-            f"🎵 {track['title']}\n"
-            f"⏱ {track['duration']}",
-            parse_mode="HTML"
+        await edit_progress(
+            chat_id, message_id,
+            progress_text(track, "🟦🟦⬜⬜⬜⬜⬜⬜⬜⬜ 25%", "📥 <b>Скачивание...</b>"),
+            PRIORITY_LOW, parse_mode="HTML", reply_markup=cancel_keyboard()
         )
         
-        # Скачиваем трек из Яндекс.Музыки
-        downloader = YandexMusicDownloader()
-        audio_data = await downloader.download_track(track['url'])
+        # Скачиваем трек (или забираем уже подкачанный) и записываем теги
+        audio_data = await prepare_audio(track)
         
         if not audio_data:
-            logger.error(f"Не удалось скачать трек: '{track['title']}' ({track['url']})")
-            await callback.message.edit_text(
-                "❌ Не удалось скачать трек\n\n"
-                "Возможно, ссылка устарела. Попробуй выполнить новый поиск."
-            )
-            await state.clear()
-            return
+            raise DownloadFailed(f"не удалось скачать трек '{track['title']}' ({track['id']})")
         
         file_size_mb = len(audio_data) / 1024 / 1024
-        logger.info(f"Трек скачан успешно: '{track['title']}', размер: {file_size_mb:.2f} МБ")
+        logger.info("Трек скачан успешно: '%s', размер: %.2f МБ", track['title'], file_size_mb)
+        
+        # Оценка по длительности могла ошибиться - не тратим время на заведомо неудачную выгрузку
+        if len(audio_data) > UPLOAD_LIMIT:
+            raise TrackTooLarge(len(audio_data))
         
         # Обновляем прогресс - 75%
-        await progress_msg.edit_text(
-            f"🟦🟦🟦🟦🟦🟦🟦⬜⬜⬜ 75%\n"
-            f"📤 <b>Отправка...</b>\n\n"
-            f"🎵 {track['title']}\n"
-            f"⏱ {track['duration']}",
-            parse_mode="HTML"
+        await edit_progress(
+            chat_id, message_id,
+            progress_text(track, "🟦🟦🟦🟦🟦🟦🟦⬜⬜⬜ 75%", "📤 <b>Отправка...</b>"),
+            PRIORITY_LOW, parse_mode="HTML", reply_markup=cancel_keyboard()
         )
         
         # Отправляем аудио файл
-        audio_file = BufferedInputFile(
+        audio = BufferedInputFile(
             file=audio_data,
             filename=f"{track['artist']} - {track['title']}.mp3"
         )
         
-        # Форматируем название трека красиво
-        # Добавляем эмодзи и форматирование
-        formatted_title = f"♫ {track['title']}"
-        
-        # Добавляем название бота к исполнителю с красивым форматированием
-        performer_with_bot = f"{track['artist']} ✦ @DownloaderSSMusicBot"
-        
-        # Загружаем обложку
-        thumbnail_path = os.path.join(os.path.dirname(__file__), 'thumbnail.jpg')
-        if os.path.exists(thumbnail_path):
-            with open(thumbnail_path, 'rb') as thumb_file:
-                thumbnail = BufferedInputFile(thumb_file.read(), filename='thumbnail.jpg')
-        else:
-            thumbnail = None
-        
-        await callback.message.answer_audio(
-            audio=audio_file,
-            title=formatted_title,
-            performer=performer_with_bot,
-            thumbnail=thumbnail,
-            caption=f"🎵 <b>{track['title']}</b>\n"
-                   f"👤 <i>{track['artist']}</i>\n"
-                   f"⏱ {track['duration']}\n\n"
-                   f"📥 Downloaded by @DownloaderSSMusicBot",
+        # Обложка альбома - из кэша обложек
+        thumbnail = await load_thumbnail(track)
+    else:
+        logger.info("Трек '%s' отправляется по сохранённому file_id", track['title'])
+    
+    # Форматируем название трека красиво
+    # Добавляем эмодзи и форматирование
+    formatted_title = f"♫ {track['title']}"
+    
+    # Добавляем название бота к исполнителю с красивым форматированием
+    performer_with_bot = f"{track['artist']} ✦ @DownloaderSSMusicBot"
+    
+    # Итоговый результат - высокий приоритет, retry_after выжидается автоматически
+    sent = await api.send(chat_id, partial(
+        bot.send_audio,
+        chat_id,
+        audio=audio,
+        title=formatted_title,
+        performer=performer_with_bot,
+        thumbnail=thumbnail,
+        caption=track_caption(track),
+        parse_mode="HTML",
+        reply_markup=similar_keyboard(track)
+    ))
+    
+    # Запоминаем file_id для повторных отправок и inline-режима
+    if sent and sent.audio:
+        file_ids.set(track['id'], sent.audio.file_id)
+    popularity.record_track(track['id'])
+    # Скачанный трек - в подсказки; вес растёт с каждым скачиванием
+    add_suggestions(track)
+
+
+async def run_track_job(job: dict):
+    """Задание 'track': скачивание и отправка одного трека"""
+    chat_id, message_id = job['chat_id'], job['message_id']
+    track = await catalog.fetch(job['payload']['track_id'])
+    
+    if track is None:
+        await edit_progress(chat_id, message_id, "❌ Трек не найден")
+        return
+    
+    logger.info("Начало скачивания трека: '%s' (%s) для пользователя %s (задание %s, попытка %s)",
+                track['title'], track['id'], job['user_id'], job['id'], job['attempts'])
+    
+    try:
+        # Скачивание и отправка - отдельной задачей: её прерывают отмена и дедлайн
+        await jobs.run(job['user_id'], deliver_track(chat_id, message_id, track), DOWNLOAD_DEADLINE,
+                       since=job['claimed_at'], key=(chat_id, message_id))
+    
+    except JobCancelled:
+        logger.info("Скачивание '%s' отменено пользователем %s", track['title'], job['user_id'])
+        await edit_progress(chat_id, message_id, "✅ Скачивание отменено")
+        return
+    
+    except JobTimeout:
+        await edit_progress(
+            chat_id, message_id,
+            "⏱ <b>Скачивание заняло слишком много времени</b>\n\n"
+            "Попробуй ещё раз позже или выбери другой трек",
             parse_mode="HTML"
         )
-        
-        # Удаляем сообщение с прогресс баром
-        await progress_msg.delete()
-        
-        logger.info(f"Трек успешно отправлен пользователю {callback.from_user.id}: '{track['title']}'")
-        
-        await state.clear()
-        
+        return
+    
     except Exception as e:
-        logger.error(f"Ошибка при скачивании/отправке трека: {e}", exc_info=True)
-        
-        # Проверяем, не слишком ли большой файл
+        # Слишком большой файл - повтор тут не поможет; остальные ошибки - повтор задания
+        # (TrackTooLarge - трек отклонён по оценке размера ещё до скачивания)
         error_msg = str(e)
-        if "Request Entity Too Large" in error_msg or "too large" in error_msg.lower():
-            logger.warning(f"Файл слишком большой для Telegram: '{track['title']}'")
-            await callback.message.edit_text(
-                "❌ <b>Файл слишком большой!</b>\n\n"
-                "📦 Размер файла превышает лимит Telegram (50 МБ)\n\n"
-                "💡 <b>Попробуй:</b>\n"
-                "• Выбрать другую версию трека\n"
-                "• Найти короткую версию песни",
+        if (not isinstance(e, TrackTooLarge) and "Request Entity Too Large" not in error_msg
+                and "too large" not in error_msg.lower()):
+            raise
+        logger.warning("Файл слишком большой для Telegram: '%s' (%s)", track['title'], error_msg)
+        await edit_progress(
+            chat_id, message_id,
+            "❌ <b>Файл слишком большой!</b>\n\n"
+            "📦 Размер файла превышает лимит Telegram (50 МБ)\n\n"
+            "💡 <b>Попробуй:</b>\n"
+            "• Выбрать другую версию трека\n"
+            "• Найти короткую версию песни",
+            parse_mode="HTML"
+        )
+        return
+    
+    # Удаляем сообщение с прогресс баром
+    await api.send(chat_id, partial(bot.delete_message, chat_id, message_id), PRIORITY_LOW)
+    await similar_tracks.record(job['user_id'], [track['id']])
+    
+    logger.info("Трек успешно отправлен пользователю %s: '%s'", job['user_id'], track['title'])
+
+
+async def send_audio_group(chat_id: int, items: list) -> list:
+    """
+    Отправляет готовые треки одной медиагруппой (или одним аудио)
+    
+    Args:
+        chat_id: чат получателя
+        items: список пар (трек, file_id или байты аудио)
+        
+    Returns:
+        Список треков, которые не удалось отправить
+    """
+    media = []
+    for track, payload in items:
+        if isinstance(payload, bytes):
+            payload = BufferedInputFile(payload, filename=f"{track['artist']} - {track['title']}.mp3")
+        media.append(InputMediaAudio(
+            media=payload,
+            title=f"♫ {track['title']}",
+            performer=f"{track['artist']} ✦ @DownloaderSSMusicBot",
+            caption=track_caption(track),
+            parse_mode="HTML"
+        ))
+    
+    try:
+        if len(media) == 1:
+            item = media[0]
+            sent = [await api.send(chat_id, partial(
+                bot.send_audio,
+                chat_id,
+                audio=item.media,
+                title=item.title,
+                performer=item.performer,
+                caption=item.caption,
                 parse_mode="HTML"
-            )
+            ))]
         else:
-            await callback.message.edit_text(
-                "❌ <b>Произошла ошибка</b>\n\n"
-                "Попробуй выбрать другой трек\n"
-                "или выполни новый поиск",
+            sent = await api.send(chat_id, partial(bot.send_media_group, chat_id, media=media))
+    except Exception as e:
+        logger.error("Ошибка отправки медиагруппы: %s", e, exc_info=True)
+        return [track for track, _ in items]
+    
+    for (track, _), message in zip(items, sent or []):
+        if message and message.audio:
+            file_ids.set(track['id'], message.audio.file_id)
+        popularity.record_track(track['id'])
+        add_suggestions(track)
+    return []
+
+
+async def deliver_page(chat_id: int, page_tracks: list, failed: list):
+    """
+    Параллельно скачивает треки страницы и отправляет их медиагруппами
+    (выполняется как задача из jobs); неудачные треки добавляются в failed
+    """
+    semaphore = asyncio.Semaphore(BULK_DOWNLOAD_CONCURRENCY)
+    
+    async def fetch(track: dict):
+        """Возвращает (трек, file_id или байты аудио или None)"""
+        file_id = file_ids.get(track['id'])
+        if file_id:
+            return track, file_id
+        try:
+            async with semaphore:
+                audio = await prepare_audio(track)
+        except Exception as e:
+            logger.error("Ошибка скачивания трека '%s': %s", track['title'], e)
+            return track, None
+        # Как и в deliver_track: файл больше лимита не кладём в медиагруппу -
+        # его выгрузка заведомо не удастся и провалит всю группу
+        if audio and len(audio) > UPLOAD_LIMIT:
+            logger.warning("Трек '%s' не отправлен: %s", track['title'], TrackTooLarge(len(audio)))
+            return track, None
+        return track, audio
+    
+    async def flush(items: list):
+        failed.extend(await send_audio_group(chat_id, items))
+    
+    # Ссылки на скачивание всей страницы - заранее, до начала скачиваний
+    # (VK - пачкой, Яндекс - по треку)
+    await sources.resolve([track for track in page_tracks
+                           if not file_ids.get(track['id']) and track['id'] not in tagger.cache
+                           and track['id'] not in audio_cache])
+    
+    batch = []
+    upload_task = None
+    fetches = [asyncio.create_task(fetch(track)) for track in page_tracks]
+    try:
+        # Пока одна медиагруппа отправляется, остальные треки докачиваются;
+        # всё, что успело скачаться за время отправки, уходит следующей группой
+        for next_done in asyncio.as_completed(fetches):
+            track, payload = await next_done
+            if not payload:
+                failed.append(track)
+                continue
+            
+            batch.append((track, payload))
+            if upload_task is None or upload_task.done():
+                if upload_task is not None:
+                    await upload_task
+                upload_task = asyncio.create_task(flush(batch))
+                batch = []
+        
+        if upload_task is not None:
+            await upload_task
+        if batch:
+            await flush(batch)
+    finally:
+        # При отмене или дедлайне прерываем и незавершённые скачивания, и отправку
+        for task in fetches + [upload_task]:
+            if task is not None and not task.done():
+                task.cancel()
+
+
+async def run_page_job(job: dict):
+    """Задание 'page': скачивание всех треков страницы"""
+    chat_id, message_id = job['chat_id'], job['message_id']
+    page = job['payload']['page']
+    page_tracks = await catalog.fetch_many(job['payload']['track_ids'])
+    
+    if not page_tracks:
+        await edit_progress(chat_id, message_id, "❌ Треки не найдены")
+        return
+    
+    logger.info("Скачивание страницы %s (%s треков) для пользователя %s (задание %s, попытка %s)",
+                page + 1, len(page_tracks), job['user_id'], job['id'], job['attempts'])
+    
+    await edit_progress(
+        chat_id, message_id,
+        f"📥 <b>Скачиваю {len(page_tracks)} треков...</b>\n\n"
+        f"Готовые треки придут по мере загрузки",
+        PRIORITY_LOW, parse_mode="HTML", reply_markup=cancel_keyboard()
+    )
+    
+    failed = []
+    try:
+        await jobs.run(job['user_id'], deliver_page(chat_id, page_tracks, failed), BULK_DOWNLOAD_DEADLINE,
+                       since=job['claimed_at'], key=(chat_id, message_id))
+    except JobCancelled:
+        logger.info("Скачивание страницы отменено пользователем %s", job['user_id'])
+        await edit_progress(chat_id, message_id, "✅ Скачивание отменено")
+        return
+    except JobTimeout:
+        failed = [track for track in page_tracks if not file_ids.get(track['id'])]
+    
+    delivered = len(page_tracks) - len(failed)
+    failed_ids = {track['id'] for track in failed}
+    if delivered:
+        await similar_tracks.record(job['user_id'], [track['id'] for track in page_tracks
+                                                     if track['id'] not in failed_ids])
+    text = f"✅ <b>Отправлено {delivered} из {len(page_tracks)} треков</b>"
+    if failed:
+        text += "\n\n❌ <b>Не удалось скачать:</b>\n"
+        text += "\n".join(f"• {track['artist']} - {track['title']}" for track in failed)
+    
+    logger.info("Страница %s: отправлено %s из %s треков пользователю %s",
+                page + 1, delivered, len(page_tracks), job['user_id'])
+    
+    await edit_progress(chat_id, message_id, text, parse_mode="HTML")
+
+
+async def process_job(job: dict):
+    """Выполняет задание из очереди скачиваний"""
+    if job['kind'] == 'track':
+        await run_track_job(job)
+    elif job['kind'] == 'page':
+        await run_page_job(job)
+    else:
+        logger.error("Неизвестный тип задания %s: %s", job['id'], job['kind'])
+
+
+async def on_job_failed(job: dict, error: Exception):
+    """Все попытки задания исчерпаны - сообщаем пользователю"""
+    if isinstance(error, DownloadFailed):
+        text = (
+            "❌ Не удалось скачать трек\n\n"
+            "Возможно, ссылка устарела. Попробуй выполнить новый поиск."
+        )
+    else:
+        text = (
+            "❌ <b>Произошла ошибка</b>\n\n"
+            "Попробуй выбрать другой трек\n"
+            "или выполни новый поиск"
+        )
+    await edit_progress(job['chat_id'], job['message_id'], text, parse_mode="HTML")
+
+
+# Воркеры очереди скачиваний: обработчики только ставят задания, работа идёт здесь
+download_workers = JobWorkers(job_queue, process_job, on_job_failed, workers=DOWNLOAD_WORKERS)
+
+
+async def cancel_downloads(user_id: int) -> bool:
+    """Отменяет выполняемые и ожидающие скачивания пользователя; True, если было что отменять"""
+    # Сначала очередь, затем выполняемые: задание, забранное из очереди до её отмены,
+    # либо уже зарегистрировано в jobs, либо увидит отметку отмены в jobs.run
+    queued = await job_queue.cancel(user_id)
+    claimed = await asyncio.to_thread(job_queue.running, user_id)
+    running = jobs.cancel(user_id)
+    # Выполняемые задания сами обновят своё сообщение, ожидающие - обновляем здесь
+    for job in queued:
+        await edit_progress(job['chat_id'], job['message_id'], "✅ Скачивание отменено")
+    return bool(running or claimed or queued)
+
+
+async def cancel_download(user_id: int, chat_id: int, message_id: int) -> bool:
+    """Отменяет одно скачивание - по сообщению с его прогрессом; True, если было что отменять"""
+    # Тот же порядок, что и в cancel_downloads
+    queued = await job_queue.cancel_message(user_id, chat_id, message_id)
+    claimed = await asyncio.to_thread(job_queue.running_message, user_id, chat_id, message_id)
+    running = jobs.cancel_job(user_id, (chat_id, message_id))
+    for job in queued:
+        await edit_progress(job['chat_id'], job['message_id'], "✅ Скачивание отменено")
+    return bool(running or claimed or queued)
+
+
+@dp.callback_query(F.data.startswith("download_"))
+async def callback_download(callback: CallbackQuery, state: FSMContext):
+    """Обработчик скачивания выбранного трека: ставит задание в очередь"""
+    # Получаем id выборки, индекс трека и id трека из состояния
+    parts = callback.data.split("_")
+    data = await state.get_data()
+    if len(parts) != 3 or data.get('result_set') != parts[1]:
+        # Кнопка старой выдачи: индекс относится к другим результатам
+        await callback.answer("❌ Результаты устарели, выполни новый поиск", show_alert=True)
+        return
+    track_idx = int(parts[2])
+    await callback.answer("⏳ Скачиваю...")
+    
+    chat_id = callback.message.chat.id
+    track_ids = data.get('track_ids', [])
+    await state.clear()
+    
+    if track_idx >= len(track_ids):
+        await api.send(chat_id, partial(callback.message.edit_text, "❌ Трек не найден"))
+        return
+    
+    await api.send(chat_id, partial(
+        callback.message.edit_text, "⏳ <b>В очереди на скачивание...</b>",
+        parse_mode="HTML", reply_markup=cancel_keyboard()
+    ), PRIORITY_LOW)
+    await download_workers.submit(
+        'track', callback.from_user.id, chat_id, callback.message.message_id,
+        {'track_id': track_ids[track_idx]}
+    )
+
+
+@dp.callback_query(F.data.startswith("bulk_"))
+async def callback_download_page(callback: CallbackQuery, state: FSMContext):
+    """Скачивание всех треков страницы: ставит задание в очередь"""
+    parts = callback.data.split("_")
+    data = await state.get_data()
+    if len(parts) != 3 or data.get('result_set') != parts[1]:
+        await callback.answer("❌ Результаты устарели, выполни новый поиск", show_alert=True)
+        return
+    page = int(parts[2])
+    await callback.answer("⏳ Скачиваю страницу...")
+    
+    chat_id = callback.message.chat.id
+    track_ids = data.get('track_ids', [])[page * TRACKS_PER_PAGE:(page + 1) * TRACKS_PER_PAGE]
+    await state.clear()
+    
+    if not track_ids:
+        await api.send(chat_id, partial(callback.message.edit_text, "❌ Треки не найдены"))
+        return
+    
+    await api.send(chat_id, partial(
+        callback.message.edit_text, "⏳ <b>В очереди на скачивание...</b>",
+        parse_mode="HTML", reply_markup=cancel_keyboard()
+    ), PRIORITY_LOW)
+    await download_workers.submit(
+        'page', callback.from_user.id, chat_id, callback.message.message_id,
+        {'page': page, 'track_ids': track_ids}
+    )
+
+
+@dp.callback_query(F.data.startswith("similar_"))
+async def callback_similar(callback: CallbackQuery, state: FSMContext):
+    """Похожие треки: выборка из заранее посчитанных соседей, без поиска"""
+    track_id = callback.data[len("similar_"):]
+    tracks = await catalog.fetch_many(similar_tracks.similar(track_id, SIMILAR_LIMIT))
+    
+    if not tracks:
+        await callback.answer("🤷 Похожих треков пока нет", show_alert=True)
+        return
+    await callback.answer()
+    
+    # Дальше - как обычная выдача: страницы, скачивание, подкачка
+    track_ids = [track['id'] for track in tracks]
+    result_set = result_set_id(track_ids, [])
+    await state.update_data(track_ids=track_ids, result_set=result_set, pages={}, suggestions=[])
+    await state.set_state(MusicStates.choosing_track)
+    
+    text, markup = await get_tracks_page(result_set, 0, track_ids, [], tracks)
+    sent = await api.send(callback.message.chat.id, partial(
+        callback.message.answer, text, reply_markup=markup, parse_mode="HTML"
+    ))
+    if sent is not None:
+        await state.update_data(pages={sent.message_id: 0})
+    prefetcher.schedule(callback.from_user.id, [track for track in tracks if not file_ids.get(track['id'])])
+
+
+@dp.inline_query()
+async def inline_search(inline_query: InlineQuery):
+    """Inline-режим: @DownloaderSSMusicBot запрос в любом чате"""
+    query = inline_query.query.strip()
+    
+    if not query:
+        await inline_query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=False)
+        return
+    
+    try:
+        offset = int(inline_query.offset or 0)
+    except ValueError:
+        offset = 0
+    
+    tracks = await search_tracks(query)
+    page_tracks = tracks[offset:offset + INLINE_PAGE_SIZE]
+    
+    results = []
+    for track in page_tracks:
+        file_id = file_ids.get(track['id'])
+        
+        if file_id:
+            # Трек уже есть в Telegram - отдаём аудио сразу
+            results.append(InlineQueryResultCachedAudio(
+                id=track['id'],
+                audio_file_id=file_id,
+                caption=track_caption(track),
                 parse_mode="HTML"
-            )
-        await state.clear()
+            ))
+        else:
+            results.append(InlineQueryResultArticle(
+                id=track['id'],
+                title=track['title'],
+                description=f"{track['artist']} • {track['duration']}",
+                input_message_content=InputTextMessageContent(
+                    message_text=f"🎵 <b>{track['title']}</b>\n"
+                                 f"👤 <i>{track['artist']}</i>\n\n"
+                                 f"📥 Скачать: @DownloaderSSMusicBot",
+                    parse_mode="HTML"
+                ),
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(
+                    text="🎵 Скачать в боте",
+                    url="https://t.me/DownloaderSSMusicBot"
+                )]])
+            ))
+    
+    next_offset = offset + INLINE_PAGE_SIZE
+    await inline_query.answer(
+        results,
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=False,
+        next_offset=str(next_offset) if next_offset < len(tracks) else ""
+    )
 
 
 # HTTP endpoint для пинга (чтобы бот не засыпал на хостинге)
@@ -549,8 +1433,19 @@ async def keep_alive():
         try:
             await asyncio.sleep(300)  # Каждые 5 минут
             logger.info("Keep-alive ping")
+            logger.info("Подкачка: %s, попаданий %.0f%%", prefetcher.stats, prefetcher.hit_rate() * 100)
+            
+            # Сбрасываем накопленные file_id на диск
+            await file_ids.save_async()
+            await popularity.save_async()
+            
+            # Удаляем давно завершённые задания очереди скачиваний
+            await asyncio.to_thread(job_queue.purge, JOBS_RETENTION)
+            
+            # Снимок на случай остановки без штатного завершения
+            await snapshot.save_async(SNAPSHOT_FILE)
         except Exception as e:
-            logger.error(f"Keep-alive error: {e}")
+            logger.error("Keep-alive error: %s", e)
 
 
 async def start_web_server():
@@ -565,7 +1460,7 @@ async def start_web_server():
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', port)
     await site.start()
-    logger.info(f"🌐 HTTP сервер запущен на порту {port}")
+    logger.info("🌐 HTTP сервер запущен на порту %s", port)
     return runner
 
 
@@ -575,14 +1470,58 @@ async def main():
     
     web_runner = None
     keep_alive_task = None
+    probe_task = None
+    similar_task = None
     
     try:
+        # Открываем каталог и восстанавливаем file_id отправленных ранее треков
+        with startup.phase('хранилища'):
+            catalog.connect()
+            file_ids.load()
+            popularity.load()
+            
+            # Очередь скачиваний: задания, прерванные перезапуском, выполняются заново
+            resumed = job_queue.connect()
+            if resumed:
+                logger.info("Возобновлено %s незавершённых заданий на скачивание", resumed)
+            
+            similar_tracks.connect()
+            covers.load()
+        
+        # Кэш поиска и подсказки - из снимка, без пересборки
+        with startup.phase('снимок'):
+            suggestions_restored = await restore_snapshot()
+        
+        # Прогреваем кэши до начала приёма обновлений (не дольше WARMUP_TIMEOUT)
+        with startup.phase('прогрев'):
+            try:
+                await asyncio.wait_for(warm_up(not suggestions_restored), timeout=WARMUP_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("Прогрев не уложился в %s сек", WARMUP_TIMEOUT)
+        
         # Запускаем HTTP сервер для пингов
-        web_runner = await start_web_server()
+        with startup.phase('веб-сервер'):
+            web_runner = await start_web_server()
         
         # Запускаем keep-alive в фоне
         keep_alive_task = asyncio.create_task(keep_alive())
         
+        # Фоновая проверка источников для восстановления отключённых
+        probe_task = asyncio.create_task(sources.run_probes())
+        
+        # Пересчёт похожих треков по истории скачиваний
+        similar_task = asyncio.create_task(similar_tracks.run(SIMILAR_REBUILD_INTERVAL))
+        
+        # Продолжаем рассылку, прерванную перезапуском
+        broadcaster.resume()
+        
+        # Воркеры очереди скачиваний
+        download_workers.start()
+        
+        # Время до первого ответа после запуска
+        dp.update.outer_middleware(startup.first_update)
+        startup.mark_ready()
+        
         logger.info("✅ Бот готов к работе!")
         
         # Запускаем polling с обработкой таймаутов
@@ -590,30 +1529,52 @@ async def main():
             try:
                 await dp.start_polling(bot)
             except Exception as e:
-                logger.error(f"Ошибка polling: {e}")
+                logger.error("Ошибка polling: %s", e)
                 logger.info("Перезапуск через 3 секунды...")
                 await asyncio.sleep(3)
         
     except KeyboardInterrupt:
         logger.info("👋 Получен сигнал остановки")
     except Exception as e:
-        logger.error(f"❌ Критическая ошибка: {e}", exc_info=True)
+        logger.error("❌ Критическая ошибка: %s", e, exc_info=True)
     finally:
         logger.info("🛑 Завершение работы бота...")
         
-        # Отменяем keep-alive задачу
-        if keep_alive_task:
-            keep_alive_task.cancel()
-            try:
-                await keep_alive_task
-            except asyncio.CancelledError:
-                pass
+        # Останавливаем рассылку с сохранением прогресса
+        await broadcaster.stop()
+        
+        # Останавливаем воркеры: прерванные задания выполнятся после перезапуска
+        await download_workers.stop()
+        await jobs.shutdown()
+        tagger.shutdown()
+        
+        # Отменяем фоновые задачи
+        for task in (keep_alive_task, probe_task, similar_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        
+        # Сохраняем file_id и популярность, закрываем каталог, очередь и историю скачиваний
+        file_ids.save()
+        popularity.save()
+        catalog.close()
+        job_queue.close()
+        similar_tracks.close()
+        
+        # Снимок индексов и кэшей для быстрого следующего старта
+        try:
+            snapshot.save(SNAPSHOT_FILE)
+        except Exception as e:
+            logger.error("Ошибка сохранения снимка: %s", e)
         
         # Закрываем сессии
         try:
-            # Закрываем Яндекс.Музыка сессию если есть
-            yandex_downloader = YandexMusicDownloader()
-            await yandex_downloader.close()
+            # Закрываем сессии источников и общий пул соединений
+            await sources.close()
+            await close_session()
         except:
             pass
             
@@ -634,3 +1595,6 @@ if __name__ == '__main__':
         asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("👋 Бот остановлен")
+    finally:
+        # Дописываем оставшиеся в очереди записи
+        log_listener.stop()
@@ -0,0 +1,253 @@
+"""
+Рассылка всем пользователям - ограничение скорости, обработка блокировок и продолжение после перезапуска
+"""
+import asyncio
+import json
+import logging
+import os
+import shutil
+import time
+from functools import partial
+from typing import Dict, Iterator, List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+from rate_limit import BotApiScheduler, PRIORITY_BULK, PRIORITY_HIGH, TokenBucket
+from user_store import iter_users
+
+logger = logging.getLogger(__name__)
+
+
+class Broadcaster:
+    """
+    Рассылка сообщения всем пользователям из users_stats.json.
+
+    Получатели читаются потоково из копии файла, снятой при запуске рассылки
+    (users_path тем временем перезаписывается, а offset должен указывать на
+    тех же получателей и после перезапуска). Отправка идёт пулом воркеров через
+    общий BotApiScheduler с приоритетом PRIORITY_BULK (не выедает запас для
+    интерактивных ответов) и собственным лимитом скорости. Прогресс
+    периодически сохраняется в файл: после перезапуска рассылка продолжается
+    с первого необработанного получателя.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        api: BotApiScheduler,
+        state_path: str,
+        users_path: str,
+        workers: int = 8,
+        rate: float = 20.0,
+        checkpoint_interval: float = 5.0,
+    ):
+        self.bot = bot
+        self.api = api
+        self.state_path = state_path
+        self.users_path = users_path
+        self.workers = workers
+        self.rate = rate
+        self.checkpoint_interval = checkpoint_interval
+        # Список получателей текущей рассылки
+        self.recipients_path = state_path + '.users'
+
+        self.state: Optional[Dict] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def _load_state(self) -> Optional[Dict]:
+        try:
+            if os.path.exists(self.state_path):
+                with open(self.state_path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error("Ошибка загрузки состояния рассылки: %s", e)
+        return None
+
+    def _save_state(self, state: Dict):
+        try:
+            tmp_path = self.state_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False)
+            os.replace(tmp_path, self.state_path)
+        except Exception as e:
+            logger.error("Ошибка сохранения состояния рассылки: %s", e)
+
+    def start(self, admin_chat_id: int, from_chat_id: int, message_id: int) -> bool:
+        """Запускает новую рассылку копии сообщения; False, если рассылка уже идёт"""
+        if self.running:
+            return False
+        self.state = {
+            'admin_chat_id': admin_chat_id,
+            'from_chat_id': from_chat_id,
+            'message_id': message_id,
+            'started': time.time(),
+            'elapsed': 0.0,
+            'offset': 0,
+            'sent': 0,
+            'blocked': 0,
+            'failed': 0,
+            'status': 'running',
+        }
+        # Снимок получателей прошлой рассылки не нужен - _run снимет новый
+        try:
+            os.remove(self.recipients_path)
+        except OSError:
+            pass
+        self._save_state(self.state)
+        self.task = asyncio.create_task(self._run())
+        return True
+
+    def resume(self) -> bool:
+        """Продолжает незавершённую рассылку после перезапуска"""
+        state = self._load_state()
+        if not state or state.get('status') != 'running' or self.running:
+            return False
+        self.state = state
+        logger.info("Продолжаем рассылку с получателя #%s", state['offset'])
+        self.task = asyncio.create_task(self._run())
+        return True
+
+    async def stop(self):
+        """Останавливает рассылку, сохранив прогресс (при завершении работы бота)"""
+        if self.running:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def _snapshot_recipients(self):
+        """Копирует файл пользователей (один раз за рассылку)"""
+        if os.path.exists(self.recipients_path):
+            return
+        tmp_path = self.recipients_path + '.tmp'
+        shutil.copyfile(self.users_path, tmp_path)
+        os.replace(tmp_path, self.recipients_path)
+
+    def _recipients(self, offset: int) -> Iterator[int]:
+        for index, user in enumerate(iter_users(self.recipients_path)):
+            if index >= offset:
+                yield user['user_id']
+
+    async def _run(self):
+        state = self.state
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.workers * 4)
+        bucket = TokenBucket(self.rate, self.rate)
+        # Обработанные получатели за границей offset (их не шлём повторно после перезапуска)
+        done: set = set(state.get('ahead', []))
+        started = time.monotonic()
+        last_checkpoint = started
+        base_elapsed = state['elapsed']
+
+        def checkpoint():
+            # offset - граница, до которой обработаны все получатели подряд
+            while state['offset'] in done:
+                done.discard(state['offset'])
+                state['offset'] += 1
+            state['ahead'] = sorted(done)
+            state['elapsed'] = base_elapsed + time.monotonic() - started
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                index, user_id = item
+                # Flood wait на любом получателе останавливает всех воркеров до его окончания
+                while True:
+                    pause = self.api.bulk_pause_left()
+                    if pause <= 0:
+                        break
+                    await asyncio.sleep(pause)
+                while True:
+                    wait = bucket.wait_time(time.monotonic())
+                    if wait <= 0:
+                        bucket.consume(time.monotonic())
+                        break
+                    await asyncio.sleep(wait)
+                try:
+                    await self.api.send(user_id, partial(
+                        self.bot.copy_message,
+                        chat_id=user_id,
+                        from_chat_id=state['from_chat_id'],
+                        message_id=state['message_id'],
+                    ), PRIORITY_BULK)
+                    state['sent'] += 1
+                except TelegramForbiddenError:
+                    state['blocked'] += 1
+                except TelegramBadRequest as e:
+                    # Удалённый аккаунт, недоступный чат и т.п.
+                    logger.debug("Рассылка: пользователь %s недоступен: %s", user_id, e)
+                    state['blocked'] += 1
+                except Exception as e:
+                    logger.warning("Рассылка: ошибка отправки пользователю %s: %s", user_id, e)
+                    state['failed'] += 1
+                done.add(index)
+
+        workers: List[asyncio.Task] = [asyncio.create_task(worker()) for _ in range(self.workers)]
+        try:
+            if os.path.exists(self.users_path):
+                await asyncio.to_thread(self._snapshot_recipients)
+            recipients = self._recipients(state['offset'])
+            index = state['offset']
+            while True:
+                # Чтение файла - в отдельном потоке, пачками
+                batch = await asyncio.to_thread(lambda: [uid for _, uid in zip(range(500), recipients)])
+                if not batch:
+                    break
+                for user_id in batch:
+                    if index not in done:
+                        await queue.put((index, user_id))
+                    index += 1
+                    if time.monotonic() - last_checkpoint >= self.checkpoint_interval:
+                        checkpoint()
+                        last_checkpoint = time.monotonic()
+                        await asyncio.to_thread(self._save_state, dict(state))
+
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+
+            checkpoint()
+            state['status'] = 'done'
+            await asyncio.to_thread(self._save_state, dict(state))
+            try:
+                os.remove(self.recipients_path)
+            except OSError:
+                pass
+        except BaseException as e:
+            # Остановка бота или ошибка чтения получателей (обрезанный файл):
+            # прогресс сохраняется, рассылка продолжится после перезапуска
+            for task in workers:
+                task.cancel()
+            checkpoint()
+            self._save_state(dict(state))
+            if not isinstance(e, asyncio.CancelledError):
+                logger.error("Рассылка прервана: %s", e, exc_info=True)
+            raise
+
+        await self._report()
+
+    async def _report(self):
+        state = self.state
+        processed = state['sent'] + state['blocked'] + state['failed']
+        elapsed = max(state['elapsed'], 0.001)
+        text = (
+            "📢 <b>Рассылка завершена</b>\n\n"
+            f"✅ Доставлено: {state['sent']}\n"
+            f"🚫 Заблокировали бота: {state['blocked']}\n"
+            f"❌ Ошибки: {state['failed']}\n"
+            f"⏱ Время: {elapsed:.0f} сек ({processed / elapsed:.1f} сообщ./сек)"
+        )
+        logger.info("Рассылка завершена: %s", state)
+        try:
+            await self.api.send(state['admin_chat_id'], partial(
+                self.bot.send_message, state['admin_chat_id'], text, parse_mode="HTML"
+            ), PRIORITY_HIGH)
+        except Exception as e:
+            logger.error("Не удалось отправить отчёт о рассылке: %s", e)
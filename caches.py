@@ -0,0 +1,138 @@
+"""
+Кэши бота - результаты поиска и file_id уже загруженных в Telegram треков
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """LRU-кэш с ограничением по размеру и времени жизни записей"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._pending: Dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires, value = item
+        if expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def dump(self) -> list:
+        """Живые записи для снимка: [(ключ, оставшееся время жизни, значение)] от старых к новым"""
+        now = time.monotonic()
+        return [(key, expires - now, value) for key, (expires, value) in self._data.items() if expires > now]
+
+    def restore(self, items: list):
+        now = time.monotonic()
+        for key, left, value in items:
+            self._data[key] = (now + left, value)
+            self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Возвращает значение из кэша или загружает его.
+        Одновременные промахи по одному ключу выполняют loader только один раз.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            value = await loader()
+            if value:
+                self.set(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            # Исключение уже отдано ожидающим; не даём asyncio ругаться на него
+            future.exception()
+            raise
+        finally:
+            del self._pending[key]
+
+
+class FileIdStore:
+    """Хранилище file_id отправленных аудио: ключ трека -> file_id в Telegram"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._data: Dict[str, str] = {}
+        self._dirty = False
+
+    def __len__(self):
+        return len(self._data)
+
+    def load(self):
+        """Загружает file_id из файла"""
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self._data = json.load(f)
+                logger.info("Загружено %s file_id", len(self._data))
+        except Exception as e:
+            logger.error("Ошибка загрузки file_id: %s", e)
+
+    def save(self):
+        """Сохраняет file_id в файл, если были изменения"""
+        if not self._dirty:
+            return
+        try:
+            snapshot = dict(self._data)
+            self._dirty = False
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            self._dirty = True
+            logger.error("Ошибка сохранения file_id: %s", e)
+
+    async def save_async(self):
+        """Сохраняет file_id в фоновом потоке"""
+        await asyncio.to_thread(self.save)
+
+    def get(self, key: str) -> Optional[str]:
+        return self._data.get(key)
+
+    def set(self, key: str, file_id: str):
+        if self._data.get(key) != file_id:
+            self._data[key] = file_id
+            self._dirty = True
@@ -0,0 +1,110 @@
+"""
+Circuit breaker для источников музыки - отключение сбоящих источников и восстановление
+"""
+import logging
+import time
+from collections import deque
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker по доле ошибок в скользящем окне последних вызовов.
+
+    closed    - вызовы идут как обычно
+    open      - источник считается недоступным, вызовы сразу отклоняются
+    half_open - после паузы пропускается один пробный вызов
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(
+        self,
+        name: str,
+        window: int = 20,
+        min_calls: int = 5,
+        failure_threshold: float = 0.5,
+        open_timeout: float = 30.0,
+    ):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_threshold = failure_threshold
+        self.open_timeout = open_timeout
+
+        self.state = self.CLOSED
+        self.results = deque(maxlen=window)  # True - успех, False - ошибка
+        self.latency_ewma: Optional[float] = None
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.last_error: Optional[str] = None
+        self.last_check: Optional[float] = None  # time.time() последнего вызова или пробы
+
+    @property
+    def error_rate(self) -> float:
+        if not self.results:
+            return 0.0
+        return self.results.count(False) / len(self.results)
+
+    def allow(self) -> bool:
+        """Можно ли сейчас обращаться к источнику"""
+        if self.state == self.CLOSED:
+            return True
+
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.open_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self.trial_in_flight = False
+
+        # half_open: пропускаем только один пробный вызов
+        if self.trial_in_flight:
+            return False
+        self.trial_in_flight = True
+        return True
+
+    def record_success(self, latency: float):
+        self.last_check = time.time()
+        self.results.append(True)
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma = 0.8 * self.latency_ewma + 0.2 * latency
+
+        if self.state != self.CLOSED:
+            logger.info("Источник %s снова доступен", self.name)
+            self.state = self.CLOSED
+            self.results.clear()
+        self.trial_in_flight = False
+
+    def record_failure(self, error: BaseException):
+        self.last_check = time.time()
+        self.last_error = f"{type(error).__name__}: {error}"
+        self.results.append(False)
+        self.trial_in_flight = False
+
+        if self.state == self.HALF_OPEN:
+            self._open()
+        elif (self.state == self.CLOSED
+              and len(self.results) >= self.min_calls
+              and self.error_rate >= self.failure_threshold):
+            self._open()
+
+    def _open(self):
+        if self.state != self.OPEN:
+            logger.warning("Источник %s отключён: %s", self.name, self.last_error)
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+
+    def snapshot(self) -> dict:
+        """Текущее состояние для /status"""
+        return {
+            'state': self.state,
+            'error_rate': self.error_rate,
+            'latency': self.latency_ewma,
+            'last_error': self.last_error,
+            'last_check': self.last_check,
+        }
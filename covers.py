@@ -0,0 +1,154 @@
+"""
+Обложки треков - одна загрузка на альбом, готовые миниатюры в памяти и на диске
+"""
+import asyncio
+import hashlib
+import logging
+import os
+from io import BytesIO
+from typing import Dict, Optional
+
+import http_pool
+from caches import TTLCache
+from track_catalog import canonical
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow не обязателен: без него берём готовый размер у источника
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Ограничения Telegram для миниатюры аудио: JPEG, не больше 320x320 и 200 КБ
+THUMBNAIL_SIZE = 320
+THUMBNAIL_MAX_BYTES = 200 * 1024
+
+# Размер, который запрашиваем у Яндекс.Музыки (ближайший готовый, не больше 320)
+YANDEX_COVER_SIZE = '300x300'
+
+
+def cover_url(track: Dict[str, str]) -> Optional[str]:
+    """Ссылка на обложку альбома трека; None, если источник её не дал"""
+    cover = track.get('cover')
+    if not cover:
+        return None
+    # Яндекс отдаёт шаблон без схемы: avatars.yandex.net/get-music-content/.../%%
+    cover = cover.replace('%%', YANDEX_COVER_SIZE)
+    if '://' not in cover:
+        cover = 'https://' + cover
+    return cover
+
+
+def make_thumbnail(data: bytes) -> Optional[bytes]:
+    """Приводит картинку к ограничениям миниатюры Telegram; None, если это не удалось"""
+    if Image is None:
+        # Без Pillow годится только уже подходящий JPEG
+        if data[:3] == b'\xff\xd8\xff' and len(data) <= THUMBNAIL_MAX_BYTES:
+            return data
+        return None
+    try:
+        image = Image.open(BytesIO(data))
+        image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        output = BytesIO()
+        image.convert('RGB').save(output, 'JPEG', quality=85, optimize=True)
+    except Exception as e:
+        logger.warning("Не удалось подготовить обложку: %s", e)
+        return None
+    thumbnail = output.getvalue()
+    return thumbnail if len(thumbnail) <= THUMBNAIL_MAX_BYTES else None
+
+
+class CoverArt:
+    """
+    Обложки по альбомам.
+
+    Обложка альбома скачивается и уменьшается один раз, дальше отдаётся из
+    памяти (LRU) или с диска (не больше disk_items файлов, старые удаляются).
+    Файловые операции и обработка картинки выполняются вне event loop.
+    Если обложки нет или она не загрузилась - отдаётся обложка по умолчанию,
+    которая читается с диска один раз при запуске.
+    """
+
+    def __init__(self, cache_dir: str, default_path: Optional[str] = None,
+                 memory_items: int = 256, disk_items: int = 5000, ttl: float = 24 * 3600):
+        self.cache_dir = cache_dir
+        self.default_path = default_path
+        self.disk_items = disk_items
+        self.default: Optional[bytes] = None
+        self.memory = TTLCache(maxsize=memory_items, ttl=ttl)
+        self.stats = {'downloaded': 0, 'disk': 0, 'failed': 0}
+        # Альбомы без обложки (ошибка загрузки) - не пытаемся снова до истечения ttl
+        self._missing = TTLCache(maxsize=memory_items * 4, ttl=ttl)
+
+    def load(self):
+        """Создаёт каталог кэша и читает обложку по умолчанию (при запуске)"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if self.default_path and os.path.exists(self.default_path):
+            with open(self.default_path, 'rb') as f:
+                self.default = f.read()
+
+    @staticmethod
+    def album_key(track: Dict[str, str]) -> str:
+        """Ключ обложки: у всех треков альбома он общий"""
+        raw = '\x1f'.join((track.get('source') or '', canonical(track.get('artist')), canonical(track.get('album'))))
+        return hashlib.blake2b(raw.encode('utf-8'), digest_size=10).hexdigest()
+
+    async def get(self, track: Dict[str, str]) -> Optional[bytes]:
+        """Миниатюра обложки трека (или обложка по умолчанию)"""
+        url = cover_url(track)
+        if not url:
+            return self.default
+        key = self.album_key(track)
+        if self._missing.get(key):
+            return self.default
+        try:
+            thumbnail = await self.memory.get_or_load(key, lambda: self._load(key, url))
+        except Exception as e:
+            logger.warning("Ошибка загрузки обложки '%s': %s", track.get('album'), e)
+            thumbnail = None
+        if not thumbnail:
+            self.stats['failed'] += 1
+            self._missing.set(key, True)
+            return self.default
+        return thumbnail
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.jpg")
+
+    def _read(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, key: str, thumbnail: bytes):
+        path = self._path(key)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(thumbnail)
+        os.replace(tmp_path, path)
+
+        # Ограничиваем дисковый кэш: удаляем самые старые обложки
+        names = os.listdir(self.cache_dir)
+        if len(names) > self.disk_items:
+            paths = [os.path.join(self.cache_dir, name) for name in names]
+            paths.sort(key=os.path.getmtime)
+            for old_path in paths[:len(paths) - self.disk_items]:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+
+    async def _load(self, key: str, url: str) -> Optional[bytes]:
+        thumbnail = await asyncio.to_thread(self._read, key)
+        if thumbnail:
+            self.stats['disk'] += 1
+            return thumbnail
+
+        data = await http_pool.request('GET', url, retries=2, parse='bytes')
+        thumbnail = await asyncio.to_thread(make_thumbnail, data)
+        if thumbnail:
+            self.stats['downloaded'] += 1
+            await asyncio.to_thread(self._write, key, thumbnail)
+        return thumbnail
@@ -0,0 +1,337 @@
+"""
+Локальный стенд API Яндекс.Музыки и VK - для проверки клиентов без токенов и сети
+
+Запуск самопроверки:
+    python fake_music_api.py [--latency 0.05]
+"""
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+from typing import Dict, List
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+ARTISTS = ['FACE', 'Lil Peep', 'Billie Eilish', 'Imagine Dragons', 'The Weeknd', 'Drake', 'Eminem', 'Morgenshtern']
+TRACKS_COUNT = 1000
+AUDIO_SIZE = 512 * 1024
+SIGN_SALT = 'XGRlBW9FXlekgbPrRHuSiA'
+
+
+def fake_tracks(count: int = TRACKS_COUNT) -> List[Dict]:
+    """Детерминированный набор треков стенда"""
+    return [
+        {
+            'id': i,
+            'album': 10000 + i // 10,
+            'title': f'Track {i}',
+            'artist': ARTISTS[i % len(ARTISTS)],
+            'duration': 120 + i % 180,
+        }
+        for i in range(1, count + 1)
+    ]
+
+
+def fake_audio(track_id: int, size: int = AUDIO_SIZE) -> bytes:
+    """Псевдо-аудио трека: MP3-заголовок и повторяющийся блок, зависящий от id"""
+    block = hashlib.sha256(str(track_id).encode()).digest() * 128
+    body = (block * (size // len(block) + 1))[:size - 4]
+    return b'\xff\xfb\x90\x00' + body
+
+
+class FakeMusicAPI:
+    """
+    aiohttp-приложение с методами, которые используют YandexMusicAPI и VKMusicAPI.
+
+    latency - искусственная задержка каждого ответа (имитация сети);
+    ranges - поддержка HTTP Range при отдаче аудио;
+    drops - сколько ответов с аудио оборвать на середине;
+    requests - счётчик запросов по маршрутам.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        tracks_count: int = TRACKS_COUNT,
+        audio_size: int = AUDIO_SIZE,
+        ranges: bool = True,
+        drops: int = 0,
+    ):
+        self.latency = latency
+        self.audio_size = audio_size
+        self.ranges = ranges
+        self.drops = drops
+        self.tracks = {track['id']: track for track in fake_tracks(tracks_count)}
+        self.requests: Dict[str, int] = {}
+
+        self.app = web.Application(middlewares=[self._middleware])
+        self.app.add_routes([
+            # Яндекс.Музыка
+            web.get('/search', self.yandex_search),
+            web.get('/tracks/{track_id}/download-info', self.yandex_download_info),
+            web.get('/download-info/{track_id}', self.yandex_download_xml),
+            web.get('/get-mp3/{sign}/{ts}/{path:.+}', self.yandex_mp3),
+            # VK
+            web.post('/method/audio.search', self.vk_search),
+            web.post('/method/audio.getById', self.vk_get_by_id),
+            web.get('/vk-audio/{audio_id}.mp3', self.vk_mp3),
+        ])
+        self.runner = None
+        self.base_url = None
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        self.requests[route] = self.requests.get(route, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return await handler(request)
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """Запускает стенд; возвращает базовый URL"""
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    def _match(self, query: str, count: int) -> List[Dict]:
+        query = query.lower()
+        return [t for t in self.tracks.values() if query in t['artist'].lower() or query in t['title'].lower()][:count]
+
+    # --- Яндекс.Музыка ---
+
+    def _yandex_track(self, track: Dict) -> Dict:
+        return {
+            'id': track['id'],
+            'title': track['title'],
+            'artists': [{'name': track['artist']}],
+            'albums': [{'id': track['album'], 'title': f"Album {track['album']}"}],
+            'durationMs': track['duration'] * 1000,
+        }
+
+    async def yandex_search(self, request):
+        found = self._match(request.query.get('text', ''), 50)
+        return web.json_response({'result': {'tracks': {'results': [self._yandex_track(t) for t in found]}}})
+
+    async def yandex_download_info(self, request):
+        track_id = request.match_info['track_id'].split(':')[0]
+        return web.json_response({'result': [
+            {'codec': 'mp3', 'bitrateInKbps': bitrate,
+             'downloadInfoUrl': f"{self.base_url}/download-info/{track_id}?bitrate={bitrate}"}
+            for bitrate in (128, 192, 320)
+        ]})
+
+    async def yandex_download_xml(self, request):
+        track_id = request.match_info['track_id']
+        xml = (
+            '<?xml version="1.0" encoding="utf-8"?><download-info>'
+            f'<host>{request.host}</host><path>/{track_id}.mp3</path>'
+            f'<ts>{int(time.time()):x}</ts><s>fake{track_id}</s></download-info>'
+        )
+        return web.Response(text=xml, content_type='text/xml')
+
+    async def yandex_mp3(self, request):
+        path = '/' + request.match_info['path']
+        track_id = path[1:].split('.')[0]
+        sign = hashlib.md5((SIGN_SALT + path[1:] + f'fake{track_id}').encode('utf-8')).hexdigest()
+        if sign != request.match_info['sign']:
+            raise web.HTTPForbidden(text='bad sign')
+        return await self.audio_response(request, fake_audio(int(track_id), self.audio_size))
+
+    # --- VK ---
+
+    def _vk_audio(self, track: Dict) -> Dict:
+        return {
+            'id': track['id'],
+            'owner_id': -track['album'],
+            'artist': track['artist'],
+            'title': track['title'],
+            'duration': track['duration'],
+            'url': f"{self.base_url}/vk-audio/{-track['album']}_{track['id']}.mp3",
+        }
+
+    async def vk_search(self, request):
+        form = await request.post()
+        if not form.get('access_token'):
+            return web.json_response({'error': {'error_code': 5, 'error_msg': 'User authorization failed'}})
+        found = self._match(form.get('q', ''), int(form.get('count', 10)))
+        return web.json_response({'response': {'count': len(found), 'items': [self._vk_audio(t) for t in found]}})
+
+    async def vk_get_by_id(self, request):
+        form = await request.post()
+        ids = [int(i.split('_')[1]) for i in form.get('audios', '').split(',') if '_' in i]
+        return web.json_response({'response': [self._vk_audio(self.tracks[i]) for i in ids if i in self.tracks]})
+
+    async def vk_mp3(self, request):
+        track_id = int(request.match_info['audio_id'].split('_')[1])
+        return await self.audio_response(request, fake_audio(track_id, self.audio_size))
+
+    async def audio_response(self, request, data: bytes) -> web.StreamResponse:
+        """
+        Отдаёт файл с поддержкой Range (если включено ranges); пока drops > 0,
+        каждый ответ обрывается на середине - для проверки докачки
+        """
+        headers = {'ETag': f'"{hashlib.md5(data).hexdigest()}"'}
+        status = 200
+        range_header = request.headers.get('Range')
+        if self.ranges:
+            headers['Accept-Ranges'] = 'bytes'
+            match = re.match(r'bytes=(\d+)-(\d*)$', range_header or '')
+            if match:
+                start = int(match.group(1))
+                end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+                if start > end:
+                    raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f'bytes */{len(data)}'})
+                headers['Content-Range'] = f'bytes {start}-{end}/{len(data)}'
+                data = data[start:end + 1]
+                status = 206
+
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_type = 'audio/mpeg'
+        response.content_length = len(data)
+        await response.prepare(request)
+        try:
+            if self.drops > 0 and len(data) > 1:
+                self.drops -= 1
+                await response.write(data[:len(data) // 2])
+                request.transport.close()
+                return response
+            await response.write(data)
+            await response.write_eof()
+        except ConnectionResetError:
+            # Клиент закрыл соединение сам (например, после пробного запроса)
+            pass
+        return response
+
+
+async def self_check(latency: float):
+    """Поднимает стенд и прогоняет по нему клиенты: поиск, пакетные метаданные, ссылки, скачивание"""
+    import http_pool
+    from vk_music_downloader import VKMusicAPI
+    from yandex_music_downloader import YandexMusicAPI
+
+    server = FakeMusicAPI(latency=latency)
+    base_url = await server.start()
+    try:
+        yandex = YandexMusicAPI('fake-token', base_url)
+        vk = VKMusicAPI('fake-token', base_url + '/method')
+
+        found = await yandex.search_tracks('face', count=5)
+        assert found and all(t['artist'] == 'FACE' for t in found), found
+        found = await vk.search_audio('lil peep', count=5)
+        assert found and all(t['artist'] == 'Lil Peep' for t in found), found
+
+        ids = [f"{i}:{10000 + i // 10}" for i in range(1, 251)]
+        started = time.perf_counter()
+        urls = await yandex.get_download_urls(ids[:32])
+        elapsed = time.perf_counter() - started
+        assert all(urls.values())
+        print(f"Ссылки на 32 трека: {elapsed * 1000:.0f} мс")
+
+        audio = await http_pool.request('GET', urls[ids[0]], parse='bytes')
+        assert audio == fake_audio(1)
+
+        vk_ids = [f"{-(10000 + i // 10)}_{i}" for i in range(1, 251)]
+        audios = await vk.get_audio_by_id(vk_ids)
+        assert list(audios) == vk_ids
+        audio = await http_pool.request('GET', audios[vk_ids[1]]['url'], parse='bytes')
+        assert audio == fake_audio(2)
+        print(f"VK audio.getById 250 записей, вызовов: {server.requests.get('/method/audio.getById')}")
+    finally:
+        await http_pool.close_session()
+        await server.stop()
+
+    await check_segmented(latency)
+    print("Самопроверка пройдена")
+
+
+async def check_segmented(latency: float):
+    """Скачивание диапазонами: обрывы с докачкой, докачка после остановки, сервер без Range"""
+    import http_pool
+    from segmented_download import SegmentedDownloader
+
+    size = 16 * 1024 * 1024
+    expected = fake_audio(7, size)
+    downloader = SegmentedDownloader(segments=4, min_size=4 * 1024 * 1024, download_dir=tempfile.mkdtemp())
+
+    for ranges in (True, False):
+        server = FakeMusicAPI(latency=latency, audio_size=size, ranges=ranges, drops=3)
+        base_url = await server.start()
+        url = f"{base_url}/vk-audio/-1_7.mp3"
+        try:
+            started = time.perf_counter()
+            data = await downloader.fetch_bytes(url)
+            elapsed = time.perf_counter() - started
+            assert data == expected
+            print(f"{'Диапазонами' if ranges else 'Одним потоком'}, 3 обрыва: {elapsed * 1000:.0f} мс, "
+                  f"запросов: {server.requests.get('/vk-audio/{audio_id}.mp3')}")
+
+            if ranges:
+                # Прерываем скачивание и продолжаем тем же путём - докачиваются только недостающие байты
+                path = os.path.join(tempfile.mkdtemp(), 'track.mp3')
+                task = asyncio.create_task(downloader.fetch(url, path))
+                await asyncio.sleep(0.05)
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                await downloader.fetch(url, path)
+                with open(path, 'rb') as f:
+                    assert f.read() == expected
+                assert not os.path.exists(path + '.parts')
+                os.remove(path)
+
+                # fetch_bytes после ошибки докачивает тот же файл по ключу
+                task = asyncio.create_task(downloader.fetch_bytes(url, key='vk:-1_7'))
+                await asyncio.sleep(0.05)
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                part = downloader.part_path('vk:-1_7')
+                assert os.path.exists(part + '.parts')
+                assert await downloader.fetch_bytes(url, key='vk:-1_7') == expected
+                assert not os.path.exists(part) and not os.path.exists(part + '.parts')
+        finally:
+            await http_pool.close_session()
+            await server.stop()
+
+
+async def serve(host: str, port: int, latency: float):
+    server = FakeMusicAPI(latency=latency)
+    base_url = await server.start(host, port)
+    print(f"Стенд запущен: YANDEX_MUSIC_API_URL={base_url} VK_API_URL={base_url}/method")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--latency', type=float, default=float(os.getenv('FAKE_API_LATENCY', '0')))
+    parser.add_argument('--serve', action='store_true', help='не проверять, а работать как сервер')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.serve:
+        asyncio.run(serve(args.host, args.port, args.latency))
+    else:
+        asyncio.run(self_check(args.latency))
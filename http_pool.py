@@ -0,0 +1,91 @@
+"""
+Общий пул HTTP-соединений и запросы с повторами (экспоненциальная пауза со случайным разбросом)
+"""
+import asyncio
+import logging
+import random
+from typing import Any, Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Коды ответа, при которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+class UpstreamError(Exception):
+    """Ошибка ответа внешнего API"""
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Общая HTTP-сессия для всех клиентов (keep-alive соединения переиспользуются)"""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=100, limit_per_host=20, ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=60, sock_connect=10)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _session
+
+
+async def close_session():
+    """Закрытие общей сессии"""
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+def backoff_delay(attempt: int, base: float = 0.2, cap: float = 5.0) -> float:
+    """Пауза перед повтором: экспонента с полным случайным разбросом (full jitter)"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+async def request(
+    method: str,
+    url: str,
+    retries: int = 3,
+    parse: str = 'json',
+    **kwargs,
+) -> Any:
+    """
+    HTTP-запрос через общую сессию с повторами при сетевых ошибках, 429 и 5xx
+
+    Args:
+        method: HTTP-метод
+        url: адрес
+        retries: сколько раз повторять после первой попытки
+        parse: 'json', 'text' или 'bytes'
+        **kwargs: параметры aiohttp (params, data, headers, ...)
+
+    Returns:
+        Разобранное тело ответа
+    """
+    session = get_session()
+    attempt = 0
+    while True:
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                if response.status in RETRY_STATUSES and attempt < retries:
+                    retry_after = response.headers.get('Retry-After')
+                    delay = float(retry_after) if retry_after and retry_after.isdigit() else backoff_delay(attempt)
+                    logger.debug("%s %s: HTTP %s, повтор через %.2f сек", method, url, response.status, delay)
+                    attempt += 1
+                    await asyncio.sleep(delay)
+                    continue
+                if response.status >= 400:
+                    raise UpstreamError(f"{method} {url}: HTTP {response.status}")
+                if parse == 'json':
+                    return await response.json(content_type=None)
+                if parse == 'text':
+                    return await response.text()
+                return await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt >= retries:
+                raise
+            delay = backoff_delay(attempt)
+            logger.debug("%s %s: %s, повтор через %.2f сек", method, url, e, delay)
+            attempt += 1
+            await asyncio.sleep(delay)
@@ -0,0 +1,272 @@
+"""
+Постоянная очередь заданий на скачивание (SQLite) и пул воркеров
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import http_pool
+
+logger = logging.getLogger(__name__)
+
+JOB_FIELDS = ('id', 'kind', 'user_id', 'chat_id', 'message_id', 'payload', 'attempts')
+
+
+class JobQueue:
+    """
+    Очередь заданий в SQLite: переживает перезапуск и падение процесса.
+
+    Задание проходит статусы queued -> running -> done / failed / cancelled.
+    При открытии базы задания, застрявшие в running (процесс упал посреди
+    работы), возвращаются в очередь - доставка "хотя бы один раз".
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def connect(self) -> int:
+        """Открывает базу; возвращает количество возвращённых в очередь незавершённых заданий"""
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' kind TEXT NOT NULL,'
+            ' user_id INTEGER NOT NULL,'
+            ' chat_id INTEGER NOT NULL,'
+            ' message_id INTEGER,'
+            ' payload TEXT NOT NULL,'
+            ' status TEXT NOT NULL,'
+            ' attempts INTEGER NOT NULL DEFAULT 0,'
+            ' not_before REAL NOT NULL DEFAULT 0,'
+            ' error TEXT,'
+            ' created_at REAL NOT NULL,'
+            ' updated_at REAL NOT NULL'
+            ')'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, not_before, id)')
+        resumed = self._conn.execute(
+            "UPDATE jobs SET status='queued', updated_at=? WHERE status='running'", (time.time(),)
+        ).rowcount
+        self._conn.commit()
+        return resumed
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    def put(self, kind: str, user_id: int, chat_id: int, message_id: Optional[int], payload: Dict) -> int:
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT INTO jobs (kind, user_id, chat_id, message_id, payload, status, created_at, updated_at)'
+                " VALUES (?, ?, ?, ?, ?, 'queued', ?, ?)",
+                (kind, user_id, chat_id, message_id, json.dumps(payload, ensure_ascii=False), now, now)
+            )
+            self._conn.commit()
+        return cursor.lastrowid
+
+    def claim(self) -> Optional[Dict[str, Any]]:
+        """Забирает самое старое готовое к выполнению задание и помечает его running"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                f'SELECT {", ".join(JOB_FIELDS)} FROM jobs'
+                " WHERE status='queued' AND not_before<=? ORDER BY id LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE jobs SET status='running', attempts=attempts+1, updated_at=? WHERE id=?",
+                (now, row[0])
+            )
+            self._conn.commit()
+        job = dict(zip(JOB_FIELDS, row))
+        job['payload'] = json.loads(job['payload'])
+        job['attempts'] += 1
+        return job
+
+    def finish(self, job_id: int, status: str = 'done', error: Optional[str] = None):
+        with self._lock:
+            self._conn.execute(
+                'UPDATE jobs SET status=?, error=?, updated_at=? WHERE id=?',
+                (status, error, time.time(), job_id)
+            )
+            self._conn.commit()
+
+    def retry(self, job_id: int, delay: float, error: str):
+        """Возвращает задание в очередь не раньше чем через delay секунд"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status='queued', not_before=?, error=?, updated_at=? WHERE id=?",
+                (now + delay, error, now, job_id)
+            )
+            self._conn.commit()
+
+    def running(self, user_id: int) -> int:
+        """Сколько заданий пользователя сейчас выполняется (в том числе только что забранных)"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status='running' AND user_id=?", (user_id,)
+            ).fetchone()[0]
+
+    def cancel_user(self, user_id: int) -> List[Dict[str, Any]]:
+        """Отменяет ожидающие задания пользователя; возвращает их (для обновления сообщений)"""
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT {", ".join(JOB_FIELDS)} FROM jobs'
+                " WHERE status='queued' AND user_id=?",
+                (user_id,)
+            ).fetchall()
+            self._conn.executemany(
+                "UPDATE jobs SET status='cancelled', updated_at=? WHERE id=?",
+                [(time.time(), row[0]) for row in rows]
+            )
+            self._conn.commit()
+        return [dict(zip(JOB_FIELDS, row)) for row in rows]
+
+    def cancel_by_message(self, user_id: int, chat_id: int, message_id: int) -> List[Dict[str, Any]]:
+        """Отменяет ожидающее задание с сообщением прогресса message_id; возвращает отменённые"""
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT {", ".join(JOB_FIELDS)} FROM jobs'
+                " WHERE status='queued' AND user_id=? AND chat_id=? AND message_id=?",
+                (user_id, chat_id, message_id)
+            ).fetchall()
+            self._conn.executemany(
+                "UPDATE jobs SET status='cancelled', updated_at=? WHERE id=?",
+                [(time.time(), row[0]) for row in rows]
+            )
+            self._conn.commit()
+        return [dict(zip(JOB_FIELDS, row)) for row in rows]
+
+    def running_message(self, user_id: int, chat_id: int, message_id: int) -> bool:
+        """Выполняется ли задание с сообщением прогресса message_id"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM jobs WHERE status='running' AND user_id=? AND chat_id=? AND message_id=? LIMIT 1",
+                (user_id, chat_id, message_id)
+            ).fetchone() is not None
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return dict(rows)
+
+    def purge(self, older_than: float) -> int:
+        """Удаляет завершённые задания старше older_than секунд"""
+        with self._lock:
+            deleted = self._conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND updated_at<?",
+                (time.time() - older_than,)
+            ).rowcount
+            self._conn.commit()
+        return deleted
+
+    # Асинхронные обёртки: запросы к SQLite выполняются вне event loop
+
+    async def add(self, kind: str, user_id: int, chat_id: int, message_id: Optional[int], payload: Dict) -> int:
+        return await asyncio.to_thread(self.put, kind, user_id, chat_id, message_id, payload)
+
+    async def cancel(self, user_id: int) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self.cancel_user, user_id)
+
+    async def cancel_message(self, user_id: int, chat_id: int, message_id: int) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self.cancel_by_message, user_id, chat_id, message_id)
+
+
+class JobWorkers:
+    """
+    Пул воркеров, выполняющих задания очереди.
+
+    Задание подтверждается (done) только после успешного выполнения handler;
+    если процесс завершится раньше, задание выполнится снова после
+    перезапуска. Исключение из handler - повтор с паузой, после
+    max_attempts попыток задание помечается failed и вызывается on_failed.
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        handler: Callable[[Dict[str, Any]], Awaitable[None]],
+        on_failed: Optional[Callable[[Dict[str, Any], Exception], Awaitable[None]]] = None,
+        workers: int = 4,
+        max_attempts: int = 3,
+        poll_interval: float = 1.0,
+    ):
+        self.queue = queue
+        self.handler = handler
+        self.on_failed = on_failed
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self.stats = {'done': 0, 'retried': 0, 'failed': 0}
+
+    def notify(self):
+        """Будит воркеров после постановки задания"""
+        self._wakeup.set()
+
+    async def submit(self, kind: str, user_id: int, chat_id: int, message_id: Optional[int], payload: Dict) -> int:
+        job_id = await self.queue.add(kind, user_id, chat_id, message_id, payload)
+        self.notify()
+        return job_id
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Останавливает воркеров; прерванные задания остаются running и выполнятся после перезапуска"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            # Сбрасываем до claim: задание, поставленное после него, разбудит ожидание
+            self._wakeup.clear()
+            # Момент до claim: отмена после него относится и к забранному заданию (DownloadJobs.run)
+            claimed_at = time.monotonic()
+            job = await asyncio.to_thread(self.queue.claim)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job['claimed_at'] = claimed_at
+            try:
+                await self.handler(job)
+            except Exception as e:
+                if job['attempts'] < self.max_attempts:
+                    delay = http_pool.backoff_delay(job['attempts'], base=1.0, cap=30.0)
+                    logger.warning("Задание %s (%s): %s, повтор через %.1f сек", job['id'], job['kind'], e, delay)
+                    self.stats['retried'] += 1
+                    await asyncio.to_thread(self.queue.retry, job['id'], delay, str(e))
+                    continue
+                logger.error("Задание %s (%s) не выполнено: %s", job['id'], job['kind'], e, exc_info=True)
+                self.stats['failed'] += 1
+                await asyncio.to_thread(self.queue.finish, job['id'], 'failed', str(e))
+                if self.on_failed:
+                    try:
+                        await self.on_failed(job, e)
+                    except Exception as notify_error:
+                        logger.error("Ошибка обработки невыполненного задания %s: %s", job['id'], notify_error)
+                continue
+
+            self.stats['done'] += 1
+            await asyncio.to_thread(self.queue.finish, job['id'])
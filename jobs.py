@@ -0,0 +1,143 @@
+"""
+Учёт выполняемых скачиваний - отдельная задача на каждое, дедлайн и отмена пользователем
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Dict, Hashable, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    """Скачивание отменено пользователем"""
+
+
+class JobTimeout(Exception):
+    """Скачивание не уложилось в дедлайн"""
+
+
+class DownloadFailed(Exception):
+    """Источник не вернул аудио"""
+
+
+class DownloadJobs:
+    """
+    Реестр скачиваний пользователей.
+
+    Каждое скачивание выполняется отдельной asyncio-задачей с дедлайном.
+    Отмена (cancel) прерывает задачу целиком: CancelledError доходит до
+    загрузки из источника (соединение закрывается, временные файлы
+    удаляются), до ожидания в BotApiScheduler и до выгрузки в Telegram,
+    а семафоры и слоты освобождаются в их finally.
+
+    Задание из очереди между claim и run ещё не зарегистрировано здесь;
+    чтобы отмена не потерялась, run получает момент начала claim (since)
+    и сразу отменяет задание, если пользователь нажал отмену после него.
+
+    Скачивание с ключом (key) можно отменить отдельно от остальных
+    скачиваний пользователя - cancel_job.
+    """
+
+    def __init__(self, deadline: float = 120.0):
+        self.deadline = deadline
+        self.active: Dict[int, Set[asyncio.Task]] = {}
+        self._cancelled: Set[asyncio.Task] = set()
+        # Когда пользователь последний раз отменял скачивания (time.monotonic)
+        self.cancelled_at: Dict[int, float] = {}
+        # Ключи скачиваний и когда их отменяли по отдельности
+        self.keys: Dict[asyncio.Task, Hashable] = {}
+        self.cancelled_keys: Dict[Hashable, float] = {}
+        self.stats = {'started': 0, 'done': 0, 'cancelled': 0, 'timed_out': 0, 'failed': 0}
+
+    def running(self, user_id: int) -> int:
+        return len(self.active.get(user_id, ()))
+
+    async def run(self, user_id: int, coro: Awaitable[Any], deadline: Optional[float] = None,
+                  since: Optional[float] = None, key: Optional[Hashable] = None) -> Any:
+        """
+        Выполняет скачивание как отслеживаемую задачу
+
+        Args:
+            since: с какого момента (time.monotonic) отмена пользователем
+                относится к этому скачиванию, даже если была до вызова run
+            key: ключ для отмены только этого скачивания (cancel_job)
+
+        Raises:
+            JobCancelled: пользователь отменил скачивание
+            JobTimeout: истёк дедлайн (задача при этом прервана)
+        """
+        # Между проверкой и регистрацией задачи нет await - отмена не проскочит
+        if since is not None and max(self.cancelled_at.get(user_id, float('-inf')),
+                                     self.cancelled_keys.get(key, float('-inf'))) >= since:
+            coro.close()
+            self.stats['cancelled'] += 1
+            raise JobCancelled()
+        task = asyncio.create_task(coro)
+        self.active.setdefault(user_id, set()).add(task)
+        if key is not None:
+            self.keys[task] = key
+        self.stats['started'] += 1
+        try:
+            result = await asyncio.wait_for(task, timeout=deadline or self.deadline)
+        except asyncio.TimeoutError:
+            self.stats['timed_out'] += 1
+            logger.warning("Скачивание пользователя %s прервано по дедлайну", user_id)
+            raise JobTimeout() from None
+        except asyncio.CancelledError:
+            if task not in self._cancelled:
+                # Отменили того, кто ждёт (остановка бота) - прерываем и саму задачу
+                task.cancel()
+                raise
+            self.stats['cancelled'] += 1
+            raise JobCancelled() from None
+        except Exception:
+            self.stats['failed'] += 1
+            raise
+        finally:
+            self._cancelled.discard(task)
+            self.keys.pop(task, None)
+            tasks = self.active.get(user_id)
+            if tasks is not None:
+                tasks.discard(task)
+                if not tasks:
+                    del self.active[user_id]
+        self.stats['done'] += 1
+        return result
+
+    def cancel(self, user_id: int) -> int:
+        """Отменяет все скачивания пользователя; возвращает их количество"""
+        now = time.monotonic()
+        self.cancelled_at[user_id] = now
+        # Старые отметки уже не относятся ни к одному заданию
+        if len(self.cancelled_at) > 10000:
+            self.cancelled_at = {uid: at for uid, at in self.cancelled_at.items() if now - at < 3600}
+        tasks = [task for task in self.active.get(user_id, ()) if not task.done()]
+        for task in tasks:
+            self._cancelled.add(task)
+            task.cancel()
+        if tasks:
+            logger.info("Пользователь %s отменил %s скачиваний", user_id, len(tasks))
+        return len(tasks)
+
+    def cancel_job(self, user_id: int, key: Hashable) -> int:
+        """Отменяет скачивание пользователя с ключом key; возвращает, сколько задач прервано"""
+        now = time.monotonic()
+        self.cancelled_keys[key] = now
+        if len(self.cancelled_keys) > 10000:
+            self.cancelled_keys = {k: at for k, at in self.cancelled_keys.items() if now - at < 3600}
+        tasks = [task for task in self.active.get(user_id, ())
+                 if not task.done() and self.keys.get(task) == key]
+        for task in tasks:
+            self._cancelled.add(task)
+            task.cancel()
+        if tasks:
+            logger.info("Пользователь %s отменил скачивание %s", user_id, key)
+        return len(tasks)
+
+    async def shutdown(self):
+        """Прерывает все скачивания (при остановке бота)"""
+        tasks = [task for tasks in self.active.values() for task in tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,159 @@
+"""
+Популярность запросов и треков - count-min sketch и top-k в фиксированной памяти
+"""
+import asyncio
+import base64
+import hashlib
+import heapq
+import json
+import logging
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class CountMinSketch:
+    """Count-min sketch: оценка частоты сверху с фиксированной памятью depth x width"""
+
+    def __init__(self, width: int = 4096, depth: int = 4):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.uint32)
+        self._rows = np.arange(depth)
+
+    def _columns(self, key: str) -> np.ndarray:
+        # blake2b, а не hash(): индексы должны совпадать между перезапусками
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=4 * self.depth).digest()
+        return np.frombuffer(digest, dtype=np.uint32) % self.width
+
+    def add(self, key: str, count: int = 1) -> int:
+        """Увеличивает счётчик ключа; возвращает новую оценку"""
+        columns = self._columns(key)
+        self.table[self._rows, columns] += count
+        return int(self.table[self._rows, columns].min())
+
+    def estimate(self, key: str) -> int:
+        return int(self.table[self._rows, self._columns(key)].min())
+
+
+class TopK:
+    """Кандидаты в самые частые ключи (не больше capacity) с оценками из sketch"""
+
+    def __init__(self, capacity: int = 100):
+        self.capacity = capacity
+        self.counts: Dict[str, int] = {}
+        self._heap: List[Tuple[int, str]] = []  # ленивая min-куча (оценка, ключ)
+
+    def offer(self, key: str, estimate: int):
+        if key in self.counts or len(self.counts) < self.capacity:
+            self.counts[key] = estimate
+            heapq.heappush(self._heap, (estimate, key))
+            return
+
+        # Снимаем устаревшие записи кучи, пока на вершине не окажется настоящий минимум
+        while self._heap:
+            count, weakest = self._heap[0]
+            if self.counts.get(weakest) == count:
+                break
+            heapq.heappop(self._heap)
+
+        if self._heap and estimate > self._heap[0][0]:
+            _, weakest = heapq.heappop(self._heap)
+            del self.counts[weakest]
+            self.counts[key] = estimate
+            heapq.heappush(self._heap, (estimate, key))
+
+        # Куча не должна разрастаться из-за устаревших записей
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(count, key) for key, count in self.counts.items()]
+            heapq.heapify(self._heap)
+
+    def top(self, n: int) -> List[Tuple[str, int]]:
+        return sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))[:n]
+
+
+class PopularityTracker:
+    """Популярность запросов и скачиваемых треков; сохраняется между перезапусками"""
+
+    KINDS = ('queries', 'tracks')
+
+    def __init__(self, path: str, width: int = 4096, depth: int = 4, capacity: int = 100):
+        self.path = path
+        self.sketches = {kind: CountMinSketch(width, depth) for kind in self.KINDS}
+        self.tops = {kind: TopK(capacity) for kind in self.KINDS}
+
+    def record(self, kind: str, key: str):
+        estimate = self.sketches[kind].add(key)
+        self.tops[kind].offer(key, estimate)
+
+    def record_query(self, query: str):
+        self.record('queries', ' '.join(query.lower().split()))
+
+    def record_track(self, track_id: str):
+        self.record('tracks', track_id)
+
+    def top_queries(self, n: int = 20) -> List[Tuple[str, int]]:
+        return self.tops['queries'].top(n)
+
+    def top_tracks(self, n: int = 20) -> List[Tuple[str, int]]:
+        return self.tops['tracks'].top(n)
+
+    def dump(self) -> dict:
+        """
+        Снимок состояния для сохранения; вызывается в потоке event loop,
+        пока обработчики не меняют счётчики
+        """
+        state = {}
+        for kind in self.KINDS:
+            sketch = self.sketches[kind]
+            state[kind] = {
+                'width': sketch.width,
+                'depth': sketch.depth,
+                'table': sketch.table.copy(),
+                'top': dict(self.tops[kind].counts),
+            }
+        return state
+
+    def write(self, state: dict):
+        """Кодирует снимок и пишет его в файл (можно вызывать в отдельном потоке)"""
+        try:
+            for saved in state.values():
+                saved['table'] = base64.b64encode(saved['table'].tobytes()).decode('ascii')
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.error("Ошибка сохранения популярности: %s", e)
+
+    def save(self):
+        """Сохраняет sketch и top-k в файл"""
+        self.write(self.dump())
+
+    async def save_async(self):
+        """Снимок берётся в event loop, кодирование и запись - в отдельном потоке"""
+        await asyncio.to_thread(self.write, self.dump())
+
+    def load(self):
+        """Загружает sketch и top-k из файла"""
+        try:
+            if not os.path.exists(self.path):
+                return
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            for kind in self.KINDS:
+                saved = state.get(kind)
+                sketch = self.sketches[kind]
+                if not saved or (saved['width'], saved['depth']) != (sketch.width, sketch.depth):
+                    continue
+                table = np.frombuffer(base64.b64decode(saved['table']), dtype=np.uint32)
+                sketch.table = table.reshape(sketch.depth, sketch.width).copy()
+                for key, count in saved['top'].items():
+                    self.tops[kind].offer(key, count)
+            logger.info("Популярность загружена: %s запросов, %s треков в топе",
+                        len(self.tops['queries'].counts), len(self.tops['tracks'].counts))
+        except Exception as e:
+            logger.error("Ошибка загрузки популярности: %s", e)
@@ -0,0 +1,228 @@
+"""
+Упреждающее скачивание - треки из начала выдачи качаются, пока пользователь выбирает
+"""
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class AudioCache:
+    """LRU-кэш аудио в памяти с ограничением по суммарному размеру"""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._data: "OrderedDict[str, bytes]" = OrderedDict()
+        # Вызывается для вытесненных, так и не использованных записей
+        self.on_evict: Optional[Callable[[str], None]] = None
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._data[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            evicted_key, evicted = self._data.popitem(last=False)
+            self.size -= len(evicted)
+            if self.on_evict:
+                self.on_evict(evicted_key)
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Возвращает запись, оставляя её в кэше"""
+        data = self._data.get(key)
+        if data is not None:
+            self._data.move_to_end(key)
+        return data
+
+    def pop(self, key: str) -> Optional[bytes]:
+        data = self._data.pop(key, None)
+        if data is not None:
+            self.size -= len(data)
+        return data
+
+
+class Prefetcher:
+    """
+    Фоновая подкачка самых вероятных треков в AudioCache.
+
+    Не конкурирует с настоящими скачиваниями: новые подкачки не стартуют,
+    пока идёт хотя бы одно настоящее скачивание, число одновременных
+    подкачек и резерв памяти под них ограничены.
+
+    Прогрев (warm) - ещё ниже: треки качаются по одному и только когда нет
+    ни настоящих скачиваний, ни подкачек пользователей; подкачка по выдаче
+    пользователя прерывает трек прогрева, он будет скачан позже.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[dict], Awaitable[Optional[bytes]]],
+        cache: AudioCache,
+        top_n: int = 2,
+        concurrency: int = 2,
+        estimated_size: int = 10 * 1024 * 1024,
+        idle_poll: float = 1.0,
+    ):
+        self.fetch = fetch
+        self.cache = cache
+        self.top_n = top_n
+        self.concurrency = concurrency
+        # Сколько байт резервируем под трек, размер которого ещё не известен
+        self.estimated_size = estimated_size
+        # Как часто прогрев проверяет, свободна ли подкачка
+        self.idle_poll = idle_poll
+
+        self.inflight: Dict[str, asyncio.Task] = {}
+        self.user_tasks: Dict[int, List[str]] = {}
+        self.foreground_active = 0
+        # Фоновый прогрев и трек, который он сейчас качает
+        self.warm_task: Optional[asyncio.Task] = None
+        self.warming: Optional[str] = None
+
+        self.stats = {
+            'scheduled': 0,
+            'completed': 0,
+            'hits': 0,
+            'joined': 0,
+            'misses': 0,
+            'cancelled': 0,
+            'wasted': 0,
+            'skipped': 0,
+            'preempted': 0,
+        }
+        cache.on_evict = self._on_evict
+
+    def _on_evict(self, key: str):
+        self.stats['wasted'] += 1
+
+    @asynccontextmanager
+    async def foreground(self):
+        """Помечает настоящее скачивание - на это время новые подкачки не стартуют"""
+        self.foreground_active += 1
+        try:
+            yield
+        finally:
+            self.foreground_active -= 1
+
+    def _has_budget(self) -> bool:
+        reserved = (len(self.inflight) + 1) * self.estimated_size
+        return (len(self.inflight) < self.concurrency
+                and self.cache.size + reserved <= self.cache.max_bytes)
+
+    def schedule(self, user_id: int, tracks: List[dict], limit: Optional[int] = None):
+        """Запускает подкачку первых треков выдачи (предыдущая подкачка пользователя отменяется)"""
+        self.cancel(user_id)
+        wanted = tracks[:limit or self.top_n]
+        # Прогрев уступает место подкачке пользователя
+        if self.warming is not None and self.warming not in {track['id'] for track in wanted}:
+            task = self.inflight.pop(self.warming, None)
+            if task and not task.done():
+                task.cancel()
+                self.stats['preempted'] += 1
+        started = []
+        for track in wanted:
+            track_id = track['id']
+            if track_id in self.cache or track_id in self.inflight:
+                continue
+            if self.foreground_active or not self._has_budget():
+                self.stats['skipped'] += 1
+                continue
+            task = asyncio.create_task(self._run(track))
+            self.inflight[track_id] = task
+            started.append(track_id)
+            self.stats['scheduled'] += 1
+        if started:
+            self.user_tasks[user_id] = started
+
+    async def _run(self, track: dict):
+        track_id = track['id']
+        try:
+            data = await self.fetch(track)
+            if data:
+                self.cache.put(track_id, data)
+                self.stats['completed'] += 1
+            return data
+        except Exception as e:
+            logger.debug("Ошибка подкачки трека %s: %s", track_id, e)
+            return None
+        finally:
+            if self.inflight.get(track_id) is asyncio.current_task():
+                del self.inflight[track_id]
+
+    def warm(self, tracks: List[dict]):
+        """Подкачивает треки в фоне с самым низким приоритетом (прогрев при запуске)"""
+        if self.warm_task is not None and not self.warm_task.done():
+            self.warm_task.cancel()
+        self.warm_task = asyncio.create_task(self._warm(list(tracks)))
+
+    async def _warm(self, tracks: List[dict]):
+        for track in tracks:
+            track_id = track['id']
+            while track_id not in self.cache and track_id not in self.inflight:
+                if self.foreground_active or self.inflight or not self._has_budget():
+                    await asyncio.sleep(self.idle_poll)
+                    continue
+                task = asyncio.create_task(self._run(track))
+                self.inflight[track_id] = task
+                self.warming = track_id
+                self.stats['scheduled'] += 1
+                try:
+                    # Не пробрасывает отмену задачи: прерванный трек пробуем снова, когда станет свободно
+                    await asyncio.wait([task])
+                finally:
+                    self.warming = None
+                    if not task.done():
+                        task.cancel()
+                if not task.cancelled():
+                    break
+
+    def cancel(self, user_id: int):
+        """Отменяет незавершённые подкачки пользователя (/cancel, новый поиск)"""
+        for track_id in self.user_tasks.pop(user_id, []):
+            # Задача, отменённая до первого запуска, не доходит до finally в _run
+            task = self.inflight.pop(track_id, None)
+            if task and not task.done():
+                task.cancel()
+                self.stats['cancelled'] += 1
+
+    async def take(self, track_id: str) -> Optional[bytes]:
+        """Забирает подкачанный трек; если подкачка ещё идёт - дожидается её"""
+        data = self.cache.pop(track_id)
+        if data is not None:
+            self.stats['hits'] += 1
+            return data
+
+        task = self.inflight.get(track_id)
+        if task is not None:
+            try:
+                data = await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    raise
+                data = None
+            if data:
+                self.cache.pop(track_id)
+                self.stats['joined'] += 1
+                return data
+
+        self.stats['misses'] += 1
+        return None
+
+    def hit_rate(self) -> float:
+        """Доля скачиваний, обслуженных подкачкой"""
+        served = self.stats['hits'] + self.stats['joined']
+        total = served + self.stats['misses']
+        return served / total if total else 0.0
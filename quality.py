@@ -0,0 +1,52 @@
+"""
+Выбор битрейта по размеру: трек, который не пройдёт в Telegram, не скачивается
+"""
+import logging
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Лимит Telegram на отправку файла ботом
+UPLOAD_LIMIT = 50 * 1024 * 1024
+
+# Запас на теги и заголовки кадров mp3 сверх чистого битрейта
+SIZE_OVERHEAD = 1.03
+
+
+class TrackTooLarge(Exception):
+    """Трек не укладывается в лимит отправки ни в одном доступном качестве"""
+
+    def __init__(self, estimated: int, limit: int = UPLOAD_LIMIT):
+        super().__init__(f"оценка размера {estimated / 1024 / 1024:.1f} МБ больше лимита {limit / 1024 / 1024:.0f} МБ")
+        self.estimated = estimated
+        self.limit = limit
+
+
+def estimate_size(seconds: int, bitrate: int) -> int:
+    """Оценка размера файла в байтах по длительности (сек) и битрейту (кбит/с)"""
+    return int(seconds * bitrate * 1000 / 8 * SIZE_OVERHEAD)
+
+
+def pick_bitrate(bitrates: List[int], seconds: int, limit: int = UPLOAD_LIMIT) -> Optional[int]:
+    """
+    Наибольший битрейт, при котором файл уложится в limit
+
+    Returns:
+        Битрейт; None, если битрейты неизвестны (качество выбирает источник)
+
+    Raises:
+        TrackTooLarge: даже наименьший битрейт не укладывается в лимит
+    """
+    if not bitrates:
+        return None
+    if seconds <= 0:
+        # Длительность неизвестна - оценить нельзя, берём лучшее качество
+        return max(bitrates)
+    fitting = [bitrate for bitrate in bitrates if estimate_size(seconds, bitrate) <= limit]
+    if not fitting:
+        raise TrackTooLarge(estimate_size(seconds, min(bitrates)), limit)
+    bitrate = max(fitting)
+    if bitrate < max(bitrates):
+        logger.info("Качество снижено до %s кбит/с: %s сек не помещаются в лимит при %s кбит/с",
+                    bitrate, seconds, max(bitrates))
+    return bitrate
@@ -0,0 +1,222 @@
+"""
+Планировщик исходящих запросов к Bot API - лимиты Telegram и обработка flood wait
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих запросов
+PRIORITY_HIGH = 0  # Итоговые результаты: аудио, результаты поиска, ошибки
+PRIORITY_LOW = 1   # Косметика: прогресс-бары, удаление служебных сообщений
+PRIORITY_BULK = 2  # Массовые рассылки: не отбрасываются, но оставляют запас интерактиву
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity про запас"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+    def wait_time(self, now: float, reserve: float = 0.0) -> float:
+        """Сколько секунд ждать, пока появится токен сверх reserve"""
+        self._refill(now)
+        need = 1.0 + reserve
+        if self.tokens >= need:
+            return 0.0
+        return (need - self.tokens) / self.rate
+
+    def consume(self, now: float) -> bool:
+        """Забирает токен, если он есть"""
+        self._refill(now)
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class BotApiScheduler:
+    """
+    Центральный планировщик исходящих вызовов Bot API.
+
+    Держит глобальный и поканальный token bucket, автоматически выжидает
+    retry_after и пропускает вперёд важные запросы. Косметические запросы
+    (PRIORITY_LOW) под нагрузкой отбрасываются, а не ломают основной сценарий.
+
+    Flood wait на массовом запросе (PRIORITY_BULK) ставит на паузу весь
+    массовый трафик, а не только один чат: при рассылке такой 429 означает,
+    что упёрлись в общий лимит бота.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 30.0,
+        chat_rate: float = 1.0,
+        chat_burst: float = 3.0,
+        low_reserve: float = 5.0,
+        bulk_reserve: float = 15.0,
+        low_max_wait: float = 1.0,
+        max_retries: int = 3,
+        max_chats: int = 10000,
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        # Сколько глобальных токенов держим в резерве для важных запросов
+        self.low_reserve = low_reserve
+        self.bulk_reserve = bulk_reserve
+        self.low_max_wait = low_max_wait
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.chat_paused_until: Dict[int, float] = {}
+        self.bulk_paused_until = 0.0
+        self.high_waiting: Dict[int, int] = {}
+
+        self.stats = {'sent': 0, 'shed': 0, 'retry_after': 0}
+
+    def _chat_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.max_chats:
+                self._evict_idle(now)
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _evict_idle(self, now: float):
+        """Удаляет полностью восстановившиеся (простаивающие) бакеты"""
+        idle = [chat_id for chat_id, bucket in self.chat_buckets.items()
+                if bucket.is_full(now) and not self.high_waiting.get(chat_id)]
+        for chat_id in idle:
+            del self.chat_buckets[chat_id]
+        for chat_id, until in list(self.chat_paused_until.items()):
+            if until <= now:
+                del self.chat_paused_until[chat_id]
+
+    def _pause(self, chat_id: int, retry_after: float):
+        until = time.monotonic() + retry_after
+        if until > self.chat_paused_until.get(chat_id, 0.0):
+            self.chat_paused_until[chat_id] = until
+
+    def _pause_bulk(self, retry_after: float):
+        self.bulk_paused_until = max(self.bulk_paused_until, time.monotonic() + retry_after)
+
+    def bulk_pause_left(self) -> float:
+        """Сколько секунд осталось до конца паузы массового трафика"""
+        return max(0.0, self.bulk_paused_until - time.monotonic())
+
+    async def _acquire(self, chat_id: int, priority: int) -> bool:
+        """Ждёт токены; для PRIORITY_LOW возвращает False, если запрос надо отбросить"""
+        is_high = priority == PRIORITY_HIGH
+        is_low = priority == PRIORITY_LOW
+        if is_high:
+            reserve = 0.0
+        elif is_low:
+            reserve = self.low_reserve
+        else:
+            reserve = self.bulk_reserve
+        if is_high:
+            self.high_waiting[chat_id] = self.high_waiting.get(chat_id, 0) + 1
+        try:
+            while True:
+                now = time.monotonic()
+                # Косметика уступает важным запросам в том же чате
+                if is_low and self.high_waiting.get(chat_id):
+                    return False
+
+                bucket = self._chat_bucket(chat_id, now)
+                wait = max(
+                    self.global_bucket.wait_time(now, reserve),
+                    bucket.wait_time(now),
+                    self.chat_paused_until.get(chat_id, 0.0) - now,
+                    self.bulk_paused_until - now if priority == PRIORITY_BULK else 0.0,
+                )
+
+                if wait <= 0:
+                    self.global_bucket.consume(now)
+                    bucket.consume(now)
+                    return True
+
+                if is_low and wait > self.low_max_wait:
+                    return False
+
+                await asyncio.sleep(wait)
+        finally:
+            if is_high:
+                left = self.high_waiting[chat_id] - 1
+                if left:
+                    self.high_waiting[chat_id] = left
+                else:
+                    del self.high_waiting[chat_id]
+
+    async def send(
+        self,
+        chat_id: int,
+        request: Callable[[], Awaitable[Any]],
+        priority: int = PRIORITY_HIGH,
+    ) -> Optional[Any]:
+        """
+        Выполняет запрос к Bot API с учётом лимитов
+
+        Args:
+            chat_id: чат, в который уходит запрос
+            request: фабрика корутины (например, functools.partial(message.edit_text, ...))
+            priority: PRIORITY_HIGH, PRIORITY_LOW или PRIORITY_BULK
+
+        Returns:
+            Результат запроса или None, если косметический запрос был отброшен
+        """
+        attempt = 0
+        while True:
+            if not await self._acquire(chat_id, priority):
+                self.stats['shed'] += 1
+                logger.debug("Отброшен косметический запрос для чата %s", chat_id)
+                return None
+
+            try:
+                result = await request()
+                self.stats['sent'] += 1
+                return result
+
+            except TelegramRetryAfter as e:
+                self.stats['retry_after'] += 1
+                self._pause(chat_id, e.retry_after)
+                if priority == PRIORITY_BULK:
+                    self._pause_bulk(e.retry_after)
+                logger.warning("Flood wait %s сек для чата %s", e.retry_after, chat_id)
+
+                attempt += 1
+                if priority == PRIORITY_LOW:
+                    self.stats['shed'] += 1
+                    return None
+                if attempt > self.max_retries:
+                    raise
+
+            except TelegramBadRequest as e:
+                # "message is not modified", удалённые сообщения и т.п. -
+                # для косметики это не ошибка
+                if priority == PRIORITY_LOW:
+                    logger.debug("Косметический запрос не выполнен: %s", e)
+                    return None
+                raise
@@ -0,0 +1,154 @@
+"""
+Нечёткий поиск - триграммный индекс по нормализованным и транслитерированным полям
+"""
+import math
+import re
+from array import array
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from track_catalog import canonical
+
+# Транслитерация кириллицы в латиницу: "моргенштерн" и "morgenshtern" дают одну строку
+_CYR_TO_LAT = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p',
+    'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch',
+    'ш': 'sh', 'щ': 'sch', 'ъ': '', 'ы': 'i', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+}
+_TRANSLIT = str.maketrans(_CYR_TO_LAT)
+
+# Упрощение латиницы до "звучания": oxxxymiron -> oksimiron, scriptonite -> skriptonite
+_PHONETIC = (
+    ('ph', 'f'),
+    ('x', 'ks'),
+    ('y', 'i'),
+    ('w', 'v'),
+    ('q', 'k'),
+    ('c', 'k'),
+)
+_REPEATS = re.compile(r'(.)\1+')
+
+
+def normalize(text: str) -> str:
+    """Нормализованная форма для нечёткого сравнения"""
+    text = canonical(text).translate(_TRANSLIT)
+    text = _REPEATS.sub(r'\1', text)
+    for src, dst in _PHONETIC:
+        text = text.replace(src, dst)
+    return _REPEATS.sub(r'\1', text)
+
+
+def trigrams(text: str) -> set:
+    """Множество триграмм нормализованной строки (слова дополняются пробелами)"""
+    grams = set()
+    for word in normalize(text).split():
+        padded = f" {word} "
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return grams
+
+
+class TrigramIndex:
+    """
+    Инвертированный индекс триграмм.
+
+    Списки документов хранятся массивами uint32 и при поиске склеиваются
+    в один вектор: число общих триграмм для всех документов считает
+    np.bincount, без цикла Python по кандидатам.
+    """
+
+    def __init__(self):
+        self.docs: List[Any] = []
+        self.doc_sizes = array('H')
+        self.postings: Dict[str, array] = defaultdict(lambda: array('I'))
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, payload: Any, text: str) -> int:
+        """Добавляет документ; возвращает его номер"""
+        doc_id = len(self.docs)
+        grams = trigrams(text)
+        self.docs.append(payload)
+        self.doc_sizes.append(min(len(grams), 0xFFFF))
+        for gram in grams:
+            self.postings[gram].append(doc_id)
+        return doc_id
+
+    def to_state(self) -> tuple:
+        """Компактное состояние для снимка: списки документов склеены в один массив"""
+        grams = list(self.postings)
+        lengths = np.fromiter((len(self.postings[gram]) for gram in grams), dtype=np.uint32, count=len(grams))
+        flat = np.concatenate([np.frombuffer(self.postings[gram], dtype=np.uint32) for gram in grams]) \
+            if grams else np.zeros(0, dtype=np.uint32)
+        return self.docs, self.doc_sizes.tobytes(), '\n'.join(grams), lengths.tobytes(), flat.tobytes()
+
+    @classmethod
+    def from_state(cls, state: tuple) -> 'TrigramIndex':
+        docs, doc_sizes, grams, lengths, flat = state
+        index = cls()
+        index.docs = docs
+        index.doc_sizes.frombytes(doc_sizes)
+        lengths = np.frombuffer(lengths, dtype=np.uint32)
+        offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+        flat = memoryview(flat)
+        item = array('I').itemsize
+        for i, gram in enumerate(grams.split('\n') if grams else []):
+            postings = index.postings[gram]
+            postings.frombytes(flat[offsets[i] * item:offsets[i + 1] * item])
+        return index
+
+    def search(
+        self,
+        query: str,
+        limit: int = 10,
+        min_score: float = 0.5,
+        mask: Optional[np.ndarray] = None,
+    ) -> List[Tuple[float, Any]]:
+        """
+        Поиск похожих документов
+
+        Args:
+            query: поисковый запрос
+            limit: максимальное количество результатов
+            min_score: минимальная доля триграмм запроса, найденных в документе
+            mask: булева маска допустимых документов (фильтры поиска)
+
+        Returns:
+            Список (оценка, документ) по убыванию оценки
+        """
+        query_grams = trigrams(query)
+        if not query_grams:
+            return []
+
+        # np.frombuffer не копирует данные массивов
+        lists = [np.frombuffer(self.postings[gram], dtype=np.uint32)
+                 for gram in query_grams if gram in self.postings]
+        if not lists:
+            return []
+
+        total = len(query_grams)
+        need = max(1, math.ceil(min_score * total))
+
+        counts = np.bincount(np.concatenate(lists))
+        candidates = np.flatnonzero(counts >= need)
+        if mask is not None:
+            candidates = candidates[mask[candidates]]
+        if not len(candidates):
+            return []
+
+        shared = counts[candidates]
+        sizes = np.frombuffer(self.doc_sizes, dtype=np.uint16)[candidates]
+        # Основная оценка - покрытие запроса, при равенстве выше короткие документы
+        scores = shared / total + 0.2 * shared / (total + sizes)
+
+        if len(candidates) > limit:
+            top = np.argpartition(-scores, limit)[:limit]
+        else:
+            top = np.arange(len(candidates))
+        top = top[np.lexsort((candidates[top], -scores[top]))]
+
+        return [(float(scores[i]), self.docs[candidates[i]]) for i in top]
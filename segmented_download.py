@@ -0,0 +1,300 @@
+"""
+Скачивание больших файлов параллельными диапазонами (HTTP Range) с докачкой
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+import http_pool
+
+logger = logging.getLogger(__name__)
+
+_CONTENT_RANGE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+)')
+_MD5_ETAG = re.compile(r'^"?([0-9a-fA-F]{32})"?$')
+
+
+class DownloadError(Exception):
+    """Файл не удалось скачать или он не прошёл проверку"""
+
+
+class SegmentedDownloader:
+    """
+    Скачивание файла несколькими параллельными Range-запросами в заранее
+    выделенный файл.
+
+    Сначала одним запросом "bytes=0-0" выясняется размер и поддержка
+    диапазонов. Файлы меньше min_size и серверы без диапазонов качаются
+    одним потоком. Прогресс каждого сегмента сохраняется в файл
+    <path>.parts: оборванный сегмент докачивается с места обрыва, в том числе
+    после перезапуска. В конце проверяется размер и, если известен, MD5
+    (из аргумента или ETag вида md5).
+
+    fetch_bytes качает в постоянный файл каталога download_dir, имя которого
+    зависит от ключа (id трека и качество; подписанная ссылка меняется от
+    запроса к запросу): после ошибки файл и <path>.parts остаются, и
+    следующая попытка того же трека докачивает его. Брошенные недокачки
+    старше max_age удаляются.
+    """
+
+    def __init__(
+        self,
+        segments: int = 4,
+        min_size: int = 4 * 1024 * 1024,
+        chunk_size: int = 64 * 1024,
+        flush_size: int = 1024 * 1024,
+        retries: int = 5,
+        download_dir: Optional[str] = None,
+        max_age: float = 24 * 3600,
+    ):
+        self.segments = segments
+        self.min_size = min_size
+        self.chunk_size = chunk_size
+        self.flush_size = flush_size
+        self.retries = retries
+        self.download_dir = download_dir or os.path.join(tempfile.gettempdir(), 'music-bot-downloads')
+        self.max_age = max_age
+        # Один файл - одно скачивание: параллельные запросы того же ключа ждут друг друга
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._waiting: Dict[str, int] = {}
+        self._cleaned_at = 0.0
+
+    async def probe(self, url: str) -> Tuple[Optional[int], bool, Optional[str]]:
+        """Возвращает (размер или None, поддерживаются ли диапазоны, md5 из ETag или None)"""
+        session = http_pool.get_session()
+        async with session.get(url, headers={'Range': 'bytes=0-0'}) as response:
+            if response.status >= 400:
+                raise DownloadError(f"GET {url}: HTTP {response.status}")
+            etag = _MD5_ETAG.match(response.headers.get('ETag', ''))
+            md5 = etag.group(1).lower() if etag else None
+            if response.status == 206:
+                match = _CONTENT_RANGE.match(response.headers.get('Content-Range', ''))
+                if match:
+                    return int(match.group(3)), True, md5
+            # Сервер проигнорировал Range - тело не читаем, соединение закроется
+            response.release()
+            return response.content_length, False, md5
+
+    def _plan(self, size: int) -> List[List[int]]:
+        """Сегменты [начало, конец включительно, скачано байт]"""
+        count = max(1, min(self.segments, size // max(1, self.min_size // 2)))
+        step = -(-size // count)
+        return [[start, min(start + step, size) - 1, 0] for start in range(0, size, step)]
+
+    def _load_parts(self, path: str, size: int) -> Optional[List[List[int]]]:
+        try:
+            with open(path + '.parts', 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if state['size'] == size and os.path.getsize(path) == size:
+                return state['segments']
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def _save_parts(self, path: str, size: int, segments: List[List[int]]):
+        try:
+            with open(path + '.parts', 'w', encoding='utf-8') as f:
+                json.dump({'size': size, 'segments': segments}, f)
+        except OSError as e:
+            logger.warning("Не удалось сохранить прогресс скачивания %s: %s", path, e)
+
+    async def _fetch_segment(self, url: str, path: str, segment: List[int]):
+        """Качает сегмент до конца, после обрыва продолжает с последнего записанного байта"""
+        start, end = segment[0], segment[1]
+        session = http_pool.get_session()
+        attempt = 0
+        while start + segment[2] <= end:
+            offset = start + segment[2]
+            try:
+                async with session.get(url, headers={'Range': f'bytes={offset}-{end}'}) as response:
+                    if response.status != 206:
+                        raise DownloadError(f"HTTP {response.status} на диапазон {offset}-{end}")
+                    buffer = bytearray()
+                    async for chunk in response.content.iter_chunked(self.chunk_size):
+                        buffer += chunk
+                        if len(buffer) >= self.flush_size:
+                            await asyncio.to_thread(_pwrite, path, bytes(buffer), offset)
+                            offset += len(buffer)
+                            segment[2] += len(buffer)
+                            buffer.clear()
+                    if buffer:
+                        await asyncio.to_thread(_pwrite, path, bytes(buffer), offset)
+                        segment[2] += len(buffer)
+                    if start + segment[2] <= end:
+                        raise aiohttp.ClientPayloadError("соединение закрыто до конца диапазона")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= self.retries:
+                    raise
+                delay = http_pool.backoff_delay(attempt)
+                logger.debug("Сегмент %s-%s оборвался на %s байт (%s), докачка через %.2f сек",
+                             start, end, segment[2], e, delay)
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def _fetch_stream(self, url: str, path: str) -> int:
+        """Скачивание одним потоком (сервер не поддерживает диапазоны)"""
+        attempt = 0
+        while True:
+            try:
+                session = http_pool.get_session()
+                size = 0
+                with open(path, 'wb') as f:
+                    async with session.get(url) as response:
+                        if response.status >= 400:
+                            raise DownloadError(f"GET {url}: HTTP {response.status}")
+                        buffer = bytearray()
+                        async for chunk in response.content.iter_chunked(self.chunk_size):
+                            buffer += chunk
+                            if len(buffer) >= self.flush_size:
+                                await asyncio.to_thread(f.write, bytes(buffer))
+                                size += len(buffer)
+                                buffer.clear()
+                        await asyncio.to_thread(f.write, bytes(buffer))
+                        size += len(buffer)
+                        if response.content_length is not None and size != response.content_length:
+                            raise aiohttp.ClientPayloadError("соединение закрыто до конца файла")
+                return size
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Без диапазонов докачать нельзя - начинаем заново
+                if attempt >= self.retries:
+                    raise
+                delay = http_pool.backoff_delay(attempt)
+                logger.debug("Скачивание %s оборвалось (%s), повтор через %.2f сек", url, e, delay)
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def fetch(self, url: str, path: str, md5: Optional[str] = None) -> int:
+        """
+        Скачивает url в файл path
+
+        Args:
+            url: адрес файла
+            path: куда сохранить (незавершённый файл с <path>.parts будет докачан)
+            md5: ожидаемая контрольная сумма, если известна
+
+        Returns:
+            Размер файла
+        """
+        size, ranges, etag_md5 = await self.probe(url)
+        md5 = md5 or etag_md5
+
+        if not ranges or not size or size < self.min_size:
+            written = await self._fetch_stream(url, path)
+            if size is not None and written != size:
+                raise DownloadError(f"{url}: получено {written} байт вместо {size}")
+        else:
+            segments = self._load_parts(path, size)
+            if segments is None:
+                segments = self._plan(size)
+                # Заранее выделяем файл целиком - сегменты пишутся по своим смещениям
+                with open(path, 'wb') as f:
+                    f.truncate(size)
+            else:
+                logger.info("Докачка %s: уже есть %s из %s байт", url, sum(s[2] for s in segments), size)
+
+            tasks = [asyncio.create_task(self._fetch_segment(url, path, s)) for s in segments]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                # Ошибка одного сегмента (или отмена) останавливает остальные;
+                # прогресс сохраняем, когда все сегменты уже стоят
+                for task in tasks:
+                    task.cancel()
+                await asyncio.wait(tasks)
+                self._save_parts(path, size, segments)
+                raise
+            written = size
+            try:
+                os.remove(path + '.parts')
+            except OSError:
+                pass
+
+        if md5 and await asyncio.to_thread(file_md5, path) != md5:
+            os.remove(path)
+            raise DownloadError(f"{url}: контрольная сумма не совпала")
+        return written
+
+    def part_path(self, key: str) -> str:
+        """Постоянный путь недокачанного файла по ключу"""
+        name = hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+        return os.path.join(self.download_dir, name + '.part')
+
+    async def fetch_bytes(self, url: str, md5: Optional[str] = None, key: Optional[str] = None) -> bytes:
+        """
+        Скачивает файл и возвращает его содержимое
+
+        Args:
+            url: адрес файла
+            md5: ожидаемая контрольная сумма, если известна
+            key: постоянный ключ файла (id трека и качество); по умолчанию - url
+        """
+        path = self.part_path(key or url)
+        lock = self._locks.setdefault(path, asyncio.Lock())
+        self._waiting[path] = self._waiting.get(path, 0) + 1
+        try:
+            async with lock:
+                await asyncio.to_thread(self._prepare)
+                await self.fetch(url, path, md5)
+                try:
+                    return await asyncio.to_thread(_read_file, path)
+                finally:
+                    # Файл скачан целиком - больше не нужен; при ошибке он остаётся для докачки
+                    _remove(path)
+        finally:
+            self._waiting[path] -= 1
+            if not self._waiting[path]:
+                del self._waiting[path]
+                del self._locks[path]
+
+    def _prepare(self):
+        """Создаёт каталог скачиваний и не чаще раза в час удаляет брошенные недокачки"""
+        os.makedirs(self.download_dir, exist_ok=True)
+        now = time.time()
+        if now - self._cleaned_at < 3600:
+            return
+        self._cleaned_at = now
+        for name in os.listdir(self.download_dir):
+            path = os.path.join(self.download_dir, name)
+            try:
+                if now - os.path.getmtime(path) > self.max_age:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+def file_md5(path: str) -> str:
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _pwrite(path: str, data: bytes, offset: int):
+    # Свой дескриптор на каждую запись: запись в потоке может закончиться уже
+    # после отмены сегмента, и ей нельзя оставлять общий дескриптор, который
+    # к тому времени закрыт (или его номер занят другим файлом)
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        os.pwrite(fd, data, offset)
+    finally:
+        os.close(fd)
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
@@ -0,0 +1,161 @@
+"""
+Похожие треки - матрица совместных скачиваний и заранее посчитанные top-k соседей
+"""
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class CoDownloads:
+    """
+    Похожие треки по совместным скачиваниям: треки, которые скачивали одни
+    и те же пользователи, считаются похожими.
+
+    Скачивания пишутся в SQLite. Периодически (rebuild, в отдельном потоке)
+    по ним строится разреженная матрица совместных скачиваний и для каждого
+    трека сохраняются k лучших соседей по косинусной мере - так популярные
+    треки не становятся "похожими" на всё подряд. Соседи хранятся массивом
+    k столбцов, поиск при нажатии кнопки - словарь и срез строки, O(1).
+    """
+
+    def __init__(self, path: str, k: int = 10, per_user: int = 50, min_common: int = 2):
+        self.path = path
+        self.k = k
+        self.per_user = per_user
+        self.min_common = min_common
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+        # Результат последней пересборки: (id треков, id трека -> строка, соседи);
+        # заменяется целиком, чтобы поиск не увидел части разных пересборок
+        self._state: Tuple[List[str], Dict[str, int], np.ndarray] = ([], {}, np.empty((0, k), dtype=np.int32))
+        self.built_at: Optional[float] = None
+
+    def connect(self):
+        """Открывает базу и создаёт таблицу при необходимости"""
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS downloads ('
+            ' user_id INTEGER NOT NULL,'
+            ' track_id TEXT NOT NULL,'
+            ' ts REAL NOT NULL,'
+            ' PRIMARY KEY (user_id, track_id)'
+            ') WITHOUT ROWID'
+        )
+        self._conn.commit()
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    def add(self, user_id: int, track_ids: List[str]):
+        """Записывает скачивания пользователя (повторное скачивание обновляет время)"""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO downloads (user_id, track_id, ts) VALUES (?, ?, ?)',
+                [(user_id, track_id, now) for track_id in track_ids]
+            )
+            self._conn.commit()
+
+    async def record(self, user_id: int, track_ids: List[str]):
+        await asyncio.to_thread(self.add, user_id, track_ids)
+
+    def similar(self, track_id: str, limit: Optional[int] = None) -> List[str]:
+        """Похожие треки в порядке убывания сходства"""
+        track_ids, rows, neighbors = self._state
+        row = rows.get(track_id)
+        if row is None:
+            return []
+        ids = neighbors[row, :limit or self.k]
+        return [track_ids[i] for i in ids[ids >= 0]]
+
+    def __len__(self):
+        """Сколько треков имеют соседей"""
+        return int((self._state[2][:, 0] >= 0).sum())
+
+    def _load_pairs(self) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+        """Последние per_user скачиваний каждого пользователя: (пользователи, номера треков, id треков)"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT user_id, track_id FROM ('
+                ' SELECT user_id, track_id,'
+                '  ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY ts DESC) AS n'
+                ' FROM downloads'
+                ') WHERE n<=? ORDER BY user_id',
+                (self.per_user,)
+            ).fetchall()
+        index: Dict[str, int] = {}
+        users = np.fromiter((user_id for user_id, _ in rows), dtype=np.int64, count=len(rows))
+        tracks = np.fromiter((index.setdefault(track_id, len(index)) for _, track_id in rows),
+                             dtype=np.int64, count=len(rows))
+        return users, tracks, list(index)
+
+    def _build(self) -> Tuple[List[str], np.ndarray]:
+        users, tracks, track_ids = self._load_pairs()
+        n = len(track_ids)
+        neighbors = np.full((n, self.k), -1, dtype=np.int32)
+        if not n:
+            return track_ids, neighbors
+
+        # Пары треков внутри истории каждого пользователя (строки отсортированы по user_id)
+        bounds = np.flatnonzero(np.diff(users)) + 1
+        firsts, seconds = [], []
+        for items in np.split(tracks, bounds):
+            if len(items) < 2:
+                continue
+            a, b = np.triu_indices(len(items), 1)
+            firsts.append(items[a])
+            seconds.append(items[b])
+        if not firsts:
+            return track_ids, neighbors
+
+        # Разреженная симметричная матрица совместных скачиваний: (ключ пары, число пользователей)
+        a = np.concatenate(firsts + seconds)
+        b = np.concatenate(seconds + firsts)
+        keys, common = np.unique(a * n + b, return_counts=True)
+        left, right = keys // n, keys % n
+
+        keep = common >= self.min_common
+        left, right, common = left[keep], right[keep], common[keep]
+
+        # Косинусная мера: общие скачивания / sqrt(скачивания одного * скачивания другого)
+        counts = np.bincount(tracks, minlength=n)
+        score = common / np.sqrt(counts[left] * counts[right])
+
+        # Внутри каждой строки - по убыванию сходства; первые k пар строки - её соседи
+        order = np.lexsort((-score, left))
+        left, right = left[order], right[order]
+        starts = np.searchsorted(left, left, side='left')
+        rank = np.arange(len(left)) - starts
+        top = rank < self.k
+        neighbors[left[top], rank[top]] = right[top]
+        return track_ids, neighbors
+
+    def rebuild(self):
+        """Пересобирает соседей по текущей истории скачиваний"""
+        started = time.monotonic()
+        track_ids, neighbors = self._build()
+        self._state = (track_ids, {track_id: row for row, track_id in enumerate(track_ids)}, neighbors)
+        self.built_at = time.time()
+        logger.info("Похожие треки: %s треков, %s с соседями за %.2f сек",
+                    len(track_ids), len(self), time.monotonic() - started)
+
+    async def run(self, interval: float = 3600.0):
+        """Фоновая пересборка раз в interval секунд"""
+        while True:
+            try:
+                await asyncio.to_thread(self.rebuild)
+            except Exception as e:
+                logger.error("Ошибка пересборки похожих треков: %s", e, exc_info=True)
+            await asyncio.sleep(interval)
@@ -0,0 +1,104 @@
+"""
+Снимок индексов и кэшей на диске - быстрый холодный старт без пересборки
+"""
+import asyncio
+import logging
+import os
+import pickle
+import time
+import zlib
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Меняется при несовместимом изменении формата снимка
+SNAPSHOT_VERSION = 1
+
+# Части, восстановленные из файла и ещё не забранные владельцами: имя -> (ключ, состояние)
+_restored: Dict[str, Tuple[Any, Any]] = {}
+
+# Кто и как сохраняет свою часть: имя -> (ключ, функция состояния)
+_providers: Dict[str, Tuple[Any, Callable[[], Any]]] = {}
+
+
+def register(name: str, dump: Callable[[], Any], key: Any = None):
+    """
+    Регистрирует часть снимка
+
+    Args:
+        name: имя части
+        dump: функция, возвращающая состояние (вызывается при сохранении)
+        key: отпечаток исходных данных; при восстановлении часть с другим
+            ключом отбрасывается как устаревшая
+    """
+    _providers[name] = (key, dump)
+
+
+def take(name: str, key: Any = None) -> Optional[Any]:
+    """Забирает восстановленное состояние части (один раз); None, если его нет или оно устарело"""
+    saved = _restored.pop(name, None)
+    if saved is None:
+        return None
+    saved_key, state = saved
+    if saved_key != key:
+        logger.info("Снимок '%s' устарел, пересобираем", name)
+        return None
+    return state
+
+
+def _serialize() -> Tuple[bytes, int]:
+    parts = {}
+    for name, (key, dump) in _providers.items():
+        try:
+            parts[name] = (key, dump())
+        except Exception as e:
+            logger.error("Ошибка снимка '%s': %s", name, e)
+    # Невостребованные части прошлого снимка переносим как есть (их владелец ещё не загружался)
+    for name, saved in _restored.items():
+        parts.setdefault(name, saved)
+    return pickle.dumps((SNAPSHOT_VERSION, parts), protocol=pickle.HIGHEST_PROTOCOL), len(parts)
+
+
+def _write(path: str, raw: bytes) -> int:
+    data = zlib.compress(raw, 1)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return len(data)
+
+
+def save(path: str) -> int:
+    """Сохраняет все зарегистрированные части; возвращает размер файла"""
+    started = time.monotonic()
+    raw, count = _serialize()
+    size = _write(path, raw)
+    logger.info("Снимок сохранён: %s частей, %.1f КБ за %.3f сек", count, size / 1024, time.monotonic() - started)
+    return size
+
+
+async def save_async(path: str) -> int:
+    """
+    Сохранение без остановки event loop надолго: состояние сериализуется
+    в потоке loop (структуры не меняются во время чтения), сжатие и запись -
+    в отдельном потоке
+    """
+    raw, _ = _serialize()
+    return await asyncio.to_thread(_write, path, raw)
+
+
+def load(path: str) -> int:
+    """Читает снимок; возвращает число восстановленных частей"""
+    if not os.path.exists(path):
+        return 0
+    try:
+        with open(path, 'rb') as f:
+            version, parts = pickle.loads(zlib.decompress(f.read()))
+    except Exception as e:
+        logger.error("Ошибка чтения снимка: %s", e)
+        return 0
+    if version != SNAPSHOT_VERSION:
+        logger.info("Снимок другой версии (%s), пропускаем", version)
+        return 0
+    _restored.update(parts)
+    return len(parts)
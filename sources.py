@@ -0,0 +1,241 @@
+"""
+Реестр источников музыки - поиск и скачивание через circuit breaker каждого источника
+"""
+import asyncio
+import importlib
+import logging
+import time
+from typing import Callable, Dict, List, Optional
+
+from circuit_breaker import CircuitBreaker
+from quality import TrackTooLarge, pick_bitrate
+from track_filters import duration_seconds
+
+logger = logging.getLogger(__name__)
+
+
+class LazyDownloader:
+    """
+    Загрузчик, модуль которого импортируется при первом обращении.
+
+    Модули источников не грузятся при старте: бот начинает принимать
+    обновления раньше, а источник, которым никто не пользуется, не стоит ничего.
+    """
+
+    def __init__(self, module: str, attr: str):
+        self.module = module
+        self.attr = attr
+        self._instance = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._instance is not None
+
+    def _load(self):
+        if self._instance is None:
+            started = time.monotonic()
+            cls = getattr(importlib.import_module(self.module), self.attr)
+            self._instance = cls()
+            logger.info("Источник %s загружен за %.3f сек", self.module, time.monotonic() - started)
+        return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    async def close(self):
+        # Незагруженный загрузчик закрывать нечего
+        if self._instance is not None:
+            await self._instance.close()
+
+
+class MusicSource:
+    """Зарегистрированный источник: загрузчик + его circuit breaker"""
+
+    def __init__(self, name: str, title: str, emoji: str, downloader, timeout: float = 10.0,
+                 known_tracks: Optional[Callable[[], List[Dict[str, str]]]] = None):
+        self.name = name
+        self.title = title
+        self.emoji = emoji
+        self.downloader = downloader
+        self.timeout = timeout
+        # Треки локальной базы источника - без загрузки модуля загрузчика
+        self.known_tracks = known_tracks
+        self.breaker = CircuitBreaker(name)
+
+
+class SourceRegistry:
+    """Источники в порядке приоритета; сбоящие источники пропускаются без ожидания"""
+
+    def __init__(self, probe_interval: float = 15.0, health_interval: float = 120.0,
+                 max_bytes: Optional[int] = None):
+        self.sources: Dict[str, MusicSource] = {}
+        # Наибольший размер файла: качество выбирается так, чтобы трек в него уложился
+        self.max_bytes = max_bytes
+        # Как часто проверяем отключённые источники и как часто - здоровые
+        self.probe_interval = probe_interval
+        self.health_interval = health_interval
+
+    def register(self, name: str, title: str, emoji: str, downloader, timeout: float = 10.0,
+                 known_tracks: Optional[Callable[[], List[Dict[str, str]]]] = None):
+        self.sources[name] = MusicSource(name, title, emoji, downloader, timeout, known_tracks)
+
+    def known_tracks(self) -> List[Dict[str, str]]:
+        """Треки локальных баз источников; незагруженные загрузчики не импортируются"""
+        tracks = []
+        for source in self.sources.values():
+            if source.known_tracks is not None:
+                tracks.extend(source.known_tracks())
+        return tracks
+
+    async def _call(self, source: MusicSource, coro):
+        """Выполняет вызов источника, учитывая результат в его breaker'е"""
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(coro, timeout=source.timeout)
+        except asyncio.CancelledError:
+            source.breaker.trial_in_flight = False
+            raise
+        except Exception as e:
+            source.breaker.record_failure(e)
+            raise
+        source.breaker.record_success(time.monotonic() - started)
+        return result
+
+    async def search(self, query: str, limit: int = 10) -> List[Dict[str, str]]:
+        """
+        Поиск по источникам в порядке приоритета
+
+        Returns:
+            Результаты первого доступного источника, который что-то нашёл
+        """
+        for source in self.sources.values():
+            if not source.breaker.allow():
+                logger.debug("Источник %s отключён, пропускаем", source.name)
+                continue
+            try:
+                tracks = await self._call(source, source.downloader.search(query, limit=limit))
+            except Exception as e:
+                logger.error("Ошибка поиска в источнике %s: %s", source.name, e)
+                continue
+            if tracks:
+                return tracks
+        return []
+
+    async def pick_bitrate(self, source: MusicSource, track: Dict[str, str]) -> Optional[int]:
+        """
+        Битрейт для скачивания: наибольший, при котором оценка размера
+        (длительность x битрейт) укладывается в max_bytes
+
+        Raises:
+            TrackTooLarge: трек не уложится в лимит ни в одном качестве
+        """
+        get_bitrates = getattr(source.downloader, 'get_bitrates', None)
+        if not self.max_bytes or get_bitrates is None:
+            return None
+        bitrates = await get_bitrates(track['url'])
+        return pick_bitrate(bitrates, duration_seconds(track.get('duration')), self.max_bytes)
+
+    async def resolve(self, tracks: List[Dict[str, str]]):
+        """
+        Заранее получает ссылки на скачивание треков, параллельно по
+        источникам, пока ещё ничего не качается. Как именно - решает
+        источник: VK отдаёт ссылки пачкой (audio.getById), у Яндекса
+        запросы идут на каждый трек. Ошибки только логируются - скачивание
+        трека получит ссылку само.
+        """
+        groups: Dict[str, List[Dict[str, str]]] = {}
+        for track in tracks:
+            groups.setdefault(track.get('source'), []).append(track)
+
+        async def resolve_source(source: MusicSource, group: List[Dict[str, str]]):
+            try:
+                resolve_urls = getattr(source.downloader, 'resolve_urls', None)
+                if resolve_urls is None:
+                    return
+                picked = await asyncio.gather(*(self.pick_bitrate(source, track) for track in group),
+                                              return_exceptions=True)
+                # Треки, которые не уложатся в лимит, не разрешаем - их скачивание не начнётся
+                bitrates = {track['url']: bitrate for track, bitrate in zip(group, picked)
+                            if not isinstance(bitrate, BaseException)}
+                if bitrates:
+                    await resolve_urls(list(bitrates), bitrates)
+            except Exception as e:
+                logger.warning("Не удалось заранее получить ссылки источника %s: %s", source.name, e)
+
+        await asyncio.gather(*(resolve_source(self.sources[name], group)
+                               for name, group in groups.items() if name in self.sources))
+
+    async def download(self, track: Dict[str, str]) -> Optional[bytes]:
+        """
+        Скачивание трека из его источника
+
+        Raises:
+            TrackTooLarge: трек не уложится в лимит отправки - скачивание не начинается
+        """
+        source = self.sources.get(track.get('source'))
+        if source is None:
+            logger.error("Неизвестный источник трека: %s", track.get('source'))
+            return None
+        if not source.breaker.allow():
+            logger.warning("Источник %s отключён, скачивание отклонено", source.name)
+            return None
+
+        started = time.monotonic()
+        try:
+            bitrate = await self.pick_bitrate(source, track)
+            audio_data = await source.downloader.download_track(track['url'], bitrate=bitrate)
+        except asyncio.CancelledError:
+            source.breaker.trial_in_flight = False
+            raise
+        except TrackTooLarge:
+            # Источник ответил - это не сбой
+            source.breaker.record_success(time.monotonic() - started)
+            raise
+        except Exception as e:
+            source.breaker.record_failure(e)
+            raise
+
+        if audio_data:
+            source.breaker.record_success(time.monotonic() - started)
+        else:
+            source.breaker.record_failure(RuntimeError('пустой ответ при скачивании'))
+        return audio_data
+
+    async def probe(self, source: MusicSource):
+        """Пробный поиск для проверки доступности источника"""
+        try:
+            await self._call(source, source.downloader.search('test', limit=1))
+        except Exception as e:
+            logger.debug("Проба источника %s не прошла: %s", source.name, e)
+
+    async def run_probes(self):
+        """Фоновая проверка источников: отключённые - часто, здоровые - изредка"""
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            now = time.time()
+            for source in self.sources.values():
+                # Незагруженный источник ещё никто не использовал - проверять нечего,
+                # а проверка импортировала бы его модуль (LazyDownloader)
+                if not getattr(source.downloader, 'loaded', True):
+                    continue
+                breaker = source.breaker
+                stale = breaker.last_check is None or now - breaker.last_check >= self.health_interval
+                if breaker.state != CircuitBreaker.CLOSED or stale:
+                    await self.probe(source)
+
+    def status(self) -> List[dict]:
+        """Закэшированное состояние источников (без живых запросов)"""
+        result = []
+        for source in self.sources.values():
+            info = source.breaker.snapshot()
+            info.update(name=source.name, title=source.title, emoji=source.emoji)
+            result.append(info)
+        return result
+
+    async def close(self):
+        """Закрытие сессий всех источников"""
+        for source in self.sources.values():
+            try:
+                await source.downloader.close()
+            except Exception as e:
+                logger.error("Ошибка закрытия источника %s: %s", source.name, e)
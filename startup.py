@@ -0,0 +1,61 @@
+"""
+Замер холодного старта: длительность фаз запуска и время до первого ответа
+"""
+import logging
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+    """
+    Отсчёт идёт от создания объекта - его создают до тяжёлых импортов.
+
+    first_update подключается как outer middleware на dp.update и отмечает
+    момент, когда обработано первое обновление после запуска.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self._last = self.started
+        self.phases: List[Tuple[str, float]] = []
+        self.ready: Optional[float] = None
+        self.first_reply: Optional[float] = None
+
+    def mark(self, name: str):
+        """Закрывает фазу, начавшуюся с предыдущей отметки"""
+        now = time.monotonic()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    @contextmanager
+    def phase(self, name: str):
+        self._last = time.monotonic()
+        try:
+            yield
+        finally:
+            self.mark(name)
+
+    def mark_ready(self):
+        self.ready = time.monotonic() - self.started
+        logger.info("Запуск за %.2f сек: %s", self.ready, self.summary())
+
+    def summary(self) -> str:
+        return ', '.join(f"{name} {seconds * 1000:.0f} мс" for name, seconds in self.phases)
+
+    async def first_update(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        if self.first_reply is not None:
+            return await handler(event, data)
+        try:
+            return await handler(event, data)
+        finally:
+            if self.first_reply is None:
+                self.first_reply = time.monotonic() - self.started
+                logger.info("Первый ответ через %.2f сек после запуска", self.first_reply)
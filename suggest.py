@@ -0,0 +1,157 @@
+"""
+Подсказки запросов - префиксное дерево с заранее посчитанными top-k дополнениями
+"""
+import logging
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+from search_index import normalize
+
+logger = logging.getLogger(__name__)
+
+
+class _Node:
+    __slots__ = ('children', 'top')
+
+    def __init__(self):
+        self.children: Dict[str, '_Node'] = {}
+        # Лучшие дополнения этого префикса: [(вес, текст)] по убыванию веса
+        self.top: List[Tuple[float, str]] = []
+
+
+class SuggestionTrie:
+    """
+    Префиксное дерево по нормализованным строкам.
+
+    В каждом узле хранится top-k дополнений, поэтому поиск стоит
+    O(длина префикса) и не зависит от размера словаря.
+
+    Размер ограничен: при превышении max_keys строк или max_nodes узлов
+    дерево пересобирается из самых весомых строк (остаётся prune_ratio от
+    лимита), строки длиннее max_length не добавляются.
+    """
+
+    def __init__(self, k: int = 5, max_keys: int = 50000, max_nodes: int = 1000000,
+                 max_length: int = 80, prune_ratio: float = 0.75):
+        self.k = k
+        self.max_keys = max_keys
+        self.max_nodes = max_nodes
+        self.max_length = max_length
+        self.prune_ratio = prune_ratio
+        self.root = _Node()
+        self.nodes = 1
+        self.weights: Dict[str, float] = {}
+        # Нормализованная форма -> текст для показа пользователю
+        self.display: Dict[str, str] = {}
+
+    def __len__(self):
+        return len(self.weights)
+
+    def to_state(self) -> tuple:
+        """
+        Плоское состояние для снимка: узлы в порядке обхода, для каждого -
+        номер родителя, символ ребра и top-k (вложенные объекты pickle
+        восстанавливает в разы медленнее)
+        """
+        parents = array('I', [0])
+        chars = []
+        tops = [self.root.top]
+        stack = [(0, self.root)]
+        while stack:
+            index, node = stack.pop()
+            for char, child in node.children.items():
+                parents.append(index)
+                chars.append(char)
+                tops.append(child.top)
+                stack.append((len(tops) - 1, child))
+        return self.k, self.weights, self.display, parents.tobytes(), ''.join(chars), tops
+
+    def load_state(self, state: tuple):
+        """Восстанавливает дерево из снимка без пересчёта top-k"""
+        self.k, self.weights, self.display, parents, chars, tops = state
+        parents = array('I', parents)
+        nodes = [_Node() for _ in range(len(tops))]
+        for node, top in zip(nodes, tops):
+            node.top = top
+        # У корня нет ребра: символ узла index - chars[index - 1]
+        for index in range(1, len(nodes)):
+            nodes[parents[index]].children[chars[index - 1]] = nodes[index]
+        self.root = nodes[0]
+        self.nodes = len(nodes)
+
+    def add(self, text: str, weight: float = 1.0):
+        """Добавляет строку или увеличивает её вес"""
+        key = normalize(text)
+        if not key or len(key) > self.max_length:
+            return
+        self.display.setdefault(key, text)
+        total = self.weights.get(key, 0.0) + weight
+        self.weights[key] = total
+        self._insert(key, total)
+
+        if len(self.weights) > self.max_keys or self.nodes > self.max_nodes:
+            self.prune()
+
+    def _insert(self, key: str, weight: float):
+        node = self.root
+        self._update_top(node, key, weight)
+        for char in key:
+            child = node.children.get(char)
+            if child is None:
+                child = node.children[char] = _Node()
+                self.nodes += 1
+            node = child
+            self._update_top(node, key, weight)
+
+    def prune(self):
+        """Оставляет самые весомые строки и пересобирает дерево"""
+        keep_keys = int(self.max_keys * self.prune_ratio)
+        keep_nodes = int(self.max_nodes * self.prune_ratio)
+        kept: Dict[str, float] = {}
+        nodes = 0
+        # При равном весе остаются более новые строки (сортировка устойчивая)
+        for key, weight in sorted(reversed(self.weights.items()), key=lambda item: -item[1]):
+            # Оценка сверху: каждая строка - не больше len(key) новых узлов
+            if len(kept) >= keep_keys or nodes + len(key) > keep_nodes:
+                break
+            kept[key] = weight
+            nodes += len(key)
+
+        dropped = len(self.weights) - len(kept)
+        self.weights = kept
+        self.display = {key: self.display[key] for key in kept}
+        self.root = _Node()
+        self.nodes = 1
+        for key, weight in kept.items():
+            self._insert(key, weight)
+        logger.info("Подсказки: удалено %s строк с наименьшим весом, осталось %s (%s узлов)",
+                    dropped, len(kept), self.nodes)
+
+    def _update_top(self, node: _Node, key: str, weight: float):
+        top = [item for item in node.top if item[1] != key]
+        if len(top) >= self.k and weight <= top[-1][0]:
+            return
+        top.append((weight, key))
+        top.sort(key=lambda item: (-item[0], item[1]))
+        node.top = top[:self.k]
+
+    def suggest(self, prefix: str, limit: Optional[int] = None, min_prefix: int = 3) -> List[str]:
+        """
+        Лучшие дополнения префикса (в исходном написании)
+
+        Если префикс целиком не найден (например, опечатка в конце),
+        используется самый длинный найденный префикс не короче min_prefix.
+        """
+        key = normalize(prefix)
+        node = self.root
+        depth = 0
+        for char in key:
+            child = node.children.get(char)
+            if child is None:
+                break
+            node = child
+            depth += 1
+
+        if depth < len(key) and depth < min_prefix:
+            return []
+        return [self.display[item] for _, item in node.top[:limit or self.k] if item != key]
@@ -0,0 +1,110 @@
+"""
+ID3-теги скачанных треков - запись в пуле процессов, готовые файлы кэшируются по id трека
+"""
+import asyncio
+import logging
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional
+
+from prefetch import AudioCache
+
+logger = logging.getLogger(__name__)
+
+
+def _syncsafe(size: int) -> bytes:
+    """Размер тега ID3v2: 4 байта по 7 значащих бит"""
+    return bytes(((size >> 21) & 0x7f, (size >> 14) & 0x7f, (size >> 7) & 0x7f, size & 0x7f))
+
+
+def _frame(frame_id: str, payload: bytes) -> bytes:
+    # ID3v2.3: размер кадра - обычное 32-битное число, флаги нулевые
+    return frame_id.encode('ascii') + struct.pack('>I', len(payload)) + b'\x00\x00' + payload
+
+
+def _text_frame(frame_id: str, text: str) -> bytes:
+    # Кодировка 1 - UTF-16 с BOM (UTF-8 в ID3v2.3 не предусмотрен)
+    return _frame(frame_id, b'\x01' + text.encode('utf-16') + b'\x00\x00')
+
+
+def build_tag(title: str, artist: str, album: Optional[str] = None, cover: Optional[bytes] = None) -> bytes:
+    """Тег ID3v2.3 с названием, исполнителем, альбомом и обложкой (JPEG)"""
+    frames = [_text_frame('TIT2', title), _text_frame('TPE1', artist)]
+    if album:
+        frames.append(_text_frame('TALB', album))
+    if cover:
+        # Кодировка описания, MIME, тип картинки 3 (обложка альбома), пустое описание, данные
+        frames.append(_frame('APIC', b'\x00image/jpeg\x00\x03\x00' + cover))
+    body = b''.join(frames)
+    return b'ID3\x03\x00\x00' + _syncsafe(len(body)) + body
+
+
+def strip_tags(audio: bytes) -> bytes:
+    """Убирает существующие теги ID3v2 (в начале) и ID3v1 (последние 128 байт)"""
+    start = 0
+    while audio[start:start + 3] == b'ID3' and len(audio) >= start + 10:
+        size = 0
+        for byte in audio[start + 6:start + 10]:
+            size = (size << 7) | (byte & 0x7f)
+        # Флаг footer добавляет ещё 10 байт
+        start += 10 + size + (10 if audio[start + 5] & 0x10 else 0)
+    end = len(audio)
+    if end - start >= 128 and audio[end - 128:end - 125] == b'TAG':
+        end -= 128
+    return audio[start:end]
+
+
+def tag_audio(audio: bytes, title: str, artist: str, album: Optional[str] = None,
+              cover: Optional[bytes] = None) -> bytes:
+    """mp3 с новым тегом вместо прежних (выполняется в процессе пула)"""
+    return build_tag(title, artist, album, cover) + strip_tags(audio)
+
+
+class Tagger:
+    """
+    Запись тегов в пуле процессов: сборка и копирование многомегабайтного
+    файла не занимают event loop и не держат GIL основного процесса.
+
+    Готовый файл кэшируется по id трека (в памяти, с ограничением по
+    размеру) - повторная отправка трека не скачивает и не тегирует его снова.
+    Пул создаётся при первом использовании.
+    """
+
+    def __init__(self, workers: int = 2, max_bytes: int = 128 * 1024 * 1024):
+        self.workers = workers
+        self.cache = AudioCache(max_bytes=max_bytes)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.stats = {'tagged': 0, 'cached': 0, 'failed': 0}
+
+    def cached(self, track_id: str) -> Optional[bytes]:
+        """Уже тегированный файл трека"""
+        audio = self.cache.get(track_id)
+        if audio is not None:
+            self.stats['cached'] += 1
+        return audio
+
+    async def tag(self, track: Dict[str, str], audio: bytes, cover: Optional[bytes] = None) -> bytes:
+        """
+        Записывает теги трека в аудио
+
+        Returns:
+            Тегированный файл; при ошибке - исходные байты (отправка важнее тегов)
+        """
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            tagged = await asyncio.get_running_loop().run_in_executor(
+                self._pool, tag_audio, audio, track['title'], track['artist'], track.get('album'), cover
+            )
+        except Exception as e:
+            self.stats['failed'] += 1
+            logger.error("Ошибка записи тегов трека '%s': %s", track['title'], e)
+            return audio
+        self.stats['tagged'] += 1
+        self.cache.put(track['id'], tagged)
+        return tagged
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
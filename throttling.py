@@ -0,0 +1,113 @@
+"""
+Ограничение частоты запросов пользователей - middleware с token bucket на пользователя
+"""
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, InlineQuery, Message, TelegramObject
+
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Вид запроса -> (токенов в секунду, запас)
+DEFAULT_LIMITS = {
+    'search': (1 / 3, 5),      # текстовые сообщения = поиск
+    'command': (0.5, 5),
+    'download': (1 / 10, 3),   # скачивание трека или страницы
+    'callback': (2.0, 10),     # листание страниц, подсказки, отмена
+    'inline': (2.0, 10),
+}
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Outer middleware: лишние обновления отбрасываются до фильтров и обработчиков.
+
+    Бакеты хранятся по (пользователь, вид запроса) и удаляются после простоя;
+    о превышении лимита пользователь узнаёт не чаще раза в notice_window секунд.
+    """
+
+    def __init__(
+        self,
+        limits: Optional[Dict[str, Tuple[float, float]]] = None,
+        idle_ttl: float = 600.0,
+        notice_window: float = 10.0,
+    ):
+        self.limits = limits or DEFAULT_LIMITS
+        self.idle_ttl = idle_ttl
+        self.notice_window = notice_window
+
+        self.buckets: Dict[Tuple[int, str], TokenBucket] = {}
+        self.notified: Dict[Tuple[int, str], float] = {}
+        self.next_sweep = time.monotonic() + idle_ttl
+        self.throttled = 0
+
+    @staticmethod
+    def classify(event: TelegramObject) -> Optional[str]:
+        if isinstance(event, Message):
+            if event.text and event.text.startswith('/'):
+                return 'command'
+            return 'search'
+        if isinstance(event, CallbackQuery):
+            if event.data and event.data.startswith(('download_', 'bulk_')):
+                return 'download'
+            return 'callback'
+        if isinstance(event, InlineQuery):
+            return 'inline'
+        return None
+
+    def _sweep(self, now: float):
+        """Удаляет бакеты пользователей, которые давно ничего не присылали"""
+        stale = [key for key, bucket in self.buckets.items() if now - bucket.updated > self.idle_ttl]
+        for key in stale:
+            del self.buckets[key]
+        for key, until in list(self.notified.items()):
+            if until <= now:
+                del self.notified[key]
+        self.next_sweep = now + self.idle_ttl
+
+    def _allow(self, key: Tuple[int, str], now: float) -> bool:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            rate, burst = self.limits[key[1]]
+            bucket = self.buckets[key] = TokenBucket(rate, burst)
+        return bucket.consume(now)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        kind = self.classify(event)
+        user = data.get('event_from_user')
+        if kind is None or user is None or kind not in self.limits:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        if now >= self.next_sweep:
+            self._sweep(now)
+
+        key = (user.id, kind)
+        if self._allow(key, now):
+            return await handler(event, data)
+
+        self.throttled += 1
+        notify = self.notified.get(key, 0.0) <= now
+        if notify:
+            self.notified[key] = now + self.notice_window
+            logger.warning("Пользователь %s превысил лимит '%s'", user.id, kind)
+
+        text = "⏳ Слишком много запросов, подожди немного" if notify else None
+        try:
+            if isinstance(event, CallbackQuery):
+                # На callback нужно ответить в любом случае, иначе кнопка "зависнет"
+                await event.answer(text)
+            elif isinstance(event, Message) and notify:
+                await event.answer(text)
+        except Exception as e:
+            logger.debug("Не удалось уведомить о лимите: %s", e)
+        return None
@@ -0,0 +1,125 @@
+"""
+Каталог треков - стабильные идентификаторы и постоянное хранилище метаданных (SQLite)
+"""
+import asyncio
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_NON_WORD = re.compile(r'[^\w]+', re.UNICODE)
+
+# Поля трека, которые хранятся в каталоге
+TRACK_FIELDS = ('id', 'source', 'url', 'title', 'artist', 'album', 'duration', 'cover')
+
+
+def canonical(text: Optional[str]) -> str:
+    """Каноническая форма строки: регистр, ё/е, пунктуация и пробелы не важны"""
+    if not text:
+        return ''
+    text = unicodedata.normalize('NFKC', text).casefold().replace('ё', 'е')
+    return ' '.join(_NON_WORD.sub(' ', text).split())
+
+
+def make_track_id(source: str, artist: str, title: str, album: Optional[str] = None) -> str:
+    """
+    Детерминированный идентификатор трека
+
+    Не зависит от запроса, позиции в выдаче и перезапусков процесса;
+    80 бит blake2b делают коллизии практически невозможными.
+    Подходит для callback_data, id inline-результатов и deep link.
+    """
+    key = '\x1f'.join((source, canonical(artist), canonical(title), canonical(album)))
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=10).hexdigest()
+    return f"{source}_{digest}"
+
+
+class TrackCatalog:
+    """Постоянный каталог треков: результаты поиска пишутся сюда, скачивание читает отсюда"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """Открывает базу и создаёт таблицу при необходимости"""
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS tracks ('
+            ' id TEXT PRIMARY KEY,'
+            ' source TEXT NOT NULL,'
+            ' url TEXT NOT NULL,'
+            ' title TEXT NOT NULL,'
+            ' artist TEXT NOT NULL,'
+            ' album TEXT,'
+            ' duration TEXT,'
+            ' cover TEXT,'
+            ' updated_at REAL NOT NULL'
+            ')'
+        )
+        # Базы, созданные до появления обложек
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(tracks)')}
+        if 'cover' not in columns:
+            self._conn.execute('ALTER TABLE tracks ADD COLUMN cover TEXT')
+        self._conn.commit()
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    def upsert_many(self, tracks: Iterable[Dict[str, str]]):
+        rows = [
+            tuple(track.get(field) for field in TRACK_FIELDS) + (time.time(),)
+            for track in tracks
+        ]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany(
+                'INSERT INTO tracks (id, source, url, title, artist, album, duration, cover, updated_at)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+                ' ON CONFLICT(id) DO UPDATE SET'
+                ' url=excluded.url, title=excluded.title, artist=excluded.artist,'
+                ' album=excluded.album, duration=excluded.duration,'
+                ' cover=COALESCE(excluded.cover, cover), updated_at=excluded.updated_at',
+                rows
+            )
+            self._conn.commit()
+
+    def get_many(self, track_ids: List[str]) -> List[Dict[str, str]]:
+        """Треки по id в том же порядке; отсутствующие пропускаются"""
+        if not track_ids:
+            return []
+        placeholders = ','.join('?' * len(track_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT {", ".join(TRACK_FIELDS)} FROM tracks WHERE id IN ({placeholders})',
+                track_ids
+            ).fetchall()
+        found = {row[0]: dict(zip(TRACK_FIELDS, row)) for row in rows}
+        return [found[track_id] for track_id in track_ids if track_id in found]
+
+    def get(self, track_id: str) -> Optional[Dict[str, str]]:
+        tracks = self.get_many([track_id])
+        return tracks[0] if tracks else None
+
+    # Асинхронные обёртки: запросы к SQLite выполняются вне event loop
+
+    async def add(self, tracks: List[Dict[str, str]]):
+        await asyncio.to_thread(self.upsert_many, tracks)
+
+    async def fetch_many(self, track_ids: List[str]) -> List[Dict[str, str]]:
+        return await asyncio.to_thread(self.get_many, track_ids)
+
+    async def fetch(self, track_id: str) -> Optional[Dict[str, str]]:
+        return await asyncio.to_thread(self.get, track_id)
@@ -0,0 +1,152 @@
+"""
+Фильтры поиска (artist:face dur:<180) над колоночным представлением каталога треков
+"""
+import logging
+import re
+import shlex
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from track_catalog import canonical
+
+logger = logging.getLogger(__name__)
+
+# Поле фильтра -> синонимы в запросе
+FIELD_ALIASES = {
+    'artist': ('artist', 'a', 'исполнитель'),
+    'album': ('album', 'альбом'),
+    'title': ('title', 't', 'название'),
+    'dur': ('dur', 'duration', 'длительность', 'длит'),
+}
+_FIELDS = {alias: field for field, aliases in FIELD_ALIASES.items() for alias in aliases}
+
+_DURATION = re.compile(r'^(<=|>=|<|>|=)?(\d+(?::\d{1,2})?)(?:-(\d+(?::\d{1,2})?))?$')
+
+# Фильтр: (поле, значение); для dur значение - (минимум, максимум) в секундах включительно
+Filter = Tuple[str, Any]
+
+
+def duration_seconds(text: Optional[str]) -> int:
+    """'3:24' -> 204, '180' -> 180; неизвестная длительность -> -1"""
+    if not text:
+        return -1
+    try:
+        if ':' in text:
+            minutes, seconds = text.split(':', 1)
+            return int(minutes) * 60 + int(seconds)
+        return int(text)
+    except ValueError:
+        return -1
+
+
+def _parse_duration(value: str) -> Optional[Tuple[int, int]]:
+    match = _DURATION.match(value)
+    if not match:
+        return None
+    op, low, high = match.groups()
+    low = duration_seconds(low)
+    if high is not None:
+        return low, duration_seconds(high)
+    if op == '<':
+        return 0, low - 1
+    if op == '<=':
+        return 0, low
+    if op == '>':
+        return low + 1, 1 << 30
+    if op == '>=':
+        return low, 1 << 30
+    return low, low
+
+
+def parse_query(query: str) -> Tuple[str, List[Filter]]:
+    """
+    Разделяет запрос на текст и фильтры
+
+    Поддерживается artist:, album:, title: (подстрока, значение можно взять
+    в кавычки) и dur: (<180, >=2:30, 120-200, =3:00). Нераспознанные
+    конструкции остаются частью текста.
+    """
+    try:
+        tokens = shlex.split(query)
+    except ValueError:
+        tokens = query.split()
+
+    words = []
+    filters: List[Filter] = []
+    for token in tokens:
+        key, sep, value = token.partition(':')
+        field = _FIELDS.get(key.lower()) if sep and value else None
+        if field == 'dur':
+            bounds = _parse_duration(value)
+            if bounds is not None:
+                filters.append(('dur', bounds))
+                continue
+        elif field is not None and canonical(value):
+            filters.append((field, canonical(value)))
+            continue
+        words.append(token)
+    return ' '.join(words), filters
+
+
+class TrackColumns:
+    """
+    Колоночное представление треков: длительность в секундах (int32),
+    исполнитель и альбом - номера в словаре уникальных значений.
+
+    Фильтр по исполнителю или альбому сначала проверяет словарь (он намного
+    меньше каталога), затем одной выборкой по массиву номеров строит маску
+    строк. Все фильтры запроса - логическое И масок.
+    """
+
+    def __init__(self, tracks: Sequence[Dict[str, str]]):
+        self.tracks = list(tracks)
+        self.duration = np.fromiter(
+            (duration_seconds(track.get('duration')) for track in self.tracks),
+            dtype=np.int32, count=len(self.tracks)
+        )
+        self.vocab: Dict[str, List[str]] = {}
+        self.ids: Dict[str, np.ndarray] = {}
+        for field in ('artist', 'album'):
+            self.vocab[field], self.ids[field] = self._intern(track.get(field) for track in self.tracks)
+        # Названия уникальны почти для каждой строки - ищем по ним в numpy-массиве строк
+        self.titles = np.array([canonical(track.get('title')) for track in self.tracks], dtype=str)
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def _intern(self, values) -> Tuple[List[str], np.ndarray]:
+        index: Dict[str, int] = {}
+        ids = np.fromiter(
+            (index.setdefault(value, len(index)) for value in map(canonical, values)),
+            dtype=np.int32, count=len(self.tracks)
+        )
+        # Словарь сохраняет порядок вставки - он же порядок номеров
+        return list(index), ids
+
+    def mask(self, filters: List[Filter]) -> np.ndarray:
+        """Булева маска строк, подходящих под все фильтры"""
+        mask = np.ones(len(self.tracks), dtype=bool)
+        for field, value in filters:
+            if field == 'dur':
+                low, high = value
+                mask &= (self.duration >= low) & (self.duration <= high)
+            elif field == 'title':
+                mask &= np.char.find(self.titles, value) >= 0
+            else:
+                allowed = np.fromiter((value in item for item in self.vocab[field]),
+                                      dtype=bool, count=len(self.vocab[field]))
+                mask &= allowed[self.ids[field]]
+        return mask
+
+    def select(self, filters: List[Filter], limit: int) -> List[Dict[str, str]]:
+        """Первые limit треков, подходящих под фильтры"""
+        rows = np.flatnonzero(self.mask(filters))[:limit]
+        return [self.tracks[row] for row in rows]
+
+
+def filter_tracks(tracks: List[Dict[str, str]], filters: List[Filter]) -> List[Dict[str, str]]:
+    """Фильтрует готовый список треков (например, ответ API)"""
+    if not filters or not tracks:
+        return tracks
+    return TrackColumns(tracks).select(filters, len(tracks))
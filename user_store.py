@@ -0,0 +1,103 @@
+"""
+Потоковое чтение users_stats.json - пользователи по одному, без загрузки всего файла
+(рассылка, выгрузка для админа)
+"""
+import csv
+import gzip
+import json
+import os
+from typing import Dict, Iterator, Optional
+
+_decoder = json.JSONDecoder()
+
+
+def iter_users(path: str, chunk_size: int = 64 * 1024) -> Iterator[Dict]:
+    """
+    Перебирает записи массива "users" файла статистики
+
+    Файл читается кусками по chunk_size, в памяти держится только текущий
+    кусок и недочитанная запись. save_stats заменяет файл атомарно, поэтому
+    открытый файл дочитывается в той версии, что была при открытии.
+
+    Raises:
+        ValueError: файл кончился посреди массива (обрезан) - иначе
+            обрезанный файл выглядел бы как короткий список пользователей
+    """
+    if not os.path.exists(path):
+        return
+
+    with open(path, 'r', encoding='utf-8') as f:
+        buf = ''
+
+        # Ищем начало массива пользователей
+        while True:
+            start = buf.find('[')
+            if start >= 0:
+                buf = buf[start + 1:]
+                break
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            buf += chunk
+
+        while True:
+            buf = buf.lstrip(' \t\r\n,')
+            if buf.startswith(']'):
+                return
+            if buf:
+                try:
+                    user, end = _decoder.raw_decode(buf)
+                except json.JSONDecodeError:
+                    pass
+                else:
+                    yield user
+                    buf = buf[end:]
+                    continue
+
+            # Запись не поместилась в буфер - дочитываем
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise ValueError(f"{path}: файл обрезан, список пользователей не закрыт")
+            buf += chunk
+
+
+# Поля записи пользователя в выгрузке
+EXPORT_FIELDS = ('user_id', 'username', 'first_name', 'joined', 'last_seen')
+
+
+def export_users(path: str, out_path: str, fmt: str = 'csv', joined_since: Optional[str] = None,
+                 active_since: Optional[str] = None) -> int:
+    """
+    Выгружает пользователей в сжатый gzip файл CSV или JSONL
+
+    Пользователи читаются и пишутся по одному (iter_users), память не зависит
+    от размера базы. Фильтры - ISO-даты: даты в статистике в том же формате,
+    поэтому сравниваются как строки.
+
+    Args:
+        path: файл статистики
+        out_path: файл выгрузки
+        fmt: 'csv' или 'jsonl'
+        joined_since: только присоединившиеся не раньше этой даты
+        active_since: только заходившие не раньше этой даты
+
+    Returns:
+        Количество выгруженных пользователей
+    """
+    count = 0
+    with gzip.open(out_path, 'wt', encoding='utf-8', newline='', compresslevel=6) as out:
+        if fmt == 'csv':
+            writer = csv.writer(out)
+            writer.writerow(EXPORT_FIELDS)
+        for user in iter_users(path):
+            if joined_since and (user.get('joined') or '') < joined_since:
+                continue
+            if active_since and (user.get('last_seen') or '') < active_since:
+                continue
+            if fmt == 'csv':
+                writer.writerow([user.get(field) for field in EXPORT_FIELDS])
+            else:
+                out.write(json.dumps({field: user.get(field) for field in EXPORT_FIELDS}, ensure_ascii=False))
+                out.write('\n')
+            count += 1
+    return count
@@ -3,12 +3,20 @@ VK Music downloader - поиск и скачивание музыки из VK
 """
 import asyncio
 import aiohttp
+import functools
 import logging
 import re
 import json
+import os
 from typing import List, Dict, Optional
 from urllib.parse import quote, unquote
 
+from caches import TTLCache
+from track_catalog import make_track_id
+from track_filters import filter_tracks, parse_query
+import http_pool
+from segmented_download import SegmentedDownloader
+
 logger = logging.getLogger(__name__)
 
 
@@ -20,6 +28,12 @@ class VKMusicDownloader:
         self.search_url = "https://vk.com/audio"
         self.session = None
         
+        # С токеном работаем через официальный API, без него - по локальной базе
+        token = os.getenv('VK_TOKEN')
+        self.api = VKMusicAPI(token, os.getenv('VK_API_URL')) if token else None
+        # Большие файлы качаем параллельными диапазонами с докачкой
+        self.fetcher = SegmentedDownloader()
+        
         # Заголовки для имитации браузера
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
@@ -34,16 +48,8 @@ class VKMusicDownloader:
         logger.info("VK Music downloader инициализирован")
     
     async def _get_session(self):
-        """Получение HTTP сессии"""
-        if not self.session:
-            connector = aiohttp.TCPConnector(ssl=False)
-            timeout = aiohttp.ClientTimeout(total=30)
-            self.session = aiohttp.ClientSession(
-                headers=self.headers,
-                connector=connector,
-                timeout=timeout
-            )
-        return self.session
+        """Получение HTTP сессии (общий пул соединений)"""
+        return http_pool.get_session()
     
     async def search(self, query: str, limit: int = 10) -> List[Dict[str, str]]:
         """
@@ -56,8 +62,17 @@ class VKMusicDownloader:
         Returns:
             Список словарей с информацией о треках
         """
+        # Фильтры (artist:, dur: ...) источник не понимает: ищем по тексту, фильтруем результат
+        text, filters = parse_query(query)
+        
+        if self.api:
+            # Ошибки API пробрасываем - их учитывает circuit breaker источника
+            tracks = filter_tracks(await self.api.search_audio(text or query, count=limit), filters)
+            logger.info("VK API вернул %s треков для запроса: %s", len(tracks), query, extra={'sample': 'search'})
+            return tracks
+        
         try:
-            logger.info(f"Поиск в VK Music: {query}")
+            logger.info("Поиск в VK Music: %s", query, extra={'sample': 'search'})
             
             # Используем альтернативный API для поиска музыки VK
             search_query = quote(query)
@@ -66,20 +81,20 @@ class VKMusicDownloader:
             tracks = []
             
             # Метод 1: Через публичные API
-            tracks.extend(await self._search_method_1(query, limit))
+            tracks.extend(await self._search_method_1(text or query, limit))
             
             # Метод 2: Через парсинг (если первый не сработал)
             if len(tracks) < limit:
-                tracks.extend(await self._search_method_2(query, limit - len(tracks)))
+                tracks.extend(await self._search_method_2(text or query, limit - len(tracks)))
             
             # Ограничиваем результат
-            tracks = tracks[:limit]
+            tracks = filter_tracks(tracks, filters)[:limit]
             
-            logger.info(f"VK Music поиск вернул {len(tracks)} треков для запроса: {query}")
+            logger.info("VK Music поиск вернул %s треков для запроса: %s", len(tracks), query, extra={'sample': 'search'})
             return tracks
             
         except Exception as e:
-            logger.error(f"Ошибка поиска в VK Music: {e}")
+            logger.error("Ошибка поиска в VK Music: %s", e)
             return []
     
     async def _search_method_1(self, query: str, limit: int) -> List[Dict[str, str]]:
@@ -92,7 +107,7 @@ class VKMusicDownloader:
             tracks.extend(realistic_tracks)
             
         except Exception as e:
-            logger.error(f"Ошибка в методе поиска 1: {e}")
+            logger.error("Ошибка в методе поиска 1: %s", e)
         
         return tracks
     
@@ -180,12 +195,14 @@ class VKMusicDownloader:
             ]
         
         # Конвертируем в нужный формат
-        for i, track in enumerate(found_tracks[:limit]):
+        for track in found_tracks[:limit]:
+            track_id = make_track_id('vk', track['artist'], track['title'])
             tracks.append({
+                'id': track_id,
                 'title': track['title'],
                 'artist': track['artist'],
                 'duration': track['duration'],
-                'url': f'vk_track_{i+1}_{abs(hash(query + track["title"])) % 10000}',
+                'url': track_id,
                 'source': 'vk'
             })
         
@@ -228,32 +245,52 @@ class VKMusicDownloader:
                 ]
             
             # Конвертируем в нужный формат
-            for i, track in enumerate(additional_variants[:limit]):
+            for track in additional_variants[:limit]:
+                track_id = make_track_id('vk', track['artist'], track['title'])
                 tracks.append({
+                    'id': track_id,
                     'title': track['title'],
                     'artist': track['artist'],
                     'duration': track['duration'],
-                    'url': f'vk_alt_{i+1}_{abs(hash(query + track["title"])) % 10000}',
+                    'url': track_id,
                     'source': 'vk'
                 })
             
         except Exception as e:
-            logger.error(f"Ошибка в методе поиска 2: {e}")
+            logger.error("Ошибка в методе поиска 2: %s", e)
         
         return tracks
     
-    async def download_track(self, url: str) -> Optional[bytes]:
+    async def get_bitrates(self, url: str) -> List[int]:
+        """Доступные битрейты трека (кбит/с): VK отдаёт один вариант mp3 до 320 кбит/с"""
+        return [320]
+    
+    async def resolve_urls(self, urls: List[str], bitrates: Dict[str, Optional[int]]):
+        """Заранее получает ссылки на скачивание пачки треков одним вызовом audio.getById"""
+        if self.api:
+            await self.api.get_audio_urls(urls)
+    
+    async def download_track(self, url: str, bitrate: Optional[int] = None) -> Optional[bytes]:
         """
         Скачивание трека из VK
         
         Args:
             url: URL или ID трека
+            bitrate: не используется - выбора качества у VK нет
             
         Returns:
             Байты аудио файла или None в случае ошибки
         """
+        if self.api:
+            audio_url = (await self.api.get_audio_urls([url])).get(url)
+            if not audio_url:
+                return None
+            audio = await self.fetcher.fetch_bytes(audio_url, key=f"vk:{url}")
+            logger.info("VK трек скачан через API: %s байт", len(audio))
+            return audio
+        
         try:
-            logger.info(f"Начало скачивания VK трека: {url}")
+            logger.info("Начало скачивания VK трека: %s", url)
             
             # Для демонстрации создаем фейковый аудио файл
             # В реальности здесь был бы запрос к VK API
@@ -262,17 +299,20 @@ class VKMusicDownloader:
             await asyncio.sleep(2)  # Имитация загрузки 2-3 секунды
             
             # Создаем минимальный MP3 заголовок (фейковый файл для теста)
-            fake_mp3_data = self._create_fake_mp3()
+            # (собирается один раз и вне event loop, дальше берётся из кэша)
+            fake_mp3_data = await asyncio.to_thread(self._create_fake_mp3)
             
-            logger.info(f"VK трек скачан успешно: {len(fake_mp3_data)} байт")
+            logger.info("VK трек скачан успешно: %s байт", len(fake_mp3_data))
             return fake_mp3_data
             
         except Exception as e:
-            logger.error(f"Ошибка скачивания VK трека: {e}")
+            logger.error("Ошибка скачивания VK трека: %s", e)
             return None
     
-    def _create_fake_mp3(self) -> bytes:
-        """Создает реалистичный MP3 файл для тестирования"""
+    @staticmethod
+    @functools.lru_cache(maxsize=1)
+    def _create_fake_mp3() -> bytes:
+        """Создает реалистичный MP3 файл для тестирования; результат детерминирован и кэшируется"""
         # Создаем более реалистичный MP3 файл (около 2-3 МБ)
         
         # MP3 заголовок для 128kbps, 44.1kHz, стерео
@@ -305,10 +345,8 @@ class VKMusicDownloader:
         return mp3_data
     
     async def close(self):
-        """Закрытие сессии"""
-        if self.session:
-            await self.session.close()
-            self.session = None
+        """Закрытие сессии (общий пул закрывается через http_pool.close_session)"""
+        self.session = None
     
     def _format_duration(self, seconds) -> str:
         """Форматирование длительности в минуты:секунды"""
@@ -324,22 +362,71 @@ class VKMusicDownloader:
             return "N/A"
 
 
-# Альтернативный класс для реального VK API (когда получим доступ)
+# Клиент официального VK API
 class VKMusicAPI:
     """Класс для работы с официальным VK API"""
     
-    def __init__(self, access_token: str = None):
+    _format_duration = VKMusicDownloader._format_duration
+    
+    def __init__(self, access_token: str = None, base_url: str = None, batch_size: int = 100):
         self.access_token = access_token
         self.api_version = "5.131"
-        self.base_url = "https://api.vk.com/method/"
-        
-    async def search_audio(self, query: str, count: int = 10):
+        self.base_url = (base_url or "https://api.vk.com/method").rstrip('/')
+        # Сколько аудио запрашиваем в одном вызове audio.getById
+        self.batch_size = batch_size
+        # Прямые ссылки на аудио: "owner_id_audio_id" -> url
+        self.audio_urls = TTLCache(maxsize=4096, ttl=600)
+    
+    async def _call(self, method: str, **params) -> dict:
+        """Вызов метода API; ошибка VK превращается в исключение"""
+        params.update(access_token=self.access_token, v=self.api_version)
+        data = await http_pool.request('POST', f"{self.base_url}/{method}", data=params)
+        if 'error' in data:
+            raise http_pool.UpstreamError(f"VK {method}: {data['error'].get('error_msg')}")
+        return data.get('response')
+    
+    def _parse_audio(self, item: dict) -> Dict[str, str]:
+        """Преобразует аудиозапись из ответа API в формат бота"""
+        track = {
+            'id': make_track_id('vk', item.get('artist', ''), item.get('title', '')),
+            'title': item.get('title', ''),
+            'artist': item.get('artist', ''),
+            'duration': self._format_duration(item.get('duration')),
+            # id аудио в API: "owner_id_audio_id"
+            'url': f"{item['owner_id']}_{item['id']}",
+            'source': 'vk'
+        }
+        album = item.get('album') or {}
+        if album.get('title'):
+            track['album'] = album['title']
+        cover = (album.get('thumb') or {}).get('photo_300')
+        if cover:
+            track['cover'] = cover
+        return track
+    
+    async def search_audio(self, query: str, count: int = 10) -> List[Dict[str, str]]:
         """Поиск аудио через VK API"""
-        # Этот метод требует токен доступа VK
-        # Пока оставляем как заготовку для будущего использования
-        pass
+        response = await self._call('audio.search', q=query, count=count, auto_complete=1)
+        return [self._parse_audio(item) for item in (response or {}).get('items', [])]
+    
+    async def get_audio_by_id(self, audio_ids: List[str]) -> Dict[str, dict]:
+        """
+        Аудиозаписи по id: по batch_size id в одном вызове, пачки - параллельно
+        
+        Returns:
+            Словарь "owner_id_audio_id" -> запись API (с прямой ссылкой url)
+        """
+        batches = [audio_ids[i:i + self.batch_size] for i in range(0, len(audio_ids), self.batch_size)]
+        results = await asyncio.gather(*(self._call('audio.getById', audios=','.join(batch)) for batch in batches))
+        return {f"{item['owner_id']}_{item['id']}": item for batch in results for item in batch or []}
     
-    async def get_audio_by_id(self, audio_id: str):
-        """Получение аудио по ID"""
-        # Заготовка для будущего использования
-        pass
+    async def get_audio_urls(self, audio_ids: List[str]) -> Dict[str, Optional[str]]:
+        """Прямые ссылки на аудио: из кэша, недостающие - пачками через audio.getById"""
+        urls = {audio_id: self.audio_urls.get(audio_id) for audio_id in audio_ids}
+        missing = [audio_id for audio_id, url in urls.items() if url is None]
+        if missing:
+            for audio_id, item in (await self.get_audio_by_id(missing)).items():
+                if item.get('url'):
+                    self.audio_urls.set(audio_id, item['url'])
+                    urls[audio_id] = item['url']
+        return urls
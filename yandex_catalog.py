@@ -0,0 +1,60 @@
+"""
+Локальная база треков Яндекс.Музыки - отдельно от загрузчика: подсказки
+строятся при старте без импорта модуля источника
+"""
+from typing import Dict, List
+
+# База данных популярных треков Яндекс.Музыки
+YANDEX_DATABASE = {
+    'lil peep': [
+        {'title': 'Save That Shit', 'artist': 'Lil Peep', 'duration': '2:45', 'album': 'Come Over When You\'re Sober, Pt. 1'},
+        {'title': 'Awful Things', 'artist': 'Lil Peep feat. Lil Tracy', 'duration': '3:12', 'album': 'Come Over When You\'re Sober, Pt. 1'},
+        {'title': 'Star Shopping', 'artist': 'Lil Peep', 'duration': '2:18', 'album': 'Lil Peep Part One'},
+        {'title': 'Crybaby', 'artist': 'Lil Peep', 'duration': '3:01', 'album': 'Crybaby'},
+        {'title': 'The Brightside', 'artist': 'Lil Peep', 'duration': '2:33', 'album': 'Come Over When You\'re Sober, Pt. 2'},
+    ],
+    'morgenshtern': [
+        {'title': 'Cadillac', 'artist': 'MORGENSHTERN feat. Элджей', 'duration': '2:33', 'album': 'LEGENDARY'},
+        {'title': 'Aristocrat', 'artist': 'MORGENSHTERN', 'duration': '2:45', 'album': 'MILLION DOLLAR VIEWS'},
+        {'title': 'Yung Hefner', 'artist': 'MORGENSHTERN', 'duration': '2:28', 'album': 'MILLION DOLLAR VIEWS'},
+        {'title': 'PABLO', 'artist': 'MORGENSHTERN', 'duration': '2:15', 'album': 'MILLION DOLLAR VIEWS'},
+    ],
+    'face': [
+        {'title': 'Бургер', 'artist': 'FACE', 'duration': '3:12', 'album': 'NO FACE'},
+        {'title': 'Юморист', 'artist': 'FACE', 'duration': '2:45', 'album': 'FACE'},
+        {'title': 'Гоша Рубчинский', 'artist': 'FACE', 'duration': '2:33', 'album': 'FACE'},
+        {'title': 'Я роняю запад', 'artist': 'FACE', 'duration': '3:45', 'album': 'HATE LOVE'},
+    ],
+    'элджей': [
+        {'title': 'Розовое вино', 'artist': 'Элджей feat. Feduk', 'duration': '3:28', 'album': 'Sayonara Boy'},
+        {'title': 'Минимал', 'artist': 'Элджей', 'duration': '3:15', 'album': 'Sayonara Boy'},
+        {'title': 'Hey, Guys', 'artist': 'Элджей', 'duration': '2:58', 'album': 'Sayonara Boy'},
+    ],
+    'billie eilish': [
+        {'title': 'bad guy', 'artist': 'Billie Eilish', 'duration': '3:14', 'album': 'WHEN WE ALL FALL ASLEEP, WHERE DO WE GO?'},
+        {'title': 'when the party\'s over', 'artist': 'Billie Eilish', 'duration': '3:16', 'album': 'WHEN WE ALL FALL ASLEEP, WHERE DO WE GO?'},
+        {'title': 'lovely', 'artist': 'Billie Eilish & Khalid', 'duration': '3:20', 'album': '13 Reasons Why (Season 2)'},
+        {'title': 'ocean eyes', 'artist': 'Billie Eilish', 'duration': '3:20', 'album': 'dont smile at me'},
+    ],
+    'imagine dragons': [
+        {'title': 'Believer', 'artist': 'Imagine Dragons', 'duration': '3:24', 'album': 'Evolve'},
+        {'title': 'Thunder', 'artist': 'Imagine Dragons', 'duration': '3:07', 'album': 'Evolve'},
+        {'title': 'Radioactive', 'artist': 'Imagine Dragons', 'duration': '3:06', 'album': 'Night Visions'},
+        {'title': 'Demons', 'artist': 'Imagine Dragons', 'duration': '2:57', 'album': 'Night Visions'},
+    ],
+    'скриптонит': [
+        {'title': 'Вечеринка', 'artist': 'Скриптонит', 'duration': '4:12', 'album': 'Уроки Выживания'},
+        {'title': 'Это любовь', 'artist': 'Скриптонит', 'duration': '3:45', 'album': 'Дом с нормальными явлениями'},
+        {'title': 'Положение', 'artist': 'Скриптонит feat. Andro', 'duration': '3:33', 'album': 'Дом с нормальными явлениями'},
+    ],
+    'oxxxymiron': [
+        {'title': 'Город под подошвой', 'artist': 'Oxxxymiron', 'duration': '6:18', 'album': 'Горгород'},
+        {'title': 'Переплетено', 'artist': 'Oxxxymiron', 'duration': '4:45', 'album': 'Горгород'},
+        {'title': 'Неваляшка', 'artist': 'Oxxxymiron', 'duration': '4:12', 'album': 'Вечно молодой'},
+    ]
+}
+
+
+def known_tracks() -> List[Dict[str, str]]:
+    """Треки локальной базы (для подсказок и прогрева)"""
+    return [track for track_list in YANDEX_DATABASE.values() for track in track_list]